@@ -9,7 +9,12 @@ import logging
 import yaml
 from yaml.loader import SafeLoader
 from botpage import botpage
+from bot_catalog import BOT_CATALOG
 from bot_management import bot_management_page
+from db_indexes import ensure_indexes
+from session_store import fetch_session_summaries, load_session
+from session_writer import SESSION_WRITER
+import telemetry
 
 from streamlit.runtime.caching import cache_resource, cache_data
 from pymongo import MongoClient
@@ -18,59 +23,57 @@ from datetime import datetime
 
 @cache_resource(ttl=600)
 def get_db(mongo_uri, mongo_db):
-    """Get the MongoDB database."""
+    """Get the MongoDB database, creating its indexes on first connect."""
     client = MongoClient(mongo_uri)
-    return client[mongo_db]
-
-
-def fetch_user_sessions(db, username, skip=0, limit=50):
-    """Fetch sessions for the current user from MongoDB."""
-    return list(
-        db.sessions.find({"user": username})
-        .sort("create_time", -1)
-        .skip(skip)
-        .limit(limit)
-    )
-
-
-def fetch_bots(db):
-    """Fetch all bots from MongoDB."""
-    return list(db.bots.find().sort("id", 1))
-
-
-def initialize_bots(db, config_bots):
-    """Initialize bots from MongoDB or create from config if none exist."""
-    bots = fetch_bots(db)
-    if not bots and config_bots:
-        # Insert config bots into MongoDB if the collection is empty
-        for bot in config_bots:
-            db.bots.insert_one(bot)
-        return config_bots
-    return bots
+    db = client[mongo_db]
+    ensure_indexes(db)
+    return db
 
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Expose the turn telemetry to Prometheus (once per process, if configured)
+telemetry.serve_metrics()
+
 
 # Function to create a new session
 def create_new_session(username, bot_id):
     """Create a new session for the user with the specified bot."""
     return {
-        "id": int(time.time()),
+        # Microsecond resolution: sessions started by different users within the
+        # same second must not share an id (sessions are upserted by id)
+        "id": time.time_ns() // 1000,
         "user": username,
         "create_time": datetime.now(),
         "name": None,
         "bot_id": bot_id,
         "messages": [],
+        "message_count": 0,
     }
 
 
 # Function to set the current session
-def set_current_session(session):
-    """Set the current session in the Streamlit session state."""
+def set_current_session(session, db=None):
+    """Set the current session, loading its messages if only the summary is known."""
+    if "messages" not in session:
+        if db is not None:
+            # Write the saves of the session being left and of the one loaded
+            current = st.session_state.get("current_session")
+            SESSION_WRITER.flush([session["id"]] + ([current["id"]] if current else []))
+        full_session = (
+            load_session(db, st.session_state["name"], session["id"])
+            if db is not None
+            else None
+        )
+        if full_session is None:
+            st.session_state.session_load_failed = True
+            return
+        session = full_session
     st.session_state.current_session = session
+    # Loaded tool responses are keyed by message index
+    st.session_state.loaded_tool_responses = set()
 
 
 def load_config(config_file):
@@ -97,17 +100,15 @@ def initialize_session_state(config, db):
 
     # Initialize bots from MongoDB or fallback to config
     if db is not None:
+        # Shared by all sessions; reloaded when any session edits a bot
+        st.session_state.bots = BOT_CATALOG.bots(db, config.get("bots", []))
         # Always set refresh_bots to False to avoid infinite refreshes
         refresh_needed = st.session_state.get("refresh_bots", False)
-        if (
-            "bots" not in st.session_state
-            or "bot_sessions" not in st.session_state
-            or refresh_needed
-        ):
-            st.session_state.bots = initialize_bots(db, config.get("bots", []))
-            st.session_state.bot_sessions = fetch_user_sessions(
-                db, st.session_state["name"]
-            )
+        if "bot_sessions" not in st.session_state or refresh_needed:
+            (
+                st.session_state.bot_sessions,
+                st.session_state.session_page_token,
+            ) = fetch_session_summaries(db, st.session_state["name"])
             st.session_state.refresh_bots = False
     else:
         if "bots" not in st.session_state:
@@ -243,6 +244,8 @@ if st.session_state["authentication_status"]:
 
             # Session history buttons
             st.subheader("会话记录")
+            if st.session_state.pop("session_load_failed", False):
+                st.warning("会话加载失败，请稍后重试。")
 
             # Group sessions by date
             grouped_sessions = {}
@@ -262,19 +265,23 @@ if st.session_state["authentication_status"]:
                         str(session["name"]),
                         key=session["id"],
                         on_click=set_current_session,
-                        args=(session,),
+                        args=(session, db),
                         disabled=session["id"]
                         == st.session_state.current_session["id"],
                         use_container_width=True,
                     )
 
-            if db is not None:
+            if db is not None and st.session_state.get("session_page_token"):
                 if st.button("加载更多", use_container_width=True):
-                    skip = len(st.session_state.bot_sessions)
-                    additional_sessions = fetch_user_sessions(
-                        db, st.session_state["name"], skip=skip
+                    additional_sessions, st.session_state.session_page_token = (
+                        fetch_session_summaries(
+                            db,
+                            st.session_state["name"],
+                            page_token=st.session_state.session_page_token,
+                        )
                     )
                     st.session_state.bot_sessions.extend(additional_sessions)
+                    st.rerun()
 
     # Display the appropriate page based on current_page
     if st.session_state.current_page == "chat":
@@ -0,0 +1,594 @@
+"""Microbenchmarks of the chat hot paths.
+
+Each case runs one hot path on a synthetic session of growing size and
+reports its best wall time over the repeats, the peak memory allocated while it runs
+(tracemalloc) and the number of Streamlit render calls it makes.  Page
+rendering goes through ``RecordingStreamlit`` instead of a live Streamlit
+session, and ``process_tool_calls`` runs a real turn against the local
+stub model and web servers in ``stub_servers``.
+
+Run from the repository root::
+
+    python -m benchmarks.bench                    # compare with baseline.json
+    python -m benchmarks.bench --update-baseline  # record a new baseline
+
+The command exits with status 1 when a case regresses past the baseline by
+more than the tolerance of a metric.  Timings depend on the machine, so
+record the baseline on the machine the comparison runs on.
+"""
+
+from types import SimpleNamespace
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import blob_store
+import botpage
+import chat_engine
+import generation_worker
+from benchmarks.stub_servers import (
+    LOREM,
+    StubLLMServer,
+    StubWebServer,
+    routed_web_tools,
+)
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+# Allowed relative growth per metric before a case counts as a regression.
+TOLERANCES = {"time_ms": 0.5, "peak_kib": 0.25, "renders": 0.25}
+
+# Absolute growth always tolerated, so tiny values do not flap; timings of a few
+# milliseconds vary by more than the relative tolerance between runs.
+ABSOLUTE_SLACK = {"time_ms": 2.0, "peak_kib": 16.0, "renders": 2}
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+
+class StopScript(Exception):
+    """Raised by ``RecordingStreamlit`` where Streamlit would end the script run."""
+
+
+class SessionState(dict):
+    """Dict with attribute access, like ``st.session_state``."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+class _Element:
+    """Stand-in for a DeltaGenerator: usable as a context manager and as ``st``."""
+
+    def __init__(self, recorder: "RecordingStreamlit"):
+        self._recorder = recorder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._recorder, name)
+
+
+class RecordingStreamlit:
+    """Minimal ``streamlit`` replacement that counts render calls."""
+
+    RENDER_CALLS = ("markdown", "text", "image", "caption", "warning", "error")
+
+    def __init__(self):
+        self.session_state = SessionState()
+        self.renders = 0
+
+    def __getattr__(self, name):
+        if name in self.RENDER_CALLS:
+            return self._render
+        raise AttributeError(name)
+
+    def _render(self, *args, **kwargs) -> None:
+        self.renders += 1
+
+    def copy_to_clipboard(self, *args, **kwargs) -> None:
+        self.renders += 1
+
+    def chat_message(self, *args, **kwargs):
+        return _Element(self)
+
+    expander = container = empty = chat_message
+
+    def columns(self, spec, **kwargs):
+        count = spec if isinstance(spec, int) else len(spec)
+        return [_Element(self) for _ in range(count)]
+
+    def button(self, *args, **kwargs) -> bool:
+        return False
+
+    def chat_input(self, *args, **kwargs):
+        return None
+
+    def file_uploader(self, *args, **kwargs):
+        return None
+
+    def rerun(self):
+        raise StopScript("rerun")
+
+    def stop(self):
+        raise StopScript("stop")
+
+
+@contextmanager
+def patched(target, name: str, value):
+    """Temporarily replace an attribute."""
+    original = getattr(target, name)
+    setattr(target, name, value)
+    try:
+        yield value
+    finally:
+        setattr(target, name, original)
+
+
+@contextmanager
+def recording_page():
+    """Route the page rendering of botpage to a fresh RecordingStreamlit."""
+    recorder = RecordingStreamlit()
+    with patched(botpage, "st", recorder), patched(
+        botpage, "st_copy_to_clipboard", recorder.copy_to_clipboard
+    ):
+        yield recorder
+
+
+def make_session(size: int, session_id: int = 1) -> Dict[str, Any]:
+    """Build a session of about ``size`` messages; every third turn uses a tool."""
+    messages: List[Dict[str, Any]] = []
+    turn = 0
+    while len(messages) < size:
+        messages.append(
+            {
+                "role": "user",
+                "content": f"Question {turn}: {LOREM}",
+                "reasoning_content": "",
+            }
+        )
+        if turn % 3 == 2:
+            call_id = f"call_{turn}"
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": "",
+                    "reasoning_content": LOREM,
+                    "tool_calls": [
+                        {
+                            "id": call_id,
+                            "type": "function",
+                            "function": {
+                                "name": "fetch_url",
+                                "arguments": json.dumps(
+                                    {"url": f"https://example.com/{turn}"}
+                                ),
+                            },
+                        }
+                    ],
+                }
+            )
+            messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": call_id,
+                    "content": LOREM * 20,
+                    "reasoning_content": "",
+                }
+            )
+        messages.append(
+            {
+                "role": "assistant",
+                "content": f"Answer {turn}:\n\n" + LOREM * 4,
+                "reasoning_content": LOREM,
+            }
+        )
+        turn += 1
+    return {
+        "id": session_id,
+        "user": "bench",
+        "name": "bench",
+        "bot_id": 1,
+        "messages": messages[:size],
+        "message_count": size,
+    }
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _stream_chunks(count: int, clock: FakeClock, chunk_rate: float):
+    """Yield OpenAI-style stream chunks, advancing the clock at chunk_rate."""
+    step = 1.0 / chunk_rate
+    for i in range(count):
+        clock.now += step
+        delta = SimpleNamespace(
+            content="token " if i % 4 else "token\n",
+            reasoning_content=None,
+            tool_calls=None,
+        )
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class _ChunkStream:
+    """Async stream over scripted chunks, as returned by the OpenAI client."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+    async def close(self) -> None:
+        pass
+
+
+class _RenderingCallbacks(chat_engine.TurnCallbacks):
+    """Feed the deltas of a stream into a StreamRenderer."""
+
+    def __init__(self, renderer: botpage.StreamRenderer):
+        self.renderer = renderer
+
+    def on_delta(self, content, reasoning, tool_progress, tool_calls) -> None:
+        self.renderer.feed(content, reasoning, tool_progress)
+        self.renderer.update(tool_calls)
+
+
+# --- Cases ---
+
+
+def case_stream_completion(chunks: int, chunk_rate: float) -> Callable[[], int]:
+    """Stream a reply through chat_engine into a rate-limited StreamRenderer."""
+
+    def run() -> int:
+        clock = FakeClock()
+
+        async def _create(**request):
+            return _ChunkStream(_stream_chunks(chunks, clock, chunk_rate))
+
+        client = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=_create))
+        )
+        with recording_page() as recorder:
+            renderer = botpage.StreamRenderer(clock=clock, parent=recorder)
+            _, _, tool_calls, _ = asyncio.run(
+                chat_engine.stream_completion(client, {}, _RenderingCallbacks(renderer))
+            )
+            renderer.finish(tool_calls)
+        return recorder.renders
+
+    return run
+
+
+class _ScriptedJob(generation_worker.GenerationJob):
+    """A job whose deltas arrive, ``per_wait`` at a time, whenever the page waits."""
+
+    def __init__(self, session, deltas, per_wait: int):
+        super().__init__(session)
+        self._deltas = iter(deltas)
+        self._per_wait = per_wait
+
+    def wait(self, version: int, timeout: float) -> None:
+        batch = list(itertools.islice(self._deltas, self._per_wait))
+        for reasoning, content in batch:
+            self.on_delta(content, reasoning, 0, {})
+        if not batch:
+
+            async def _finish(job):
+                job.on_assistant_message(
+                    {"role": "assistant", "content": "done", "reasoning_content": ""},
+                    {},
+                )
+                return False
+
+            self._run(_finish)
+
+
+def case_attach_generation(chunks: int) -> Callable[[], int]:
+    """Follow a reply streaming reasoning and then content, ten deltas per redraw."""
+    deltas = [
+        ("token " if i % 4 else "token\n", "") if i < chunks // 2 else ("", "token ")
+        for i in range(chunks)
+    ]
+
+    def run() -> int:
+        session = make_session(0, session_id="bench-attach")
+        job = _ScriptedJob(session, deltas, per_wait=10)
+        with recording_page() as recorder, _no_render_interval():
+            try:
+                botpage.attach_generation(session, job)
+            except StopScript:
+                pass
+        return recorder.renders
+
+    return run
+
+
+@contextmanager
+def _no_render_interval():
+    interval = botpage.STREAM_RENDER_INTERVAL
+    botpage.STREAM_RENDER_INTERVAL = 0
+    try:
+        yield
+    finally:
+        botpage.STREAM_RENDER_INTERVAL = interval
+
+
+def case_prepare_messages(size: int) -> Callable[[], int]:
+    session = make_session(size)
+
+    def run() -> int:
+        botpage.prepare_messages_for_api(session)
+        return 0
+
+    return run
+
+
+def case_inject_system_prompt(size: int, role: str) -> Callable[[], int]:
+    messages = botpage.prepare_messages_for_api(make_session(size))
+    system_prompt_list = [{"role": role, "content": LOREM}]
+
+    def run() -> int:
+        botpage._inject_system_prompt(messages, system_prompt_list)
+        return 0
+
+    return run
+
+
+def case_display_chat_messages(size: int, window: Optional[int]) -> Callable[[], int]:
+    session = make_session(size)
+
+    def run() -> int:
+        with recording_page() as recorder:
+            recorder.session_state.history_window_session_id = session["id"]
+            recorder.session_state.history_window = window or size
+            botpage.display_chat_messages(session, None)
+        return recorder.renders
+
+    return run
+
+
+def case_process_tool_calls(
+    size: int, llm: StubLLMServer, web: StubWebServer
+) -> Callable[[], int]:
+    def run() -> int:
+        session = make_session(size, session_id=f"bench-{size}")
+        session["messages"].append(
+            {"role": "user", "content": "Fetch the pages", "reasoning_content": ""}
+        )
+        botpage.TOOL_CACHE.clear()
+        with recording_page() as recorder:
+            job = botpage.process_tool_calls(
+                botpage.prepare_messages_for_api(session),
+                "stub",
+                f"{llm.base_url}/v1",
+                "stub",
+                True,
+                session,
+            )
+            try:
+                botpage.attach_generation(session, job)
+            except StopScript:
+                pass
+        if job.status != "done":
+            raise RuntimeError(f"Stub turn ended with {job.status}: {job.error}")
+        return recorder.renders
+
+    return run
+
+
+@contextmanager
+def stub_environment(chunk_rate: float, page_bytes: int):
+    """Start the stub servers and route the web tools to them."""
+    with StubWebServer(page_bytes=page_bytes) as web, StubLLMServer(
+        web_base_url=web.base_url, chunk_rate=chunk_rate
+    ) as llm, routed_web_tools(web.base_url):
+        yield llm, web
+
+
+def measure(run: Callable[[], int], repeat: int) -> Dict[str, float]:
+    """Return the best time, peak allocation and render count of a case.
+
+    One untimed run warms the caches first; the best of the timed runs is
+    the least disturbed by other work on the machine.
+    """
+    run()
+    times = []
+    renders = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        renders = run()
+        times.append((time.perf_counter() - started) * 1000)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "time_ms": round(min(times), 3),
+        "peak_kib": round(peak / 1024, 1),
+        "renders": renders,
+    }
+
+
+def run_benchmarks(
+    sizes=DEFAULT_SIZES,
+    repeat: int = 5,
+    chunk_rate: float = 0.0,
+    page_bytes: int = 20_000,
+    only: Optional[str] = None,
+) -> Dict[str, Dict[str, float]]:
+    """Run every case and return its metrics keyed by case name."""
+    blob_store.configure(None)
+    botpage.TOOL_CACHE.bind_collection(None)
+    results = {}
+
+    def _run(name, factory):
+        if only and only not in name:
+            return
+        results[name] = measure(factory(), repeat)
+        logger.info(f"{name}: {results[name]}")
+
+    with stub_environment(chunk_rate, page_bytes) as (llm, web):
+        for size in sizes:
+            _run(
+                f"stream_completion[chunks={size * 10}]",
+                lambda: case_stream_completion(size * 10, 50.0),
+            )
+            _run(
+                f"attach_generation[chunks={size * 10}]",
+                lambda: case_attach_generation(size * 10),
+            )
+            _run(
+                f"prepare_messages_for_api[n={size}]",
+                lambda: case_prepare_messages(size),
+            )
+            for role in ("system", "user"):
+                _run(
+                    f"_inject_system_prompt[n={size},role={role}]",
+                    lambda: case_inject_system_prompt(size, role),
+                )
+            _run(
+                f"display_chat_messages[n={size},window]",
+                lambda: case_display_chat_messages(size, botpage.CHAT_HISTORY_WINDOW),
+            )
+            _run(
+                f"display_chat_messages[n={size},all]",
+                lambda: case_display_chat_messages(size, None),
+            )
+            _run(
+                f"process_tool_calls[n={size}]",
+                lambda: case_process_tool_calls(size, llm, web),
+            )
+    return results
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerances: Optional[Dict[str, float]] = None,
+) -> List[str]:
+    """Describe every metric that grew past its tolerance; cases without a baseline are skipped."""
+    tolerances = {**TOLERANCES, **(tolerances or {})}
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric, tolerance in tolerances.items():
+            if metric not in base or metric not in metrics:
+                continue
+            limit = base[metric] * (1 + tolerance) + ABSOLUTE_SLACK.get(metric, 0)
+            if metrics[metric] > limit:
+                regressions.append(
+                    f"{name}: {metric} {metrics[metric]} > {limit:.1f} (baseline {base[metric]})"
+                )
+    return regressions
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, float]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.warning(f"No baseline at {path}")
+        return {}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(map(str, DEFAULT_SIZES)),
+        help="comma-separated session sizes",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument(
+        "--chunk-rate",
+        type=float,
+        default=0.0,
+        help="stub model chunks per second; 0 streams as fast as possible",
+    )
+    parser.add_argument(
+        "--page-bytes",
+        type=int,
+        default=20_000,
+        help="size of the stub pages fetched by fetch_url",
+    )
+    parser.add_argument(
+        "--only", help="run only the cases whose name contains this text"
+    )
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--time-tolerance", type=float, help="override the relative time tolerance"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+    results = run_benchmarks(
+        sizes=[int(size) for size in args.sizes.split(",")],
+        repeat=args.repeat,
+        chunk_rate=args.chunk_rate,
+        page_bytes=args.page_bytes,
+        only=args.only,
+    )
+
+    print(f"{'case':<50} {'time_ms':>10} {'peak_kib':>10} {'renders':>8}")
+    for name, metrics in results.items():
+        print(
+            f"{name:<50} {metrics['time_ms']:>10} {metrics['peak_kib']:>10} {metrics['renders']:>8}"
+        )
+
+    if args.update_baseline:
+        baseline = {**load_baseline(args.baseline), **results}
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    tolerances = {}
+    if args.time_tolerance is not None:
+        tolerances["time_ms"] = args.time_tolerance
+    regressions = find_regressions(results, load_baseline(args.baseline), tolerances)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""CPU time and output size of the HTML extraction per saved page.
+
+Each fixture in ``benchmarks/fixtures`` is run through the extraction of
+``extraction`` and through the previous path (BeautifulSoup's
+``html.parser`` with the whole ``<body>`` converted by markdownify, or the
+CSS selection of the Bing results), so the two can be compared::
+
+    python -m benchmarks.extraction_bench
+    python -m benchmarks.extraction_bench --repeat 20 --fixtures path/to/page.html
+
+Pages whose name starts with ``bing`` are parsed as search result pages.
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import markdownify
+from bs4 import BeautifulSoup
+
+import extraction
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def legacy_fetch(data: bytes) -> str:
+    """The fetch_url extraction before the extraction module."""
+    soup = BeautifulSoup(data, "html.parser", from_encoding="utf-8")
+    body = soup.find("body")
+    return markdownify.markdownify(str(body) if body else "", heading_style="ATX")
+
+
+def legacy_search(data: bytes) -> str:
+    """The search_web parsing before the extraction module."""
+    soup = BeautifulSoup(data, "html.parser")
+    results = []
+    for li in soup.select("#b_results li.b_algo")[:5]:
+        a_tag = li.select_one("h2 a")
+        snippet_tag = li.select_one(".b_caption p")
+        if a_tag and a_tag.get("href", "").startswith(("http://", "https://")):
+            results.append(
+                {
+                    "title": a_tag.get_text(),
+                    "url": a_tag["href"],
+                    "snippet": snippet_tag.get_text() if snippet_tag else "",
+                }
+            )
+    return json.dumps(results, ensure_ascii=False)
+
+
+def engines(name: str) -> Dict[str, Callable[[bytes], str]]:
+    if name.startswith("bing"):
+        return {
+            "legacy": legacy_search,
+            "lxml": lambda data: json.dumps(
+                extraction.parse_search_results(data), ensure_ascii=False
+            ),
+        }
+    return {
+        "legacy": legacy_fetch,
+        "trafilatura": lambda data: extraction.html_to_markdown(data, "utf-8"),
+    }
+
+
+def measure(run: Callable[[bytes], str], data: bytes, repeat: int) -> Dict[str, float]:
+    """Return the median CPU time (ms) of ``repeat`` runs and the output size."""
+    times: List[float] = []
+    output = ""
+    for _ in range(repeat):
+        started = time.process_time()
+        output = run(data)
+        times.append((time.process_time() - started) * 1000)
+    return {
+        "cpu_ms": statistics.median(times),
+        "output_bytes": len(output.encode("utf-8")),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--fixtures",
+        nargs="+",
+        default=sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html"))),
+        help="saved HTML pages to extract",
+    )
+    args = parser.parse_args(argv)
+
+    print(
+        f"{'page':<16}{'input_bytes':>12}  {'engine':<12}{'cpu_ms':>9}"
+        f"{'output_bytes':>14}"
+    )
+    for path in args.fixtures:
+        name = os.path.basename(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        for engine, run in engines(name).items():
+            result = measure(run, data, args.repeat)
+            print(
+                f"{name:<16}{len(data):>12}  {engine:<12}{result['cpu_ms']:>9.2f}"
+                f"{result['output_bytes']:>14}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,664 @@
+"""Concurrent-user load generator for the whole Streamlit app.
+
+The harness starts ``app.py`` under ``streamlit run`` (see ``serve_app``)
+against the local stub model and web servers, and by default an in-memory
+MongoDB stand-in.  It then drives N simulated users through the real
+browser websocket protocol.  Each user logs in, replays a scripted
+conversation with think time between turns and makes an idle rerun after
+every reply, like a click elsewhere on the page.  The user count is ramped
+through ``--users`` and every level reports:
+
+- login latency (first page load and the login rerun)
+- rerun latency percentiles of script runs that do not generate a reply
+- time to first token (TTFT) and full turn latency
+- server RSS and the RSS added per connected user
+- errors
+
+The saturation point is the first level that breaks an SLO.  Pin the
+server to one CPU (``--cpu 0``) to match the ``ai-bots`` container limits
+in docker-compose.yml::
+
+    python -m benchmarks.loadtest --users 1,2,4,8,16 --cpu 0
+    python -m benchmarks.loadtest --url http://localhost:8501 --server-pid 1234 \\
+        --password <pw> --users 4  # against an app started elsewhere
+
+Requires ``mongomock`` unless ``--mongo-uri`` is given.
+"""
+
+from urllib.parse import quote, urlsplit
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import streamlit_authenticator as stauth
+import yaml
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from tornado.httpclient import AsyncHTTPClient
+from tornado.websocket import websocket_connect
+
+from benchmarks.stub_servers import StubLLMServer, StubWebServer
+
+logger = logging.getLogger(__name__)
+
+PASSWORD = "loadtest"
+
+DEFAULT_CONVERSATION = [
+    "帮我总结一下今天的新闻。",
+    "Compare the two most relevant pages you found.",
+    "给出三条建议。",
+]
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Return the pct-th percentile (nearest rank) of values, or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def is_reply_output(body: str) -> bool:
+    """Return True for markdown the chat page renders while a reply streams."""
+    return body.endswith(" | ") or "**Tool Calls:**" in body
+
+
+class ScriptRun:
+    """The elements of one script run and when the reply to ``prompt`` first showed."""
+
+    def __init__(self, prompt: Optional[str] = None):
+        self.widgets: Dict[str, List[Any]] = {}
+        self.markdown: List[str] = []
+        self.exceptions: List[str] = []
+        self.first_output_at: Optional[float] = None
+        # The history above the echoed prompt may contain old tool calls
+        self._prompt = prompt
+        self._prompt_seen = False
+
+    def add(self, element) -> None:
+        kind = element.WhichOneof("type")
+        if kind in ("text_input", "button", "chat_input"):
+            self.widgets.setdefault(kind, []).append(getattr(element, kind))
+        elif kind == "markdown":
+            body = element.markdown.body
+            self.markdown.append(body)
+            if self._prompt is not None and body == self._prompt:
+                self._prompt_seen = True
+            elif (
+                self._prompt_seen
+                and self.first_output_at is None
+                and is_reply_output(body)
+            ):
+                self.first_output_at = time.perf_counter()
+        elif kind == "exception":
+            self.exceptions.append(element.exception.message)
+
+    def widget(self, kind: str, label: Optional[str] = None):
+        for widget in self.widgets.get(kind, []):
+            if label is None or widget.label == label:
+                return widget
+        return None
+
+
+class StreamlitClient:
+    """Minimal client of the Streamlit browser websocket protocol."""
+
+    def __init__(self, base_url: str, timeout: float = 120.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._ws = None
+        self._cache: Dict[str, ForwardMsg] = {}
+        self.last_run: Optional[ScriptRun] = None
+
+    async def connect(self) -> None:
+        parts = urlsplit(self.base_url)
+        scheme = "wss" if parts.scheme == "https" else "ws"
+        self._ws = await websocket_connect(
+            f"{scheme}://{parts.netloc}{parts.path}/_stcore/stream",
+            subprotocols=["streamlit"],
+            max_message_size=256 * 1024 * 1024,
+        )
+
+    def close(self) -> None:
+        if self._ws is not None:
+            self._ws.close()
+
+    async def _resolve(self, msg: ForwardMsg) -> ForwardMsg:
+        """Return the message a ref_hash message points to."""
+        if msg.WhichOneof("type") != "ref_hash":
+            if msg.hash:
+                self._cache[msg.hash] = msg
+            return msg
+        cached = self._cache.get(msg.ref_hash)
+        if cached is None:
+            response = await AsyncHTTPClient().fetch(
+                f"{self.base_url}/_stcore/message?hash={quote(msg.ref_hash)}"
+            )
+            cached = ForwardMsg()
+            cached.ParseFromString(response.body)
+            self._cache[msg.ref_hash] = cached
+        return cached
+
+    async def rerun(
+        self,
+        widget_states: Optional[List[WidgetState]] = None,
+        prompt: Optional[str] = None,
+    ) -> ScriptRun:
+        """Request a script run and wait until it, and any reruns it triggers, finish.
+
+        With ``prompt``, the time the reply to it first shows is recorded.
+        """
+        back_msg = BackMsg()
+        back_msg.rerun_script.query_string = ""
+        back_msg.rerun_script.page_script_hash = ""
+        back_msg.rerun_script.widget_states.widgets.extend(widget_states or [])
+        await self._ws.write_message(back_msg.SerializeToString(), binary=True)
+        return await asyncio.wait_for(self._read_until_finished(prompt), self.timeout)
+
+    async def _read_until_finished(self, prompt: Optional[str]) -> ScriptRun:
+        run = ScriptRun(prompt)
+        first_output_at = None
+        runs_started = 0
+        while True:
+            data = await self._ws.read_message()
+            if data is None:
+                raise ConnectionError("websocket closed by the server")
+            msg = ForwardMsg()
+            msg.ParseFromString(data)
+            msg = await self._resolve(msg)
+            kind = msg.WhichOneof("type")
+            if kind == "new_session":
+                # A new run starts; only the widgets of the last run are current
+                runs_started += 1
+                first_output_at = first_output_at or run.first_output_at
+                run = ScriptRun(prompt if runs_started == 1 else None)
+            elif kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+                run.add(msg.delta.new_element)
+            elif kind == "script_finished":
+                status = msg.script_finished
+                if status == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    continue
+                if status == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise RuntimeError("app script failed to compile")
+                run.first_output_at = first_output_at or run.first_output_at
+                self.last_run = run
+                return run
+
+
+def string_state(widget_id: str, value: str) -> WidgetState:
+    state = WidgetState(id=widget_id)
+    state.string_value = value
+    return state
+
+
+def trigger_state(widget_id: str) -> WidgetState:
+    state = WidgetState(id=widget_id)
+    state.trigger_value = True
+    return state
+
+
+def chat_state(widget_id: str, prompt: str) -> WidgetState:
+    state = WidgetState(id=widget_id)
+    state.chat_input_value.data = prompt
+    return state
+
+
+class LevelStats:
+    """Measurements of one load level."""
+
+    def __init__(self, users: int):
+        self.users = users
+        self.login_ms: List[float] = []
+        self.rerun_ms: List[float] = []
+        self.ttft_ms: List[float] = []
+        self.turn_ms: List[float] = []
+        self.errors: List[str] = []
+        self.turns = 0
+        self.idle_rss_mib: Optional[float] = None
+        self.peak_rss_mib: Optional[float] = None
+        self.elapsed_s = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        def _round(value):
+            return None if value is None else round(value, 1)
+
+        summary = {
+            "users": self.users,
+            "turns": self.turns,
+            "errors": len(self.errors),
+            "turns_per_s": _round(self.turns / self.elapsed_s if self.elapsed_s else 0),
+        }
+        for name, values in (
+            ("login_ms", self.login_ms),
+            ("rerun_ms", self.rerun_ms),
+            ("ttft_ms", self.ttft_ms),
+            ("turn_ms", self.turn_ms),
+        ):
+            for pct in (50, 95, 99):
+                summary[f"{name}_p{pct}"] = _round(percentile(values, pct))
+        summary["rss_mib"] = _round(self.peak_rss_mib)
+        if self.peak_rss_mib is not None and self.idle_rss_mib is not None:
+            summary["mib_per_user"] = _round(
+                max(0.0, self.peak_rss_mib - self.idle_rss_mib) / self.users
+            )
+        return summary
+
+
+async def simulate_user(
+    base_url: str,
+    username: str,
+    password: str,
+    conversation: List[str],
+    think_time: float,
+    stats: LevelStats,
+    timeout: float,
+) -> None:
+    """Log in one user and replay a conversation, recording latencies into stats."""
+    client = StreamlitClient(base_url, timeout)
+
+    async def timed_rerun(samples: List[float]) -> ScriptRun:
+        started = time.perf_counter()
+        run = await client.rerun()
+        samples.append((time.perf_counter() - started) * 1000)
+        return run
+
+    try:
+        await client.connect()
+        started = time.perf_counter()
+        run = await client.rerun()
+        username_input = run.widget("text_input", "Username")
+        password_input = run.widget("text_input", "Password")
+        login_button = run.widget("button", "Login")
+        if username_input and password_input and login_button:
+            run = await client.rerun(
+                [
+                    string_state(username_input.id, username),
+                    string_state(password_input.id, password),
+                    trigger_state(login_button.id),
+                ]
+            )
+        stats.login_ms.append((time.perf_counter() - started) * 1000)
+        for prompt in conversation:
+            chat_input = run.widget("chat_input")
+            if chat_input is None:
+                raise RuntimeError("chat input not found (login failed?)")
+            await asyncio.sleep(random.uniform(0, 2 * think_time))
+            started = time.perf_counter()
+            run = await client.rerun([chat_state(chat_input.id, prompt)], prompt)
+            finished = time.perf_counter()
+            stats.turn_ms.append((finished - started) * 1000)
+            if run.first_output_at is not None:
+                stats.ttft_ms.append((run.first_output_at - started) * 1000)
+            stats.turns += 1
+            if run.exceptions:
+                stats.errors.append(f"{username}: {run.exceptions[0]}")
+            run = await timed_rerun(stats.rerun_ms)
+    except Exception as e:
+        stats.errors.append(f"{username}: {type(e).__name__}: {e}")
+    finally:
+        client.close()
+
+
+def process_rss_mib(pid: int) -> Optional[float]:
+    """Return the resident set size of a process in MiB (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+async def run_level(
+    base_url: str,
+    users: int,
+    conversations: List[List[str]],
+    password: str,
+    think_time: float,
+    timeout: float,
+    server_pid: Optional[int],
+) -> LevelStats:
+    """Run one load level with ``users`` concurrent users."""
+    stats = LevelStats(users)
+    if server_pid:
+        stats.idle_rss_mib = process_rss_mib(server_pid)
+    done = asyncio.Event()
+
+    async def sample_memory():
+        while not done.is_set():
+            rss = process_rss_mib(server_pid)
+            if rss is not None:
+                stats.peak_rss_mib = max(stats.peak_rss_mib or 0.0, rss)
+            await asyncio.sleep(0.2)
+
+    sampler = asyncio.ensure_future(sample_memory()) if server_pid else None
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_user(
+                base_url,
+                f"user{i}",
+                password,
+                conversations[i % len(conversations)],
+                think_time,
+                stats,
+                timeout,
+            )
+            for i in range(users)
+        )
+    )
+    stats.elapsed_s = time.perf_counter() - started
+    done.set()
+    if sampler:
+        await sampler
+    return stats
+
+
+def saturation_reasons(summary: Dict[str, Any], slo: Dict[str, float]) -> List[str]:
+    """Return the SLOs a level breaks."""
+    reasons = []
+    if summary["errors"]:
+        reasons.append(f"{summary['errors']} errors")
+    for metric in ("rerun_ms_p95", "ttft_ms_p95"):
+        value = summary.get(metric)
+        if value is not None and value > slo[metric]:
+            reasons.append(f"{metric} {value} > {slo[metric]}")
+    rss = summary.get("rss_mib")
+    if rss is not None and rss > slo["rss_mib"]:
+        reasons.append(f"rss_mib {rss} > {slo['rss_mib']}")
+    return reasons
+
+
+def load_conversations(path: Optional[str]) -> List[List[str]]:
+    """Load scripted conversations (lists of prompts) or replay exported sessions.
+
+    The file holds a JSON list; each item is either a list of prompts or a
+    session document whose user messages are replayed.
+    """
+    if not path:
+        return [DEFAULT_CONVERSATION]
+    with open(path) as f:
+        items = json.load(f)
+    conversations = []
+    for item in items:
+        if isinstance(item, dict):
+            prompts = []
+            for msg in item.get("messages", []):
+                if msg["role"] != "user":
+                    continue
+                content = msg["content"]
+                if isinstance(content, list):
+                    content = "\n".join(
+                        part.get("text", "")
+                        for part in content
+                        if part.get("type") == "text"
+                    )
+                prompts.append(content)
+        else:
+            prompts = list(item)
+        if prompts:
+            conversations.append(prompts)
+    if not conversations:
+        raise ValueError(f"No conversations found in {path}")
+    return conversations
+
+
+def write_config(path: str, users: int, model_base_url: str) -> None:
+    """Write an app config with one login per simulated user and the stub model."""
+    # Plaintext passwords would be hashed again on every script run
+    password_hash = stauth.Hasher.hash(PASSWORD)
+    config = {
+        "credentials": {
+            "usernames": {
+                f"user{i}": {
+                    "email": f"user{i}@example.com",
+                    "name": f"user{i}",
+                    "password": password_hash,
+                }
+                for i in range(users)
+            }
+        },
+        "cookie": {"name": "ai_bots_loadtest", "key": "loadtest", "expiry_days": 1},
+        "models": [
+            {
+                "id": 1,
+                "name": "stub",
+                "api_key": "stub",
+                "base_url": model_base_url,
+                "model": "stub",
+            }
+        ],
+        "bots": [
+            {
+                "id": 1,
+                "name": "Load test",
+                "description": "",
+                "prompt": "You are a helpful assistant.",
+            }
+        ],
+    }
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+
+
+def start_server(
+    port: int,
+    config_file: str,
+    web_base_url: str,
+    mongo_uri: Optional[str],
+    cpu: Optional[str],
+    log_file,
+) -> subprocess.Popen:
+    env = {**os.environ, "CONFIG_FILE": config_file}
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.serve_app",
+        f"--port={port}",
+        f"--web-base-url={web_base_url}",
+    ]
+    if mongo_uri:
+        env["MONGO_URI"] = mongo_uri
+    else:
+        command.append("--mongomock")
+    server = subprocess.Popen(
+        command,
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+    )
+    if cpu is not None:
+        os.sched_setaffinity(server.pid, {int(c) for c in cpu.split(",")})
+    return server
+
+
+async def wait_until_healthy(base_url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            response = await AsyncHTTPClient().fetch(f"{base_url}/_stcore/health")
+            if response.body.strip() == b"ok":
+                return
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+        await asyncio.sleep(0.5)
+
+
+async def run_load_test(args) -> List[Dict[str, Any]]:
+    levels = [int(n) for n in args.users.split(",")]
+    conversations = load_conversations(args.conversations)
+    slo = {
+        "rerun_ms_p95": args.slo_rerun_ms,
+        "ttft_ms_p95": args.slo_ttft_ms,
+        "rss_mib": args.memory_limit_mib,
+    }
+    summaries = []
+    with StubWebServer(latency=args.web_latency) as web, StubLLMServer(
+        web_base_url=web.base_url,
+        chunk_rate=args.chunk_rate,
+        answer_chunks=args.answer_chunks,
+        tool_rounds=args.tool_rounds,
+        first_token_delay=args.first_token_delay,
+    ) as llm, tempfile.TemporaryDirectory() as workdir:
+        server = None
+        base_url = args.url
+        server_pid = args.server_pid
+        password = args.password
+        log_path = os.path.join(workdir, "server.log")
+        with open(log_path, "w") as log_file:
+            try:
+                if not base_url:
+                    config_file = os.path.join(workdir, "config.yml")
+                    write_config(config_file, max(levels), f"{llm.base_url}/v1")
+                    server = start_server(
+                        args.port,
+                        config_file,
+                        web.base_url,
+                        args.mongo_uri,
+                        args.cpu,
+                        log_file,
+                    )
+                    base_url, server_pid = f"http://127.0.0.1:{args.port}", server.pid
+                await wait_until_healthy(base_url)
+
+                # Warm up imports and caches so the first level is not penalized
+                await run_level(
+                    base_url, 1, conversations, password, 0, args.timeout, None
+                )
+
+                for users in levels:
+                    stats = await run_level(
+                        base_url,
+                        users,
+                        conversations,
+                        password,
+                        args.think_time,
+                        args.timeout,
+                        server_pid,
+                    )
+                    summary = stats.summary()
+                    summary["saturated_by"] = saturation_reasons(summary, slo)
+                    summaries.append(summary)
+                    logger.info(json.dumps(summary, ensure_ascii=False))
+                    for error in stats.errors[:5]:
+                        logger.warning(f"users={users}: {error}")
+                    if summary["saturated_by"] and not args.keep_going:
+                        break
+            finally:
+                if server is not None:
+                    server.terminate()
+                    server.wait(timeout=30)
+        if server is not None and any(s["errors"] for s in summaries):
+            with open(log_path) as f:
+                logger.warning("Server log tail:\n" + "".join(f.readlines()[-40:]))
+    return summaries
+
+
+def print_report(summaries: List[Dict[str, Any]]) -> None:
+    columns = [
+        "users",
+        "turns",
+        "errors",
+        "turns_per_s",
+        "login_ms_p95",
+        "rerun_ms_p50",
+        "rerun_ms_p95",
+        "rerun_ms_p99",
+        "ttft_ms_p50",
+        "ttft_ms_p95",
+        "turn_ms_p95",
+        "rss_mib",
+        "mib_per_user",
+    ]
+    print(" ".join(f"{c:>12}" for c in columns))
+    for summary in summaries:
+        print(" ".join(f"{str(summary.get(c)):>12}" for c in columns))
+    saturated = next((s for s in summaries if s["saturated_by"]), None)
+    if saturated is None:
+        print(f"Not saturated up to {summaries[-1]['users']} users.")
+    else:
+        print(
+            f"Saturation point: {saturated['users']} users "
+            f"({'; '.join(saturated['saturated_by'])})."
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--users", default="1,2,4,8,16", help="comma-separated concurrent user levels"
+    )
+    parser.add_argument(
+        "--conversations", help="JSON file of prompt lists or exported sessions"
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=1.0, help="mean seconds between turns"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=180.0, help="seconds allowed per script run"
+    )
+    parser.add_argument(
+        "--url", help="load an app that is already running instead of starting one"
+    )
+    parser.add_argument(
+        "--server-pid", type=int, help="pid of the --url app, for memory sampling"
+    )
+    parser.add_argument(
+        "--password", default=PASSWORD, help="password of the user0..userN logins"
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--mongo-uri", help="MongoDB to use instead of the in-memory stand-in"
+    )
+    parser.add_argument("--cpu", help="CPU list the started app is pinned to, e.g. 0")
+    parser.add_argument(
+        "--chunk-rate", type=float, default=50.0, help="stub model chunks per second"
+    )
+    parser.add_argument("--answer-chunks", type=int, default=200)
+    parser.add_argument("--tool-rounds", type=int, default=1)
+    parser.add_argument(
+        "--first-token-delay",
+        type=float,
+        default=0.3,
+        help="stub model seconds before the first chunk",
+    )
+    parser.add_argument(
+        "--web-latency",
+        type=float,
+        default=0.1,
+        help="stub web server seconds per request",
+    )
+    parser.add_argument("--slo-rerun-ms", type=float, default=1000.0)
+    parser.add_argument("--slo-ttft-ms", type=float, default=3000.0)
+    parser.add_argument("--memory-limit-mib", type=float, default=1024.0)
+    parser.add_argument(
+        "--keep-going", action="store_true", help="run every level after saturation"
+    )
+    parser.add_argument("--json", help="also write the level summaries to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    summaries = asyncio.run(run_load_test(args))
+    print_report(summaries)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summaries, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
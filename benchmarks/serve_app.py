@@ -0,0 +1,67 @@
+"""Run app.py under ``streamlit run`` for load tests.
+
+The web tools are routed to a ``StubWebServer`` and, with ``--mongomock``,
+MongoDB is replaced by an in-memory mongomock client, so the app runs with
+no external services besides the stub model server named in the config::
+
+    python -m benchmarks.serve_app --port 8765 --web-base-url http://127.0.0.1:9000 --mongomock
+
+Remaining arguments are passed to ``streamlit run``.
+"""
+
+import argparse
+import os
+import sys
+
+APP_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py"
+)
+
+
+def use_mongomock() -> None:
+    """Make every MongoClient of the app an in-memory mongomock client."""
+    import mongomock
+    import mongomock.gridfs
+    import pymongo
+
+    mongomock.gridfs.enable_gridfs_integration()
+    pymongo.MongoClient = mongomock.MongoClient
+    os.environ.setdefault("MONGO_URI", "mongodb://mongomock")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8501)
+    parser.add_argument(
+        "--web-base-url", help="StubWebServer that receives the web tool requests"
+    )
+    parser.add_argument(
+        "--mongomock", action="store_true", help="use an in-memory MongoDB stand-in"
+    )
+    args, streamlit_args = parser.parse_known_args(argv)
+
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    if args.mongomock:
+        use_mongomock()
+    if args.web_base_url:
+        from benchmarks.stub_servers import routed_web_tools
+
+        # botpage is imported here first, so app.py picks up the routed module
+        routed_web_tools(args.web_base_url).__enter__()
+
+    from streamlit.web import cli
+
+    sys.argv = [
+        "streamlit",
+        "run",
+        APP_PATH,
+        f"--server.port={args.port}",
+        "--server.headless=true",
+        "--browser.gatherUsageStats=false",
+        *streamlit_args,
+    ]
+    return cli.main()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
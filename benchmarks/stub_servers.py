@@ -0,0 +1,244 @@
+"""Local stand-ins for the model provider and the web tool targets.
+
+``StubLLMServer`` speaks the streaming OpenAI chat-completions protocol.  It
+answers a turn with ``tool_rounds`` rounds of tool calls (one ``search_web``
+and then ``fetch_url`` calls against the ``StubWebServer``) and then streams
+a text reply, at ``chunk_rate``
+chunks per second.  ``StubWebServer`` serves a Bing-like result page at
+``/search`` and synthetic HTML articles at ``/page/<n>``.
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional
+
+LOREM = (
+    "Streamlit reruns the whole script on every interaction, so the cost of "
+    "each render grows with the length of the conversation. "
+)
+
+
+class _StubServer:
+    """Run a ThreadingHTTPServer on a free local port in a daemon thread."""
+
+    def __init__(self, handler):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+def _chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+    payload = {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "stub",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n"
+
+
+def completed_tool_rounds(messages: List[Dict[str, Any]]) -> int:
+    """Count the tool rounds answered since the last user message."""
+    rounds = 0
+    for msg in reversed(messages):
+        if msg["role"] == "user":
+            break
+        if msg["role"] == "assistant" and msg.get("tool_calls"):
+            rounds += 1
+    return rounds
+
+
+class StubLLMServer(_StubServer):
+    """OpenAI-compatible streaming chat-completions stub."""
+
+    def __init__(
+        self,
+        web_base_url: str = "",
+        chunk_rate: float = 0.0,
+        answer_chunks: int = 200,
+        chunk_text: str = "token ",
+        reasoning_chunks: int = 0,
+        tool_rounds: int = 1,
+        tool_calls_per_round: int = 2,
+        first_token_delay: float = 0.0,
+    ):
+        super().__init__(_LLMHandler)
+        self.web_base_url = web_base_url
+        self.chunk_rate = chunk_rate
+        self.answer_chunks = answer_chunks
+        self.chunk_text = chunk_text
+        self.reasoning_chunks = reasoning_chunks
+        self.tool_rounds = tool_rounds
+        self.tool_calls_per_round = tool_calls_per_round
+        self.first_token_delay = first_token_delay
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def chunks(self, messages: List[Dict[str, Any]], tools_enabled: bool = True):
+        """Yield the SSE chunks answering a request."""
+        yield _chunk({"role": "assistant", "content": ""})
+        if tools_enabled and completed_tool_rounds(messages) < self.tool_rounds:
+            for i in range(self.tool_calls_per_round):
+                if i == 0:
+                    name, arguments = "search_web", {"query": "stub query"}
+                else:
+                    name, arguments = "fetch_url", {
+                        "url": f"{self.web_base_url}/page/{i}"
+                    }
+                arguments = json.dumps(arguments)
+                # Stream the name first and the arguments in two pieces
+                yield _chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": i,
+                                "id": f"call_{i}",
+                                "type": "function",
+                                "function": {"name": name, "arguments": ""},
+                            }
+                        ]
+                    }
+                )
+                half = len(arguments) // 2
+                for piece in (arguments[:half], arguments[half:]):
+                    yield _chunk(
+                        {"tool_calls": [{"index": i, "function": {"arguments": piece}}]}
+                    )
+            yield _chunk({}, "tool_calls")
+            return
+        for _ in range(self.reasoning_chunks):
+            yield _chunk({"reasoning_content": self.chunk_text})
+        for _ in range(self.answer_chunks):
+            yield _chunk({"content": self.chunk_text})
+        yield _chunk({}, "stop")
+
+
+class _LLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        stub: StubLLMServer = self.server.stub
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with stub._lock:
+            stub.requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        if stub.first_token_delay:
+            time.sleep(stub.first_token_delay)
+        interval = 1.0 / stub.chunk_rate if stub.chunk_rate else 0.0
+        try:
+            for data in stub.chunks(body["messages"], bool(body.get("tools"))):
+                self.wfile.write(data)
+                self.wfile.flush()
+                if interval:
+                    time.sleep(interval)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream (stop button)
+            pass
+
+
+class StubWebServer(_StubServer):
+    """Stand-in for the Bing result page and the pages fetched by fetch_url."""
+
+    def __init__(self, page_bytes: int = 20_000, latency: float = 0.0):
+        super().__init__(_WebHandler)
+        self.page_bytes = page_bytes
+        self.latency = latency
+
+    def search_page(self, query: str) -> str:
+        items = "".join(
+            f'<li class="b_algo"><h2><a href="{self.base_url}/page/{i}">'
+            f"{query} result {i}</a></h2>"
+            f'<div class="b_caption"><p>{LOREM}</p></div></li>'
+            for i in range(10)
+        )
+        return f'<html><body><ol id="b_results">{items}</ol></body></html>'
+
+    def article(self, number: int) -> str:
+        paragraph = f"<p>{LOREM}</p>"
+        paragraphs = paragraph * max(1, self.page_bytes // len(paragraph))
+        return (
+            f"<html><head><title>Page {number}</title></head><body>"
+            f"<nav><a href='/'>Home</a></nav><article><h1>Page {number}</h1>"
+            f"{paragraphs}</article><footer>footer</footer></body></html>"
+        )
+
+
+class _WebHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        stub: StubWebServer = self.server.stub
+        parsed = urllib.parse.urlsplit(self.path)
+        if parsed.path == "/search":
+            query = urllib.parse.parse_qs(parsed.query).get("q", [""])[0]
+            body = stub.search_page(query)
+        elif parsed.path.startswith("/page/"):
+            body = stub.article(int(parsed.path.rsplit("/", 1)[1] or 0))
+        else:
+            self.send_error(404)
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@contextmanager
+def routed_web_tools(web_base_url: str):
+    """Send the Bing searches and page fetches of botpage to a StubWebServer."""
+    import botpage
+
+    original_get = botpage.http_get
+    original_safe_addresses = botpage._safe_addresses
+    stub_host = urllib.parse.urlsplit(web_base_url).hostname
+
+    def http_get(url, **kwargs):
+        if url == "https://www.bing.com/search":
+            url = f"{web_base_url}/search"
+        return original_get(url, **kwargs)
+
+    # fetch_url refuses loopback targets; the stub is the only one allowed
+    botpage.http_get = http_get
+    botpage._safe_addresses = lambda url: (
+        [stub_host] if url.startswith(web_base_url) else None
+    )
+    try:
+        yield
+    finally:
+        botpage.http_get = original_get
+        botpage._safe_addresses = original_safe_addresses
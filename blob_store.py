@@ -0,0 +1,231 @@
+"""Content-addressed blob store for uploaded images and large tool outputs.
+
+Messages keep a short reference of the form ``blob:<mime>;sha256,<hex>``
+(modelled on data URIs) instead of the payload itself.  Blobs are keyed by
+the SHA-256 of their content, so identical uploads are stored once.  The
+store is backed by GridFS when MongoDB is available and by a local
+directory otherwise; references are resolved lazily and immutable blobs are
+kept in an in-process LRU bounded to ``BLOB_CACHE_BYTES``.
+"""
+
+from collections import OrderedDict
+import base64
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from typing import Any, Optional, Tuple
+
+import gridfs
+
+logger = logging.getLogger(__name__)
+
+# Tool responses larger than this (bytes) are stored as blobs instead of inline.
+BLOB_INLINE_MAX_BYTES = int(os.environ.get("BLOB_INLINE_MAX_BYTES", "8192"))
+
+# Characters of a tool response shown before its full body is loaded on demand;
+# a response moved into the store keeps this much inline as its preview.
+TOOL_PREVIEW_CHARS = int(os.environ.get("TOOL_PREVIEW_CHARS", "500"))
+
+# Total size (bytes) of the blobs kept in memory; larger blobs are never cached.
+BLOB_CACHE_BYTES = int(os.environ.get("BLOB_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+# Directory used by the local-disk store when MongoDB is not configured.
+BLOB_DIR = os.environ.get(
+    "BLOB_DIR", os.path.join(tempfile.gettempdir(), "ai-bots-blobs")
+)
+
+_REF_PATTERN = re.compile(r"^blob:([\w.+-]+/[\w.+-]+);sha256,([0-9a-f]{64})$")
+
+
+def make_ref(mime_type: str, digest: str) -> str:
+    """Build a blob reference string."""
+    return f"blob:{mime_type};sha256,{digest}"
+
+
+def parse_ref(value: Any) -> Optional[Tuple[str, str]]:
+    """Return (mime_type, digest) if value is a blob reference, else None."""
+    if not isinstance(value, str) or not value.startswith("blob:"):
+        return None
+    match = _REF_PATTERN.match(value)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def is_ref(value: Any) -> bool:
+    """Return True if value is a blob reference."""
+    return parse_ref(value) is not None
+
+
+class LocalBlobStore:
+    """Blob store keeping one file per digest under a local directory."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def write(self, digest: str, data: bytes) -> None:
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read(self, digest: str) -> bytes:
+        with open(self._path(digest), "rb") as f:
+            return f.read()
+
+
+class GridFSBlobStore:
+    """Blob store backed by GridFS, using the digest as the file id."""
+
+    def __init__(self, db, collection: str = "blobs"):
+        self.fs = gridfs.GridFS(db, collection=collection)
+
+    def exists(self, digest: str) -> bool:
+        return self.fs.exists(digest)
+
+    def write(self, digest: str, data: bytes) -> None:
+        try:
+            self.fs.put(data, _id=digest)
+        except gridfs.errors.FileExists:
+            # Another replica stored the same content concurrently.
+            pass
+
+    def read(self, digest: str) -> bytes:
+        return self.fs.get(digest).read()
+
+
+_store = None
+_store_db_id = None
+_store_lock = threading.Lock()
+
+
+def configure(db) -> None:
+    """Select GridFS when a database is available, the local directory otherwise."""
+    global _store, _store_db_id
+    db_id = id(db) if db is not None else None
+    with _store_lock:
+        if _store is not None and _store_db_id == db_id:
+            return
+        _store = GridFSBlobStore(db) if db is not None else LocalBlobStore(BLOB_DIR)
+        _store_db_id = db_id
+
+
+def set_store(store) -> None:
+    """Replace the active store (used by tests)."""
+    global _store, _store_db_id
+    _store = store
+    _store_db_id = None
+    _BLOB_CACHE.clear()
+
+
+def get_store():
+    """Return the active store, defaulting to the local directory."""
+    if _store is None:
+        configure(None)
+    return _store
+
+
+def put_blob(data: bytes, mime_type: str) -> str:
+    """Store data (once per content hash) and return its reference."""
+    digest = hashlib.sha256(data).hexdigest()
+    store = get_store()
+    if not store.exists(digest):
+        store.write(digest, data)
+    return make_ref(mime_type, digest)
+
+
+class _BlobCache:
+    """LRU of blob contents bounded by their total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(digest)
+            if data is not None:
+                self._entries.move_to_end(digest)
+            return data
+
+    def put(self, digest: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if digest in self._entries:
+                return
+            self._entries[digest] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_BLOB_CACHE = _BlobCache(BLOB_CACHE_BYTES)
+
+
+def _read_blob(digest: str) -> bytes:
+    data = _BLOB_CACHE.get(digest)
+    if data is None:
+        data = get_store().read(digest)
+        _BLOB_CACHE.put(digest, data)
+    return data
+
+
+def get_blob(ref: str) -> bytes:
+    """Return the bytes behind a reference."""
+    parsed = parse_ref(ref)
+    if parsed is None:
+        raise ValueError(f"Not a blob reference: {ref!r}")
+    return _read_blob(parsed[1])
+
+
+def resolve_text(value: str) -> str:
+    """Return the text behind a reference, or the value itself if it is inline."""
+    if not is_ref(value):
+        return value
+    try:
+        return get_blob(value).decode("utf-8")
+    except Exception as e:
+        logger.error(f"Failed to load blob {value}: {e}")
+        return ""
+
+
+def resolve_data_uri(value: str) -> Optional[str]:
+    """Return a data URI for a reference, or the value itself if it is inline.
+
+    Returns None if the blob cannot be loaded.
+    """
+    parsed = parse_ref(value)
+    if parsed is None:
+        return value
+    try:
+        encoded = base64.b64encode(get_blob(value)).decode("utf-8")
+    except Exception as e:
+        logger.error(f"Failed to load blob {value}: {e}")
+        return None
+    return f"data:{parsed[0]};base64,{encoded}"
+
+
+def store_text_if_large(text: str) -> str:
+    """Move text larger than BLOB_INLINE_MAX_BYTES into the store and return its reference."""
+    data = text.encode("utf-8")
+    if len(data) <= BLOB_INLINE_MAX_BYTES:
+        return text
+    return put_blob(data, "text/plain")
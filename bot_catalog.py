@@ -0,0 +1,133 @@
+"""Process-wide cache of the bots, reloaded when the catalog version changes."""
+
+import copy
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Minimum interval (seconds) between two version checks; 0 checks on every rerun.
+BOT_CATALOG_CHECK_INTERVAL = float(os.environ.get("BOT_CATALOG_CHECK_INTERVAL", "1.0"))
+
+# Collection holding the version counters and the id of the bots counter.
+VERSION_COLLECTION = "versions"
+VERSION_ID = "bots"
+
+
+def fetch_bots(db) -> List[Dict[str, Any]]:
+    """Fetch all bots from MongoDB."""
+    return list(db.bots.find().sort("id", 1))
+
+
+def read_version(db) -> int:
+    """Return the current catalog version (0 before the first mutation)."""
+    doc = db[VERSION_COLLECTION].find_one({"_id": VERSION_ID}, {"version": 1})
+    return doc.get("version", 0) if doc else 0
+
+
+class BotCatalog:
+    """Bots of the ``bots`` collection, shared by all sessions of the process."""
+
+    def __init__(self, check_interval: Optional[float] = None, clock=time.monotonic):
+        self.check_interval = (
+            BOT_CATALOG_CHECK_INTERVAL if check_interval is None else check_interval
+        )
+        self._clock = clock
+        # Guards the cached state; never held during database calls
+        self._lock = threading.Lock()
+        # Held by the one thread refreshing the cache
+        self._refresh_lock = threading.Lock()
+        self._bots: Optional[List[Dict[str, Any]]] = None
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        # Bumped by invalidate, so a refresh started before it is discarded
+        self._generation = 0
+        self.loads = 0
+
+    def bots(self, db, config_bots=None) -> List[Dict[str, Any]]:
+        """Return the bots, reloading them if the catalog version changed.
+
+        One thread checks the version while the others keep serving the
+        cached bots; only a cold cache makes callers wait.  An empty
+        collection is seeded with ``config_bots``.  If the version cannot be
+        read, the cached bots are served until it can.
+        """
+        with self._lock:
+            cached = self._bots
+            due = cached is None or self._clock() - self._checked_at >= (
+                self.check_interval
+            )
+        if due and self._refresh_lock.acquire(blocking=cached is None):
+            try:
+                cached = self._refresh(db, config_bots or [])
+            finally:
+                self._refresh_lock.release()
+        return copy.deepcopy(cached)
+
+    def _refresh(self, db, config_bots: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with self._lock:
+            cached, version, generation = self._bots, self._version, self._generation
+            # Another thread may have refreshed while this one waited
+            if (
+                cached is not None
+                and self._clock() - self._checked_at < self.check_interval
+            ):
+                return cached
+        try:
+            current = read_version(db)
+            bots = cached
+            if cached is None or current != version:
+                bots, current = self._load(db, current, config_bots)
+        except Exception as e:
+            if cached is None:
+                raise
+            logger.warning(f"Failed to read the bot catalog version: {e}")
+            with self._lock:
+                # Retry after the interval rather than on every rerun
+                self._checked_at = self._clock()
+            return cached
+        with self._lock:
+            self._checked_at = self._clock()
+            if self._generation == generation:
+                if bots is not cached:
+                    self.loads += 1
+                self._bots, self._version = bots, current
+        return bots
+
+    def _load(self, db, version: int, config_bots: List[Dict[str, Any]]):
+        bots = fetch_bots(db)
+        if not bots and config_bots:
+            # Insert config bots into MongoDB if the collection is empty
+            for bot in config_bots:
+                db.bots.insert_one(dict(bot))
+            version = self.bump(db, invalidate=False)
+            bots = fetch_bots(db)
+        logger.info(f"Loaded {len(bots)} bots (catalog version {version})")
+        return bots, version
+
+    def bump(self, db, invalidate: bool = True) -> int:
+        """Record a bot mutation and return the new catalog version."""
+        doc = db[VERSION_COLLECTION].find_one_and_update(
+            {"_id": VERSION_ID},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if invalidate:
+            self.invalidate()
+        return doc["version"]
+
+    def invalidate(self) -> None:
+        """Reload the bots on the next call, whatever the version."""
+        with self._lock:
+            self._bots = None
+            self._generation += 1
+
+
+# Process-wide catalog used by the app and the bot management page.
+BOT_CATALOG = BotCatalog()
@@ -1,6 +1,10 @@
 import streamlit as st
 import time
 
+from bot_catalog import BOT_CATALOG
+from completion_cache import COMPLETION_CACHE
+from session_writer import SESSION_WRITER
+
 
 def get_next_bot_id(db):
     """Get the next available bot ID using epoch seconds."""
@@ -12,6 +16,7 @@ def add_bot(db, bot_data):
     try:
         bot_data["id"] = get_next_bot_id(db)
         result = db.bots.insert_one(bot_data)
+        BOT_CATALOG.bump(db)
         st.session_state.refresh_bots = True
         return bot_data
     except Exception as e:
@@ -23,6 +28,9 @@ def update_bot(db, bot_id, bot_data):
     """Update an existing bot in MongoDB."""
     try:
         result = db.bots.update_one({"id": bot_id}, {"$set": bot_data})
+        BOT_CATALOG.bump(db)
+        # Cached replies were generated with the old prompt and settings
+        COMPLETION_CACHE.invalidate_bot(bot_id)
         st.session_state.refresh_bots = True
     except Exception as e:
         st.error(f"更新机器人失败：{str(e)}")
@@ -32,7 +40,11 @@ def delete_bot(db, bot_id):
     """Delete a bot and its associated sessions from MongoDB."""
     try:
         db.bots.delete_one({"id": bot_id})
+        # Pending saves would upsert the deleted sessions again
+        SESSION_WRITER.flush()
         db.sessions.delete_many({"bot_id": bot_id})
+        BOT_CATALOG.bump(db)
+        COMPLETION_CACHE.invalidate_bot(bot_id)
         # TODO: Need to consider reset current session if the current bot is deleted
         st.session_state.refresh_bots = True
     except Exception as e:
@@ -50,6 +62,11 @@ def show_bot_form(db, existing_bot=None):
             value=existing_bot.get("prompt", "") if existing_bot else "",
             height=200,
         )
+        cache_responses = st.checkbox(
+            "缓存相同问题的回答",
+            value=existing_bot.get("cache_responses", False) if existing_bot else False,
+            help="适用于问答类机器人：相同的对话直接返回缓存的回答，不再调用模型。",
+        )
 
         col1, col2 = st.columns(2)
         with col1:
@@ -58,7 +75,11 @@ def show_bot_form(db, existing_bot=None):
             cancel = st.form_submit_button("取消")
 
         if submit and bot_name and bot_prompt:
-            bot_data = {"name": bot_name, "prompt": bot_prompt}
+            bot_data = {
+                "name": bot_name,
+                "prompt": bot_prompt,
+                "cache_responses": cache_responses,
+            }
 
             if existing_bot:
                 update_bot(db, existing_bot["id"], bot_data)
@@ -120,6 +141,14 @@ def bot_management_page(db):
                 col1, col2, col3 = st.columns([3, 1, 1])
                 with col1:
                     st.write(f"**{bot['name']}**")
+                    if bot.get("cache_responses"):
+                        stats = COMPLETION_CACHE.stats().get(str(bot["id"]))
+                        if stats:
+                            st.caption(
+                                f"回答缓存：命中率 {stats['hit_rate']:.0%}"
+                                f"（{stats['hits']}/{stats['hits'] + stats['misses']}），"
+                                f"已缓存 {stats['size']} 条"
+                            )
                 with col2:
                     if st.button("编辑", key=f"edit_{bot['id']}"):
                         st.session_state.edit_bot_id = bot["id"]
@@ -1,35 +1,74 @@
 # Import necessary libraries
-from bs4 import BeautifulSoup
-from openai import OpenAI
-from datetime import datetime
+from openai import AsyncOpenAI
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import base64
-import ipaddress
+import contextvars
+import functools
+import hashlib
 import json
 import logging
 import os
 import re
-import socket
+import threading
+import time
 import urllib.parse
 
-import requests
-import markdownify
 from st_copy_to_clipboard import st_copy_to_clipboard
 import streamlit as st
 from typing import Optional, List, Dict, Any, Tuple
 
+import blob_store
+import dns_resolver
+import extraction
+import generation_worker
+from completion_cache import COMPLETION_CACHE
+import telemetry
+from chat_engine import STREAM_TICK_SECONDS, run_chat_turn
+from context_budget import assemble_context, estimate_message_tokens
+from http_client import http_get
+from session_store import session_summary
+from session_writer import SESSION_WRITER
+from tool_cache import ToolResultCache, normalize_key
+
 # Maximum number of tool-call rounds per user turn to prevent runaway loops.
 MAX_TOOL_ROUNDS = 1000
 
+# Maximum number of tool calls executed in parallel within one round.
+# Set TOOL_CALL_WORKERS=1 in the environment to run tool calls sequentially.
+TOOL_CALL_WORKERS = max(1, int(os.environ.get("TOOL_CALL_WORKERS", "4")))
+
+# Minimum interval (seconds) between two renders of a streaming response, unless
+# at least STREAM_RENDER_MIN_CHARS characters are waiting to be rendered.
+STREAM_RENDER_INTERVAL = float(os.environ.get("STREAM_RENDER_INTERVAL", "0.1"))
+STREAM_RENDER_MIN_CHARS = int(os.environ.get("STREAM_RENDER_MIN_CHARS", "512"))
+
+# Number of most recent messages rendered on each rerun; older messages are paged
+# in CHAT_HISTORY_WINDOW at a time on demand.
+CHAT_HISTORY_WINDOW = int(os.environ.get("CHAT_HISTORY_WINDOW", "40"))
+
+# Maximum number of prepared message renders kept in memory; 0 disables the cache.
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "1024"))
+
 # Maximum tool response content size (bytes) stored in session / sent to the API.
 MAX_TOOL_RESPONSE_BYTES = 50_000
 
+# Maximum number of URLs fetched by one fetch_urls call.
+FETCH_URLS_MAX = 10
+
+# Maximum number of (decompressed) bytes of a page downloaded by fetch_url.
+FETCH_MAX_BYTES = int(os.environ.get("FETCH_MAX_BYTES", "1000000"))
+
+# Content types fetch_url parses; a response without a Content-Type is parsed too.
+FETCH_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
 # Define tools as a constant
 TOOLS = [
     {
         "type": "function",
         "function": {
             "name": "search_web",
-            "description": "Search the web using Bing and return a list of relevant results with titles, URLs, and snippets. Use this to find up-to-date information, then call fetch_url on the result URLs to get full content.",
+            "description": "Search the web using Bing and return a list of relevant results with titles, URLs, and snippets. Use this to find up-to-date information, then call fetch_urls with the relevant result URLs to get their full content in one step.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -63,6 +102,26 @@ TOOLS = [
             "strict": True,
         },
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "fetch_urls",
+            "description": f"Fetch and extract main content from several URLs at once (up to {FETCH_URLS_MAX}), e.g. the results of search_web. The pages are fetched concurrently and returned as one section per URL; URLs that could not be fetched get an error message.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "urls": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "The URLs to fetch content from",
+                    }
+                },
+                "required": ["urls"],
+                "additionalProperties": False,
+            },
+            "strict": True,
+        },
+    },
 ]
 
 # Set up logging — set LOG_LEVEL=DEBUG in the environment to enable debug output.
@@ -71,6 +130,13 @@ _log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=getattr(logging, _log_level, logging.INFO))
 logger = logging.getLogger(__name__)
 
+# Process-wide cache of search_web / fetch_url results, shared by all sessions.
+TOOL_CACHE = ToolResultCache()
+TOOL_CACHE.register_gauges()
+
+# Matches inline SVG images in message content.
+SVG_PATTERN = re.compile(r"<svg[^>]*>.*?</svg>", re.DOTALL)
+
 # --- Utility Functions ---
 
 
@@ -83,93 +149,58 @@ def quote_content(content: str) -> str:
     return "\n".join(modified_lines)
 
 
-def save_session_to_db(db, session):
-    """Save the session to MongoDB using an upsert operation."""
+def save_session_to_db(db, session, dirty_from: Optional[int] = None):
+    """Queue an upsert of the session to MongoDB.
+
+    The save is written in the background by ``session_writer``, coalesced
+    with other pending saves of the session.  Sessions that track
+    ``message_count`` are persisted incrementally: only messages past the
+    persisted (and unchanged) prefix are sent, and a shrunk history is
+    trimmed in place.  ``dirty_from`` marks the index of the first message
+    that was modified in place (e.g. by an edit).  Sessions loaded without a
+    ``message_count`` fall back to rewriting the whole array once.
+    """
     if not session["messages"] or db is None:
         return
-    db.sessions.update_one(
-        {"id": session["id"]},
-        {
-            "$set": {
-                "user": session["user"],
-                "name": session["name"],
-                "updated_at": datetime.now(),
-                "bot_id": session["bot_id"],
-                "messages": session["messages"],
-            },
-            "$setOnInsert": {
-                "create_time": datetime.now(),
-            },
-        },
-        upsert=True,
-    )
+    SESSION_WRITER.enqueue(db, session, dirty_from)
+    session["message_count"] = len(session["messages"])
 
 
-@st.cache_resource
-def initialize_openai_client(api_key: str, base_url: str) -> OpenAI:
-    """Initialize the OpenAI client."""
-    try:
-        return OpenAI(api_key=api_key, base_url=base_url, max_retries=2)
-    except Exception as e:
-        logger.error(f"Failed to initialize OpenAI client: {e}")
-        st.error("OpenAI 客户端初始化失败，请检查 API 密钥和接口地址。")
-        st.stop()
-
-
-def _is_safe_url(url: str) -> bool:
-    """Return True only if the URL uses http/https and does not target a private/internal host."""
+def _safe_addresses(url: str) -> Optional[List[str]]:
+    """Resolve the host of an http/https URL and return its addresses if all of them are public."""
     try:
         parsed = urllib.parse.urlparse(url)
         if parsed.scheme not in ("http", "https"):
-            return False
+            return None
         hostname = parsed.hostname
         if not hostname:
-            return False
-        resolved_ip = socket.gethostbyname(hostname)
-        ip = ipaddress.ip_address(resolved_ip)
-        if (
-            ip.is_private
-            or ip.is_loopback
-            or ip.is_link_local
-            or ip.is_reserved
-            or ip.is_multicast
-        ):
-            return False
-        return True
+            return None
+        addresses = dns_resolver.RESOLVER.resolve(hostname)
+        if not all(dns_resolver.is_public_address(a) for a in addresses):
+            return None
+        return addresses
     except Exception:
-        return False
+        return None
+
+
+def _is_safe_url(url: str) -> bool:
+    """Return True only if the URL uses http/https and does not target a private/internal host."""
+    return _safe_addresses(url) is not None
 
 
 def search_web(query: str) -> Optional[List[Dict]]:
     """Search the web by scraping Bing search results."""
     try:
-        response = requests.get(
+        response = http_get(
             "https://www.bing.com/search",
             params={"q": query},
             headers={
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36"
             },
-            timeout=15,
         )
         logger.debug(f"Bing search HTTP {response.status_code} for query: {query!r}")
         response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
-        items = soup.select("#b_results li.b_algo")
-        logger.debug(f"Bing search: found {len(items)} raw result elements")
-        results = []
-        for li in items[:5]:
-            a_tag = li.select_one("h2 a")
-            snippet_tag = li.select_one(".b_caption p")
-            if a_tag:
-                url = a_tag.get("href", "")
-                if url.startswith(("http://", "https://")):
-                    results.append(
-                        {
-                            "title": a_tag.get_text(),
-                            "url": url,
-                            "snippet": snippet_tag.get_text() if snippet_tag else "",
-                        }
-                    )
+        results = extraction.parse_search_results(response.content)
         logger.debug(f"Bing search: parsed {len(results)} results for query: {query!r}")
         return results if results else None
     except Exception as e:
@@ -177,50 +208,212 @@ def search_web(query: str) -> Optional[List[Dict]]:
         return None
 
 
+class FetchRejected(Exception):
+    """Raised by fetch_url for pages it refuses to parse; the message is shown to the model."""
+
+
+def _read_capped(response, max_bytes: int) -> Tuple[bytes, bool]:
+    """Read a streamed response body up to max_bytes and return (body, truncated)."""
+    chunks: List[bytes] = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            break
+    body = b"".join(chunks)
+    return body[:max_bytes], size > max_bytes
+
+
+def _trim_partial_utf8(data: bytes) -> bytes:
+    """Drop an incomplete UTF-8 sequence left at the end of a truncated body."""
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0xC0 != 0x80:
+            # Lead byte: keep the sequence only if all its bytes are present
+            length = 2 if byte >= 0xC0 else 1
+            length = 3 if byte >= 0xE0 else length
+            length = 4 if byte >= 0xF0 else length
+            return data if length <= i else data[:-i]
+    return data
+
+
+def _header_charset(content_type: str) -> Optional[str]:
+    """Return the charset declared in a Content-Type header, if any."""
+    match = re.search(r"charset=[\"']?([\w.:-]+)", content_type, re.IGNORECASE)
+    return match.group(1) if match else None
+
+
 def fetch_url(url: str) -> Optional[str]:
-    """Fetch and extract main content from a URL."""
-    if not _is_safe_url(url):
+    """Fetch and extract main content from a URL.
+
+    The body is streamed and at most FETCH_MAX_BYTES are downloaded; a
+    truncated page is parsed as far as it was read and flagged in the
+    returned text.  The main content is extracted by ``extraction``.
+    Raises FetchRejected for non-HTML content types.
+    """
+    addresses = _safe_addresses(url)
+    if addresses is None:
         logger.warning(f"Blocked fetch to unsafe URL: {url}")
         return None
     try:
-        response = requests.get(url, timeout=15, allow_redirects=False)
-        if response.is_redirect:
-            location = response.headers.get("Location", "")
-            logger.warning(f"Blocked redirect from {url} to {location!r}")
-            return None
-        response.raise_for_status()
-        soup = BeautifulSoup(
-            response.content, "html.parser", from_encoding=response.encoding
-        )
-        body = soup.find("body")
-        return markdownify.markdownify(str(body) if body else "", heading_style="ATX")
+        # Connect to the addresses that passed the check, not a new lookup
+        with dns_resolver.pinned(urllib.parse.urlparse(url).hostname, addresses):
+            response = http_get(url, allow_redirects=False, stream=True)
+        try:
+            if response.is_redirect:
+                location = response.headers.get("Location", "")
+                logger.warning(f"Blocked redirect from {url} to {location!r}")
+                return None
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "")
+            media_type = content_type.split(";")[0].strip().lower()
+            if media_type and media_type not in FETCH_CONTENT_TYPES:
+                raise FetchRejected(
+                    f"Unsupported content type {media_type!r} at URL: {url}"
+                )
+            data, truncated = _read_capped(response, FETCH_MAX_BYTES)
+        finally:
+            # Release the connection without downloading the rest of the body
+            response.close()
+        charset = _header_charset(content_type)
+        if truncated:
+            logger.warning(
+                f"Truncated {url} after {FETCH_MAX_BYTES} bytes before parsing"
+            )
+            if (charset or "utf-8").lower().replace("_", "-") in ("utf-8", "utf8"):
+                data = _trim_partial_utf8(data)
+        content = extraction.html_to_markdown(data, charset, url)
+        if truncated and content:
+            content += (
+                f"\n\n[Truncated: the page is larger than {FETCH_MAX_BYTES} bytes; "
+                "only its beginning was read.]"
+            )
+        return content
+    except FetchRejected:
+        raise
     except Exception as e:
         logger.error(f"Failed to fetch URL {url}: {e}")
         return None
 
 
+_BUDGET_NOTE = "\n\n[Truncated to fit the shared response budget.]"
+
+
+def _share_budget(sizes: List[int], budget: int) -> List[int]:
+    """Split a budget over texts: texts under an even share are kept whole and
+    the remainder is shared evenly by the longer ones."""
+    allowed = [0] * len(sizes)
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    remaining = max(0, budget)
+    while pending:
+        share = remaining // len(pending)
+        if sizes[pending[0]] > share:
+            for i in pending:
+                allowed[i] = share
+            break
+        i = pending.pop(0)
+        allowed[i] = sizes[i]
+        remaining -= sizes[i]
+    return allowed
+
+
+def fetch_urls(urls: List[str]) -> Tuple[str, bool]:
+    """Fetch several URLs concurrently and return (sections, any_succeeded).
+
+    Every URL goes through fetch_url, with its SSRF rules and the tool
+    cache, on up to TOOL_CALL_WORKERS threads.  The sections of all pages
+    share MAX_TOOL_RESPONSE_BYTES, so that a long page cannot crowd out the
+    others.
+    """
+    unique = list(dict.fromkeys(urls))
+    selected = unique[:FETCH_URLS_MAX]
+
+    def _fetch(url: str) -> Tuple[bool, str]:
+        result = handle_function_call("fetch_url", {"url": url})
+        if "content" in result:
+            return True, result["content"]
+        return False, f"Error: {result.get('error', '无效的函数响应')}"
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(selected), TOOL_CALL_WORKERS)),
+        thread_name_prefix="fetch_urls",
+    ) as pool:
+        # Copy the context per URL so telemetry tags follow the fetches
+        futures = [
+            pool.submit(contextvars.copy_context().run, _fetch, url) for url in selected
+        ]
+        results = [future.result() for future in futures]
+
+    headers = [f"## [{i + 1}] {url}\n\n" for i, url in enumerate(selected)]
+    footer = ""
+    if len(unique) > len(selected):
+        footer = (
+            f"\n\n[Skipped {len(unique) - len(selected)} URLs beyond the limit "
+            f"of {FETCH_URLS_MAX}.]"
+        )
+    overhead = sum(len(h) for h in headers) + 2 * len(selected) + len(footer)
+    texts = [text for _, text in results]
+    allowed = _share_budget(
+        [len(t) for t in texts],
+        MAX_TOOL_RESPONSE_BYTES - overhead - len(_BUDGET_NOTE) * len(texts),
+    )
+    sections = []
+    for header, text, limit in zip(headers, texts, allowed):
+        if len(text) > limit:
+            text = text[:limit] + _BUDGET_NOTE
+        sections.append(header + text)
+    return "\n\n".join(sections) + footer, any(ok for ok, _ in results)
+
+
+def _dispatch_function_call(function_name: str, arguments: dict) -> dict:
+    """Run the tool implementation behind a function call."""
+    if function_name == "search_web":
+        query = arguments.get("query")
+        if not query:
+            return {"error": "Query parameter missing"}
+        results = search_web(query)
+        if results is not None:
+            return {"content": json.dumps(results, ensure_ascii=False)}
+        else:
+            return {"error": f"Failed to search for: {query}"}
+    if function_name == "fetch_url":
+        url = arguments.get("url")
+        if not url:
+            return {"error": "URL parameter missing"}
+        try:
+            content = fetch_url(url)
+        except FetchRejected as e:
+            return {"error": str(e)}
+        if content:
+            return {"content": content}
+        else:
+            return {"error": f"Failed to fetch content from URL: {url}"}
+    if function_name == "fetch_urls":
+        urls = arguments.get("urls")
+        if not urls or not isinstance(urls, list):
+            return {"error": "URLs parameter missing"}
+        urls = [url for url in urls if isinstance(url, str) and url]
+        if not urls:
+            return {"error": "No valid URLs given"}
+        content, any_succeeded = fetch_urls(urls)
+        return {"content": content} if any_succeeded else {"error": content}
+    return {"error": f"Unknown function: {function_name}"}
+
+
 def handle_function_call(function_name: str, arguments: dict) -> dict:
-    """Handle function calls from the AI client."""
+    """Handle function calls from the AI client, serving repeated calls from the tool cache."""
     try:
-        if function_name == "search_web":
-            query = arguments.get("query")
-            if not query:
-                return {"error": "Query parameter missing"}
-            results = search_web(query)
-            if results is not None:
-                return {"content": json.dumps(results, ensure_ascii=False)}
-            else:
-                return {"error": f"Failed to search for: {query}"}
-        if function_name == "fetch_url":
-            url = arguments.get("url")
-            if not url:
-                return {"error": "URL parameter missing"}
-            content = fetch_url(url)
-            if content:
-                return {"content": content}
-            else:
-                return {"error": f"Failed to fetch content from URL: {url}"}
-        return {"error": f"Unknown function: {function_name}"}
+        cache_key = normalize_key(function_name, arguments)
+        if cache_key is not None:
+            cached = TOOL_CACHE.get(function_name, cache_key)
+            if cached is not None:
+                logger.debug(f"Tool cache hit for {function_name}: {cache_key!r}")
+                return {"content": cached}
+        result = _dispatch_function_call(function_name, arguments)
+        if cache_key is not None and "content" in result:
+            TOOL_CACHE.put(function_name, cache_key, result["content"])
+        return result
     except Exception as e:
         logger.error(f"Error in function call {function_name}: {e}")
         return {"error": f"Function call failed: {e}"}
@@ -257,20 +450,139 @@ def display_truncation_message():
     )
 
 
-def display_message_content(msg: Dict[str, Any]):
-    """Display the content of a message."""
+def prepare_message_render(msg: Dict[str, Any]) -> Tuple[str, Tuple[str, ...]]:
+    """Build the markdown and SVG data URIs displayed for a non-tool message."""
+    reasoning = quote_content(msg.get("reasoning_content", ""))
+    text_content = _get_text_content(msg["content"])
+    message_content = (reasoning + "\n\n" if reasoning else "") + text_content
+
+    if "tool_calls" in msg and msg["tool_calls"]:
+        message_content += "\n\n**Tool Calls:**\n"
+        for tool_call in msg["tool_calls"]:
+            message_content += f"- **{tool_call['function']['name']}**: {tool_call['function']['arguments']}\n"
+
+    # Convert each SVG to a base64 data URI for display in st.image
+    svg_data_uris = tuple(
+        "data:image/svg+xml;base64,"
+        + base64.b64encode(svg.encode("utf-8")).decode("utf-8")
+        for svg in SVG_PATTERN.findall(message_content)
+    )
+    return message_content, svg_data_uris
+
+
+class MessageRenderCache:
+    """Bounded LRU of prepared message renders keyed by a hash of the message content.
+
+    Messages are immutable once written, so a render prepared for one rerun
+    (or one user) can be reused for any message with the same content.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(msg: Dict[str, Any]) -> str:
+        payload = json.dumps(
+            [
+                msg.get("content"),
+                msg.get("reasoning_content", ""),
+                msg.get("tool_calls"),
+            ],
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def prepare(self, msg: Dict[str, Any]) -> Tuple[str, Tuple[str, ...]]:
+        """Return the prepared render of msg, computing it on a miss."""
+        if self.max_entries <= 0:
+            return prepare_message_render(msg)
+        key = self.key(msg)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        rendered = prepare_message_render(msg)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = rendered
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters, hit rate and current size."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Process-wide cache of prepared message renders, shared by all sessions.
+RENDER_CACHE = MessageRenderCache(RENDER_CACHE_SIZE)
+
+
+def tool_response_preview(
+    msg: Dict[str, Any], limit: Optional[int] = None
+) -> Optional[str]:
+    """Return the short preview of a tool response, or None if it is fully shown inline.
+
+    A response moved into the blob store shows the preview saved next to its
+    reference.
+    """
+    limit = blob_store.TOOL_PREVIEW_CHARS if limit is None else limit
+    content = msg["content"]
+    if blob_store.is_ref(content):
+        return msg.get("preview", "")
+    if len(content) <= limit:
+        return None
+    return content[:limit]
+
+
+def _tool_response_loaded(msg: Dict[str, Any], idx: int) -> bool:
+    """Return True if the full body of a tool message should be rendered."""
+    loaded = st.session_state.get("loaded_tool_responses", set())
+    return tool_response_preview(msg) is None or idx in loaded
+
+
+def display_tool_response(msg: Dict[str, Any], idx: int):
+    """Display a tool response, loading its full body only on demand."""
+    with st.expander("点击展开/收起工具调用响应", expanded=False):
+        if _tool_response_loaded(msg, idx):
+            st.text(blob_store.resolve_text(msg["content"]))
+            return
+        preview = tool_response_preview(msg)
+        if preview:
+            st.text(preview + " …")
+        if st.button("加载完整响应", key=f"load_tool_{idx}"):
+            loaded = st.session_state.get("loaded_tool_responses", set())
+            loaded.add(idx)
+            st.session_state.loaded_tool_responses = loaded
+            st.rerun()
+
+
+def display_message_content(msg: Dict[str, Any], idx: Optional[int] = None):
+    """Display the content of a message; ``idx`` is its index in the session."""
     if msg["role"] == "tool":
-        with st.expander("点击展开/收起工具调用响应", expanded=False):
-            st.text(msg["content"])
+        display_tool_response(msg, idx)
     else:
-        reasoning = quote_content(msg.get("reasoning_content", ""))
-        text_content = _get_text_content(msg["content"])
-        message_content = (reasoning + "\n\n" if reasoning else "") + text_content
-
-        if "tool_calls" in msg and msg["tool_calls"]:
-            message_content += "\n\n**Tool Calls:**\n"
-            for tool_call in msg["tool_calls"]:
-                message_content += f"- **{tool_call['function']['name']}**: {tool_call['function']['arguments']}\n"
+        message_content, svg_data_uris = RENDER_CACHE.prepare(msg)
 
         st.markdown(message_content)
 
@@ -278,18 +590,20 @@ def display_message_content(msg: Dict[str, Any]):
         if isinstance(msg["content"], list):
             for part in msg["content"]:
                 if part.get("type") == "image_url":
-                    st.image(part["image_url"]["url"])
-
-        # Extract SVG content using regular expressions
-        svg_pattern = re.compile(r"<svg[^>]*>.*?</svg>", re.DOTALL)
-        svg_matches = svg_pattern.findall(message_content)
+                    url = part["image_url"]["url"]
+                    if not blob_store.is_ref(url):
+                        st.image(url)
+                        continue
+                    try:
+                        image = blob_store.get_blob(url)
+                    except Exception as e:
+                        logger.error(f"Failed to load blob {url}: {e}")
+                        st.warning("图片加载失败")
+                        continue
+                    st.image(image)
 
         # Display each SVG image
-        for i, svg in enumerate(svg_matches):
-            # Convert SVG to base64 for display in st.image
-            svg_bytes = svg.encode("utf-8")
-            b64 = base64.b64encode(svg_bytes).decode("utf-8")
-            svg_data_uri = f"data:image/svg+xml;base64,{b64}"
+        for svg_data_uri in svg_data_uris:
             st.image(svg_data_uri, use_container_width=True)
 
 
@@ -306,15 +620,20 @@ def display_message_actions(
     # Build the list of buttons from the right end (rightmost = last in list)
     buttons = []
 
-    # Copy button — always at the far right end
-    buttons.append("copy")
+    # Copy button — always at the far right end; tool responses can only be
+    # copied once their full body is loaded
+    if msg["role"] != "tool" or _tool_response_loaded(msg, idx):
+        if msg["role"] == "tool":
+            text_content = blob_store.resolve_text(text_content)
+        buttons.append("copy")
 
     # Truncate/remove button — to the left of copy, only for the last message
     if is_last_message and not st.session_state.get("generating_response", False):
         buttons.append("truncate")
 
-    # Edit button — to the left of truncate, only for user messages
-    if msg["role"] == "user":
+    # Edit button — to the left of truncate, only for user messages; an edit
+    # made while a reply is generating would be lost when the reply is adopted
+    if msg["role"] == "user" and not st.session_state.get("generating_response", False):
         buttons.append("edit")
 
     # Retry button — to the left of edit, only for the last assistant message
@@ -387,7 +706,7 @@ def display_edit_form(msg: Dict[str, Any], idx: int, session: Dict[str, Any], db
             st.session_state.generating_response = False
 
             # Save the updated session to the database
-            save_session_to_db(db, session)
+            save_session_to_db(db, session, dirty_from=idx)
 
             # Trigger regeneration of the assistant's response
             st.session_state.retry_last_message = True
@@ -400,9 +719,32 @@ def display_edit_form(msg: Dict[str, Any], idx: int, session: Dict[str, Any], db
             st.rerun()
 
 
+def history_window_start(total: int, window: int) -> int:
+    """Return the index of the first message inside the rendered window."""
+    return max(0, total - window)
+
+
 def display_chat_messages(session: Dict[str, Any], db):
-    """Display all chat messages."""
-    for idx, msg in enumerate(session["messages"]):
+    """Display the most recent chat messages, paging in older ones on demand."""
+    # Reset the window when switching to another session
+    if st.session_state.get("history_window_session_id") != session["id"]:
+        st.session_state.history_window_session_id = session["id"]
+        st.session_state.history_window = CHAT_HISTORY_WINDOW
+
+    start = history_window_start(
+        len(session["messages"]), st.session_state.history_window
+    )
+    if start > 0:
+        if st.button(
+            f"加载更早的消息（还有 {start} 条）",
+            key="load_older_messages",
+            use_container_width=True,
+        ):
+            st.session_state.history_window += CHAT_HISTORY_WINDOW
+            st.rerun()
+
+    for idx in range(start, len(session["messages"])):
+        msg = session["messages"][idx]
         if msg["role"] == "truncation":
             display_truncation_message()
             continue
@@ -411,7 +753,7 @@ def display_chat_messages(session: Dict[str, Any], db):
             msg["role"] == "user" and st.session_state.get("edit_message_idx") == idx
         ):
             with st.chat_message(msg["role"]):
-                display_message_content(msg)
+                display_message_content(msg, idx)
 
             display_message_actions(
                 msg,
@@ -423,88 +765,117 @@ def display_chat_messages(session: Dict[str, Any], db):
         else:
             display_edit_form(msg, idx, session, db)
 
+    logger.debug("Message render cache: %s", RENDER_CACHE.stats())
 
-# --- Stream Handling Functions ---
-
-
-def write_stream(stream) -> Tuple[str, str, List[Dict]]:
-    """
-    Handle the streaming of chat responses including tool calls.
-    Returns the response, reasoning response, and function call data if any.
-    """
-    response = ""
-    reasoning_response = ""
-    container = None
-    final_tool_calls = {}
 
-    for chunk in stream:
-        message = ""
-        reasoning_message = ""
+# --- Stream Handling Functions ---
 
-        if len(chunk.choices) == 0 or chunk.choices[0].delta is None:
-            continue
 
-        delta = chunk.choices[0].delta
-
-        # Handle tool calls
-        if hasattr(delta, "tool_calls") and delta.tool_calls:
-            for tool_call in delta.tool_calls:
-                index = tool_call.index
-
-                if index not in final_tool_calls:
-                    final_tool_calls[index] = {
-                        "id": tool_call.id,
-                        "type": "function",
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments,
-                        },
-                    }
-                else:
-                    if tool_call.function.arguments:
-                        final_tool_calls[index]["function"][
-                            "arguments"
-                        ] += tool_call.function.arguments
-
-        # Handle normal content
-        if hasattr(delta, "reasoning_content") and delta.reasoning_content:
-            reasoning_message += delta.reasoning_content
-        elif delta.content:
-            message += delta.content
-
-        # Continue if there is no content and reasoning content
-        if not message and not reasoning_message and not final_tool_calls:
-            continue
+class StreamRenderer:
+    """Coalesce streamed deltas into rate-limited ``container.markdown()`` calls.
 
-        first_text = False
-        if not container:
-            container = st.empty()
-            first_text = True
+    While streaming, the container is re-rendered at most once per
+    ``interval`` seconds unless ``min_chars`` characters are pending.  The
+    quoted reasoning is maintained line by line so each render only joins
+    what is already formatted.  ``finish`` renders the exact final markdown.
+    """
 
-        response += message
-        reasoning_response += reasoning_message
+    def __init__(
+        self,
+        interval: Optional[float] = None,
+        min_chars: Optional[int] = None,
+        clock=time.monotonic,
+        parent=None,
+    ):
+        self.parent = parent
+        self.interval = STREAM_RENDER_INTERVAL if interval is None else interval
+        self.min_chars = STREAM_RENDER_MIN_CHARS if min_chars is None else min_chars
+        self.container = None
+        self.render_count = 0
+        self._clock = clock
+        self._last_render = 0.0
+        self._pending = 0
+        self._response_parts: List[str] = []
+        self._reasoning_parts: List[str] = []
+        self._quoted_lines: List[str] = []
+        self._reasoning_tail = ""
+
+    @staticmethod
+    def _joined(parts: List[str]) -> str:
+        # Compact the buffer so repeated renders do not re-join every delta
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0] if parts else ""
+
+    @property
+    def response(self) -> str:
+        return self._joined(self._response_parts)
+
+    @property
+    def reasoning(self) -> str:
+        return self._joined(self._reasoning_parts)
+
+    def feed(self, content: str = "", reasoning: str = "", other: int = 0) -> None:
+        """Buffer a delta; ``other`` counts non-text progress such as tool-call arguments."""
+        if reasoning:
+            self._reasoning_parts.append(reasoning)
+            self._quote_incrementally(reasoning)
+        if content:
+            self._response_parts.append(content)
+        self._pending += len(content) + len(reasoning) + other
+
+    def _quote_incrementally(self, delta: str) -> None:
+        lines = (self._reasoning_tail + delta).splitlines(keepends=True)
+        self._reasoning_tail = ""
+        # Keep the last line pending until its line break arrives; a trailing
+        # "\r" is kept too because the next delta may turn it into "\r\n".
+        if lines and (
+            lines[-1].splitlines()[0] == lines[-1] or lines[-1].endswith("\r")
+        ):
+            self._reasoning_tail = lines.pop()
+        self._quoted_lines.extend("> " + line.splitlines()[0] for line in lines)
+
+    def _quoted_reasoning(self) -> str:
+        tail = self._reasoning_tail.splitlines()
+        return "\n".join(self._quoted_lines + ["> " + line for line in tail])
+
+    def _render(self, content: str) -> None:
+        self.container.markdown(content)
+        self.render_count += 1
+        self._last_render = self._clock()
+        self._pending = 0
+
+    def update(self, tool_calls: Dict) -> None:
+        """Render the progress so far if the first chunk arrived or a flush is due."""
+        first_text = self.container is None
+        if first_text:
+            self.container = (self.parent or st).empty()
+        elif (
+            self._clock() - self._last_render < self.interval
+            and self._pending < self.min_chars
+        ):
+            return
 
-        if final_tool_calls:
-            tool_calls_content = render_tool_calls(final_tool_calls)
-            container.markdown(tool_calls_content)
+        if tool_calls:
+            self._render(render_tool_calls(tool_calls))
         else:
-            # Only add the streaming symbol on the second text chunk
-            content_to_display = quote_content(reasoning_response)
+            # Only add the streaming symbol after the first text chunk
+            content_to_display = self._quoted_reasoning()
+            response = self.response
             if response:
                 content_to_display += "\n\n" + response
             if not first_text:
                 content_to_display += " | "
-            container.markdown(content_to_display)
+            self._render(content_to_display)
 
-    # Flush the stream
-    if container:
-        if final_tool_calls:
-            tool_calls_content = render_tool_calls(final_tool_calls)
-            container.markdown(tool_calls_content)
+    def finish(self, tool_calls: Dict) -> None:
+        """Render the exact final content."""
+        if not self.container:
+            return
+        if tool_calls:
+            self._render(render_tool_calls(tool_calls))
         else:
-            container.markdown(quote_content(reasoning_response) + "\n\n" + response)
-
-    return response, reasoning_response, list(final_tool_calls.values())
+            self._render(quote_content(self.reasoning) + "\n\n" + self.response)
 
 
 def render_tool_calls(tool_calls: Dict) -> str:
@@ -515,53 +886,156 @@ def render_tool_calls(tool_calls: Dict) -> str:
     return tool_calls_content
 
 
+def _resolve_blob_refs(role: str, content):
+    """Replace blob references in message content with the inline payload for the API."""
+    if role == "tool" and isinstance(content, str):
+        return blob_store.resolve_text(content)
+    if isinstance(content, list) and any(
+        part.get("type") == "image_url" and blob_store.is_ref(part["image_url"]["url"])
+        for part in content
+    ):
+        resolved = []
+        for part in content:
+            if part.get("type") == "image_url" and blob_store.is_ref(
+                part["image_url"]["url"]
+            ):
+                url = blob_store.resolve_data_uri(part["image_url"]["url"])
+                if url is None:
+                    # Sending an empty image_url would fail the whole request
+                    continue
+                part = {**part, "image_url": {**part["image_url"], "url": url}}
+            resolved.append(part)
+        return resolved
+    return content
+
+
+def _to_api_message(msg: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the API fields of a session message (blob references unresolved)."""
+    message_to_add = {"role": msg["role"], "content": msg["content"]}
+
+    if "tool_calls" in msg:
+        message_to_add["tool_calls"] = msg["tool_calls"]
+
+    if "tool_call_id" in msg:
+        message_to_add["tool_call_id"] = msg["tool_call_id"]
+
+    return message_to_add
+
+
+def _wrap_user_input(content):
+    """Wrap the text of a user message that follows a truncation marker."""
+    if isinstance(content, list):
+        # Copy the list (and each part dict) to avoid mutating session state
+        content = [dict(part) for part in content]
+        for part in content:
+            if part.get("type") == "text":
+                part["text"] = f"<user_input>{part['text']}</user_input>"
+                return content
+        content.insert(0, {"type": "text", "text": "<user_input></user_input>"})
+        return content
+    return f"<user_input>{content}</user_input>"
+
+
+def _finalize_api_messages(
+    items: List[Dict[str, Any]], found_truncation: bool
+) -> List[Dict[str, Any]]:
+    """Resolve blob references and wrap the first user message after a truncation.
+
+    Items are copied only when they change, so cached items are never mutated.
+    """
+    messages_to_send = []
+    wrap_pending = found_truncation
+    for item in items:
+        content = _resolve_blob_refs(item["role"], item["content"])
+        if wrap_pending and item["role"] == "user":
+            content = _wrap_user_input(content)
+            wrap_pending = False
+        if content is not item["content"]:
+            item = {**item, "content": content}
+        messages_to_send.append(item)
+    return messages_to_send
+
+
 def prepare_messages_for_api(session: Dict[str, Any]) -> List[Dict[str, Any]]:
     """Prepare messages for the API call, handling truncation properly."""
-    messages_to_send = []
-    found_truncation = False
+    messages = session["messages"]
 
-    # Scan messages from newest to oldest
-    for msg in reversed(session["messages"]):
-        if msg["role"] == "truncation":
-            found_truncation = True
+    # Only messages after the last truncation marker are sent
+    start = 0
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i]["role"] == "truncation":
+            start = i + 1
             break
-        message_to_add = {"role": msg["role"], "content": msg["content"]}
 
-        if "tool_calls" in msg:
-            message_to_add["tool_calls"] = msg["tool_calls"]
+    return _finalize_api_messages(
+        [_to_api_message(msg) for msg in messages[start:]], found_truncation=start > 0
+    )
 
-        if "tool_call_id" in msg:
-            message_to_add["tool_call_id"] = msg["tool_call_id"]
 
-        messages_to_send.insert(0, message_to_add)
+class PreparedHistory:
+    """Per-session API history maintained incrementally across turns.
 
-    # If truncation was found, modify the first user message
-    if found_truncation and messages_to_send:
-        first_user_idx = next(
-            (i for i, msg in enumerate(messages_to_send) if msg["role"] == "user"), None
-        )
-        if first_user_idx is not None:
-            content = messages_to_send[first_user_idx]["content"]
-            if isinstance(content, list):
-                # Copy the list (and each part dict) to avoid mutating session state
-                content = [dict(part) for part in content]
-                messages_to_send[first_user_idx]["content"] = content
-                wrapped = False
-                for part in content:
-                    if part.get("type") == "text":
-                        part["text"] = f"<user_input>{part['text']}</user_input>"
-                        wrapped = True
-                        break
-                if not wrapped:
-                    content.insert(
-                        0, {"type": "text", "text": "<user_input></user_input>"}
-                    )
+    ``sync`` compares the session messages against the ones it has already
+    converted (by identity, which catches appends, pops, slices and in-place
+    content edits) and only converts the changed tail.  Its result equals
+    ``prepare_messages_for_api`` for the same session.
+    """
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self._sources: List[Tuple[Dict[str, Any], Any]] = []
+        self._base = 0
+        self._items: List[Dict[str, Any]] = []
+
+    def _first_changed(self, messages: List[Dict[str, Any]]) -> int:
+        for i, (msg, content) in enumerate(self._sources):
+            if i >= len(messages) or messages[i] is not msg:
+                return i
+            if msg["content"] is not content:
+                return i
+        return len(self._sources)
+
+    def sync(
+        self, messages: List[Dict[str, Any]], dirty_from: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Bring the prepared history up to date and return the API messages."""
+        start = self._first_changed(messages)
+        if dirty_from is not None:
+            start = min(start, dirty_from)
+
+        if start < self._base:
+            # The truncation marker the items start after has changed:
+            # rebuild from the previous marker
+            self._base = 0
+            for i in range(start - 1, -1, -1):
+                if messages[i]["role"] == "truncation":
+                    self._base = i + 1
+                    break
+            self._items = []
+            start = self._base
+        else:
+            del self._items[start - self._base :]
+        del self._sources[start:]
+
+        for i in range(start, len(messages)):
+            msg = messages[i]
+            self._sources.append((msg, msg["content"]))
+            if msg["role"] == "truncation":
+                self._base = i + 1
+                self._items = []
             else:
-                messages_to_send[first_user_idx][
-                    "content"
-                ] = f"<user_input>{content}</user_input>"
+                self._items.append(_to_api_message(msg))
+
+        return _finalize_api_messages(self._items, found_truncation=self._base > 0)
 
-    return messages_to_send
+
+def get_prepared_history(session: Dict[str, Any]) -> PreparedHistory:
+    """Return the prepared history of the session, replacing it when the session changes."""
+    history = st.session_state.get("prepared_history")
+    if not isinstance(history, PreparedHistory) or history.session_id != session["id"]:
+        history = PreparedHistory(session["id"])
+        st.session_state.prepared_history = history
+    return history
 
 
 def _inject_system_prompt(
@@ -594,12 +1068,25 @@ def _inject_system_prompt(
 # --- Main Chat Handling Functions ---
 
 
+def _start_turn(session: Dict[str, Any], prompt, retry_mode: bool, db):
+    """Name a new session, list it in the sidebar and save it before the reply is generated."""
+    # Set the session name if it is not already set
+    if not session["name"] and not retry_mode:
+        session["name"] = str(prompt[:50])
+        # Without a database the sidebar list is the only copy of the session
+        st.session_state.bot_sessions.append(
+            session if db is None else session_summary(session)
+        )
+
+    save_session_to_db(db, session)
+
+
 def handle_user_input(
     session: Dict[str, Any],
-    client,
-    model: str,
+    model_config: Dict[str, Any],
     system_prompt_list: List[Dict[str, str]],
     db,
+    bot: Optional[Dict[str, Any]] = None,
 ):
     """Handle user input and generate assistant response."""
     # Check if we need to retry the last message
@@ -628,11 +1115,10 @@ def handle_user_input(
             if uploaded_files:
                 content: Any = [{"type": "text", "text": prompt}]
                 for f in uploaded_files:
-                    encoded = base64.b64encode(f.read()).decode("utf-8")
                     content.append(
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:{f.type};base64,{encoded}"},
+                            "image_url": {"url": blob_store.put_blob(f.read(), f.type)},
                         }
                     )
             else:
@@ -647,135 +1133,251 @@ def handle_user_input(
             with st.chat_message("user"):
                 display_message_content(session["messages"][-1])
 
-        try:
-            # Set flag to indicate response is being generated
-            st.session_state.generating_response = True
+        _start_turn(session, prompt, retry_mode, db)
 
-            # Build messages with system prompt injection once, before the loop
-            messages_to_send = _inject_system_prompt(
-                prepare_messages_for_api(session), system_prompt_list
+        try:
+            # Build the history once; the system prompt is injected per round
+            # after the history is fitted into the model's token budget
+            messages_to_send = get_prepared_history(session).sync(session["messages"])
+
+            # Delegate tool-call loop to the generation worker pool
+            job = process_tool_calls(
+                messages_to_send,
+                model_config["api_key"],
+                model_config["base_url"],
+                model_config["model"],
+                model_config.get("support_tools", True),
+                session,
+                system_prompt_list=system_prompt_list,
+                token_budget=model_config.get("context_token_budget"),
+                db=db,
+                cache=(
+                    COMPLETION_CACHE.for_bot(bot["id"])
+                    if bot and bot.get("cache_responses")
+                    else None
+                ),
             )
-
-            supports_tools = st.session_state.current_model.get("support_tools", True)
-
-            # Delegate tool-call loop to the extracted function
-            process_tool_calls(messages_to_send, client, model, supports_tools, session)
-
-            # Reset the generating response flag
-            st.session_state.generating_response = False
-
         except Exception as e:
-            # Reset the generating response flag in case of error
-            st.session_state.generating_response = False
             logger.error(f"创建聊天回复失败: {e}", exc_info=True)
             st.error("创建聊天回复失败，请检查模型和消息内容。")
             st.stop()
 
-        # Set the session name if it is not already set
-        if not session["name"] and not retry_mode:
-            session["name"] = str(prompt[:50])
-            st.session_state.bot_sessions.append(session)
+        st.session_state.generating_response = True
+        attach_generation(session, job)
+
+
+def execute_tool_call(tool_call: Dict[str, Any]) -> Tuple[str, int]:
+    """Execute a single tool call and return its (truncated) response content and latency in ms."""
+    started = time.perf_counter()
+    try:
+        arguments = (
+            json.loads(tool_call["function"]["arguments"])
+            if tool_call["function"]["arguments"]
+            else {}
+        )
+    except json.JSONDecodeError as e:
+        logger.error(f"工具参数格式错误: {e}")
+        arguments = {}
+    function_response = handle_function_call(tool_call["function"]["name"], arguments)
+    tool_response_content = function_response.get(
+        "content",
+        function_response.get("error", "无效的函数响应"),
+    )
+    if len(tool_response_content) > MAX_TOOL_RESPONSE_BYTES:
+        logger.warning(
+            "工具 %s 的响应已从 %d 字节截断至 %d 字节。",
+            tool_call["function"]["name"],
+            len(tool_response_content),
+            MAX_TOOL_RESPONSE_BYTES,
+        )
+        tool_response_content = tool_response_content[:MAX_TOOL_RESPONSE_BYTES]
+    duration_ms = int((time.perf_counter() - started) * 1000)
+    logger.info("工具 %s 调用耗时 %d ms。", tool_call["function"]["name"], duration_ms)
+    telemetry.record(
+        "tool",
+        duration_ms,
+        "error" if "error" in function_response else "ok",
+        tags={"tool": tool_call["function"]["name"]},
+        response_bytes=len(tool_response_content),
+    )
+    return tool_response_content, duration_ms
+
+
+def build_request_messages(
+    messages: List[Dict[str, Any]],
+    system_prompt_list: List[Dict[str, str]],
+    token_budget: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Fit the history into the token budget, then inject the system prompt.
+
+    Returns the messages for one API request and the estimated number of
+    tokens saved by trimming.
+    """
+    saved = 0
+    if token_budget:
+        system_tokens = sum(estimate_message_tokens(m) for m in system_prompt_list)
+        messages, saved = assemble_context(
+            messages, max(token_budget - system_tokens, 1)
+        )
+    return _inject_system_prompt(messages, system_prompt_list), saved
+
+
+# Async OpenAI clients of the calling worker thread, keyed by (api_key, base_url).
+_thread_clients = threading.local()
+
 
-        save_session_to_db(db, session)
-        st.rerun()  # Refresh the UI
+def get_async_openai_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    """Return the async OpenAI client of the calling worker thread.
+
+    A client is bound to the event loop it first ran on, so it is cached per
+    generation worker thread, whose loop lives as long as the thread; turns
+    on the same thread reuse its connections to the provider.
+    """
+    clients = getattr(_thread_clients, "clients", None)
+    if clients is None:
+        clients = _thread_clients.clients = {}
+    key = (api_key, base_url)
+    if key not in clients:
+        clients[key] = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=2)
+    return clients[key]
 
 
 def process_tool_calls(
     messages_to_send: List[Dict[str, Any]],
-    client: OpenAI,
+    api_key: str,
+    base_url: str,
     model: str,
     supports_tools: bool,
     session: Dict[str, Any],
-) -> None:
-    """Run the tool-call loop: stream response, handle tool calls, repeat up to MAX_TOOL_ROUNDS times."""
-    tool_rounds = 0
-    while True:
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages_to_send,
-            tools=TOOLS if supports_tools else None,
-            stream=True,
-            timeout=300,
+    system_prompt_list: Optional[List[Dict[str, str]]] = None,
+    token_budget: Optional[int] = None,
+    db=None,
+    cache=None,
+) -> generation_worker.GenerationJob:
+    """Start the tool-call loop of a turn on the generation worker pool and return its job.
+
+    Each round streams the response from the model at ``base_url`` and runs
+    its tool calls, up to MAX_TOOL_ROUNDS times.  ``messages_to_send`` is the prepared history;
+    each round sends it fitted into ``token_budget`` with the system prompt
+    injected.  The job checkpoints the session to ``db`` while it runs, so
+    the turn survives reruns and disconnects of the page that started it.
+    Completions are replayed from ``cache`` (see ``completion_cache``) when
+    the bot opted in to response caching.
+    """
+
+    async def _turn(job: generation_worker.GenerationJob) -> bool:
+        def _build_request(history):
+            with telemetry.span("context_build") as span:
+                request_messages, job.saved_tokens = build_request_messages(
+                    history, system_prompt_list or [], token_budget
+                )
+                span.fields["saved_tokens"] = job.saved_tokens
+            return request_messages
+
+        return await run_chat_turn(
+            get_async_openai_client(api_key, base_url),
+            model,
+            messages_to_send,
+            TOOLS if supports_tools else None,
+            _build_request,
+            execute_tool_call,
+            job,
+            max_rounds=MAX_TOOL_ROUNDS,
+            max_workers=TOOL_CALL_WORKERS,
+            cache=cache,
         )
 
-        with st.chat_message("assistant"):
-            response, reasoning_response, tool_calls = write_stream(stream)
+    persist = None if db is None else functools.partial(save_session_to_db, db)
+    return generation_worker.submit(
+        session, _turn, persist, tags={"model": model, "bot": session["bot_id"]}
+    )
 
-        assistant_msg: Dict[str, Any] = {
-            "role": "assistant",
-            "content": response,
-        }
-        if tool_calls:
-            assistant_msg["tool_calls"] = tool_calls
-        messages_to_send.append(assistant_msg)
-
-        session["messages"].append(
-            {
-                "role": "assistant",
-                "content": response,
-                "reasoning_content": reasoning_response,
-                **({"tool_calls": tool_calls} if tool_calls else {}),
-            }
-        )
 
-        if not tool_calls:
-            break
+def _display_live_message(msg: Dict[str, Any]):
+    """Display a message of a running turn; it has no widgets, so it can be redrawn."""
+    with st.chat_message(msg["role"]):
+        if msg["role"] == "tool":
+            with st.expander("点击展开/收起工具调用响应", expanded=False):
+                preview = tool_response_preview(msg)
+                st.text(msg["content"] if preview is None else preview + " …")
+        else:
+            display_message_content(msg)
 
-        tool_rounds += 1
-        if tool_rounds >= MAX_TOOL_ROUNDS:
-            logger.warning("工具调用次数已达上限 %d，停止。", MAX_TOOL_ROUNDS)
-            st.warning(f"工具调用次数已达上限 ({MAX_TOOL_ROUNDS})，响应可能不完整。")
-            break
 
-        for tool_call in tool_calls:
-            if "function" in tool_call and tool_call["function"]:
-                try:
-                    arguments = (
-                        json.loads(tool_call["function"]["arguments"])
-                        if tool_call["function"]["arguments"]
-                        else {}
-                    )
-                except json.JSONDecodeError as e:
-                    logger.error(f"工具参数格式错误: {e}")
-                    arguments = {}
-                function_response = handle_function_call(
-                    tool_call["function"]["name"], arguments
-                )
-                tool_response_content = function_response.get(
-                    "content",
-                    function_response.get("error", "无效的函数响应"),
+def attach_generation(session: Dict[str, Any], job: generation_worker.GenerationJob):
+    """Follow a background turn until it finishes, then adopt its messages.
+
+    A rerun only interrupts this rendering loop, not the turn; the next
+    script run attaches again and redraws the progress buffered in the job.
+    """
+    if st.button("⏹️ 停止生成", key="stop_generation"):
+        job.stop()
+
+    caption = st.empty()
+    slots: List[Any] = []
+    partial_slot = None
+    # The reply being streamed is quoted incrementally from the new deltas
+    renderer: Optional[StreamRenderer] = None
+    stream, reasoning_at, content_at = None, 0, 0
+    version = None
+    while True:
+        rendered_at = time.monotonic()
+        # Accessing the session state lets Streamlit act on a pending rerun
+        # or stop even while the job has nothing new to show
+        st.session_state.get("generating_response")
+        snapshot = job.snapshot(stream, reasoning_at, content_at)
+        if snapshot["version"] != version:
+            version = snapshot["version"]
+            if snapshot["saved_tokens"]:
+                caption.caption(
+                    f"已省略约 {snapshot['saved_tokens']} tokens 的早期上下文。"
                 )
-                if len(tool_response_content) > MAX_TOOL_RESPONSE_BYTES:
-                    logger.warning(
-                        "工具 %s 的响应已从 %d 字节截断至 %d 字节。",
-                        tool_call["function"]["name"],
-                        len(tool_response_content),
-                        MAX_TOOL_RESPONSE_BYTES,
+            for msg in snapshot["messages"][len(slots) :]:
+                # A finished reply takes the place of its streaming preview
+                slot = partial_slot or st.empty()
+                partial_slot, renderer = None, None
+                with slot.container():
+                    _display_live_message(msg)
+                slots.append(slot)
+            if snapshot["stream"] != stream:
+                stream, reasoning_at, content_at = snapshot["stream"], 0, 0
+                renderer = None
+            reasoning_at += len(snapshot["reasoning"])
+            content_at += len(snapshot["content"])
+            if renderer is None and (
+                snapshot["reasoning"] or snapshot["content"] or snapshot["tool_calls"]
+            ):
+                partial_slot = partial_slot or st.empty()
+                with partial_slot.container():
+                    renderer = StreamRenderer(
+                        interval=0, min_chars=0, parent=st.chat_message("assistant")
                     )
-                    tool_response_content = tool_response_content[
-                        :MAX_TOOL_RESPONSE_BYTES
-                    ]
-                session["messages"].append(
-                    {
-                        "role": "tool",
-                        "tool_call_id": tool_call["id"],
-                        "content": tool_response_content,
-                        "reasoning_content": "",
-                    }
-                )
-                messages_to_send.append(
-                    {
-                        "role": "tool",
-                        "tool_call_id": tool_call["id"],
-                        "content": tool_response_content,
-                    }
-                )
-                with st.chat_message("tool"):
-                    with st.expander(
-                        "点击展开/收起工具调用响应",
-                        expanded=False,
-                    ):
-                        st.text(tool_response_content)
+            if renderer is not None:
+                for delta in snapshot["reasoning"]:
+                    renderer.feed(reasoning=delta)
+                for delta in snapshot["content"]:
+                    renderer.feed(content=delta)
+                renderer.update(snapshot["tool_calls"])
+        if snapshot["status"] != generation_worker.RUNNING:
+            break
+        job.wait(version, timeout=STREAM_TICK_SECONDS)
+        # Coalesce bursts of deltas into at most one redraw per interval
+        remaining = STREAM_RENDER_INTERVAL - (time.monotonic() - rendered_at)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    session["messages"] = job.session["messages"]
+    if "message_count" in job.session:
+        session["message_count"] = job.session["message_count"]
+    generation_worker.release(job)
+    st.session_state.generating_response = False
+
+    if snapshot["notice"]:
+        st.warning(snapshot["notice"])
+    if snapshot["status"] == generation_worker.FAILED:
+        st.error("创建聊天回复失败，请检查模型和消息内容。")
+        st.stop()
+    st.rerun()  # Refresh the UI
 
 
 def botpage(db):
@@ -837,12 +1439,19 @@ def botpage(db):
         [system_prompt] if system_prompt["content"].strip() != "" else []
     )
 
-    # Initialize the OpenAI client
-    client = initialize_openai_client(model["api_key"], model["base_url"])
+    # Share cached tool results with the other replicas through MongoDB
+    TOOL_CACHE.bind_collection(db.tool_cache if db is not None else None)
+
+    # Store uploaded images and large tool outputs in GridFS (or on local disk)
+    blob_store.configure(db)
 
-    # Initialize the session state for generating_response if not already set
-    if "generating_response" not in st.session_state:
-        st.session_state.generating_response = False
+    # A turn of this session may still be generating in the background, e.g.
+    # after a rerun or when the page was reopened
+    job = generation_worker.get_job(session["id"])
+    st.session_state.generating_response = job is not None
+    if job is not None and len(session["messages"]) > job.start:
+        # A session loaded mid-turn holds checkpoints the job will redraw
+        session["messages"] = session["messages"][: job.start]
 
     # Initialize the retry flag if not already set
     if "retry_last_message" not in st.session_state:
@@ -851,5 +1460,8 @@ def botpage(db):
     # Display the chat messages
     display_chat_messages(session, db)
 
-    # Handle user input
-    handle_user_input(session, client, model["model"], system_prompt_list, db)
+    if job is not None:
+        attach_generation(session, job)
+    else:
+        # Handle user input
+        handle_user_input(session, model, system_prompt_list, db, bot)
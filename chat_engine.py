@@ -0,0 +1,326 @@
+"""Asyncio engine for one chat turn: streaming rounds and tool execution.
+
+The engine does not depend on Streamlit.  Progress is reported through a
+``TurnCallbacks`` object, so the same engine drives the in-page renderer
+and background workers.  A stream is closed as soon as it ends, is
+stopped through ``TurnCallbacks.should_stop`` or is interrupted by an
+exception raised from a callback, so a cancelled generation stops
+consuming provider tokens right away.
+
+Every round is tagged with its number for ``telemetry``; a stream records
+its time to first token and output rate.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import telemetry
+from context_budget import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+# Interval (seconds) at which on_tick is called while waiting for the next chunk.
+STREAM_TICK_SECONDS = float(os.environ.get("STREAM_TICK_SECONDS", "0.25"))
+
+# Timeout (seconds) of one streaming completion request.
+COMPLETION_TIMEOUT = 300
+
+_END = object()
+
+
+class TurnCallbacks:
+    """Hooks called by the engine; the default implementation ignores every event."""
+
+    def on_round_start(self, round_index: int) -> None:
+        pass
+
+    def on_delta(
+        self, content: str, reasoning: str, tool_progress: int, tool_calls: Dict
+    ) -> None:
+        pass
+
+    def on_tick(self, tool_calls: Dict) -> None:
+        pass
+
+    def on_assistant_message(self, message: Dict[str, Any], tool_calls: Dict) -> None:
+        pass
+
+    def on_tool_message(self, message: Dict[str, Any], duration_ms: int) -> None:
+        pass
+
+    def on_max_rounds(self, max_rounds: int) -> None:
+        pass
+
+    def should_stop(self) -> bool:
+        return False
+
+
+def merge_tool_call_delta(final_tool_calls: Dict[int, Dict], tool_call) -> int:
+    """Merge a streamed tool-call delta and return the length of its argument text."""
+    index = tool_call.index
+    if index not in final_tool_calls:
+        final_tool_calls[index] = {
+            "id": tool_call.id,
+            "type": "function",
+            "function": {
+                "name": tool_call.function.name,
+                "arguments": tool_call.function.arguments,
+            },
+        }
+    elif tool_call.function.arguments:
+        final_tool_calls[index]["function"]["arguments"] += tool_call.function.arguments
+    return len(tool_call.function.arguments or "")
+
+
+async def _next_chunk(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+async def stream_completion(
+    client, request: Dict[str, Any], callbacks: TurnCallbacks
+) -> Tuple[str, str, Dict[int, Dict], bool]:
+    """Stream one completion.
+
+    Returns the content, reasoning, tool calls (by index) and whether the
+    stream was stopped before it finished.
+    """
+    with telemetry.span("completion") as span:
+        result = await _stream_completion(client, request, callbacks, span)
+        if result[3]:
+            span.outcome = "stopped"
+        return result
+
+
+async def _stream_completion(
+    client, request: Dict[str, Any], callbacks: TurnCallbacks, span: telemetry.Span
+) -> Tuple[str, str, Dict[int, Dict], bool]:
+    response_parts: List[str] = []
+    reasoning_parts: List[str] = []
+    final_tool_calls: Dict[int, Dict] = {}
+    stopped = False
+    usage = None
+
+    started = time.perf_counter()
+    first_token_at: Optional[float] = None
+    stream = await client.chat.completions.create(**request, stream=True)
+    iterator = stream.__aiter__()
+    pending = None
+    try:
+        while True:
+            if callbacks.should_stop():
+                stopped = True
+                break
+            if pending is None:
+                pending = asyncio.ensure_future(_next_chunk(iterator))
+            done, _ = await asyncio.wait({pending}, timeout=STREAM_TICK_SECONDS)
+            if not done:
+                callbacks.on_tick(final_tool_calls)
+                continue
+            chunk, pending = pending.result(), None
+            if chunk is _END:
+                break
+
+            # Only sent by providers that report usage on streams
+            usage = getattr(chunk, "usage", None) or usage
+            if len(chunk.choices) == 0 or chunk.choices[0].delta is None:
+                continue
+            delta = chunk.choices[0].delta
+
+            tool_progress = 0
+            if getattr(delta, "tool_calls", None):
+                for tool_call in delta.tool_calls:
+                    tool_progress += merge_tool_call_delta(final_tool_calls, tool_call)
+
+            content = reasoning = ""
+            if getattr(delta, "reasoning_content", None):
+                reasoning = delta.reasoning_content
+                reasoning_parts.append(reasoning)
+            elif delta.content:
+                content = delta.content
+                response_parts.append(content)
+
+            if content or reasoning or final_tool_calls:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    telemetry.record("ttft", (first_token_at - started) * 1000)
+                callbacks.on_delta(content, reasoning, tool_progress, final_tool_calls)
+    finally:
+        if pending is not None:
+            pending.cancel()
+        # Close the upstream HTTP response right away, also when interrupted
+        await stream.close()
+        _record_output_rate(
+            span, usage, response_parts, reasoning_parts, final_tool_calls
+        )
+        if first_token_at is not None:
+            span.fields["ttft_ms"] = round((first_token_at - started) * 1000, 3)
+            generating = time.perf_counter() - first_token_at
+            if generating > 0:
+                span.fields["tokens_per_s"] = round(
+                    span.fields["output_tokens"] / generating, 3
+                )
+
+    return "".join(response_parts), "".join(reasoning_parts), final_tool_calls, stopped
+
+
+def _record_output_rate(
+    span: telemetry.Span,
+    usage,
+    response_parts: List[str],
+    reasoning_parts: List[str],
+    tool_calls: Dict[int, Dict],
+) -> None:
+    """Store the output token count of a stream, estimated if the provider sent no usage."""
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if isinstance(completion_tokens, int):
+        span.fields["output_tokens"] = completion_tokens
+        return
+    text = "".join(response_parts) + "".join(reasoning_parts)
+    text += "".join(call["function"]["arguments"] or "" for call in tool_calls.values())
+    span.fields["output_tokens"] = estimate_text_tokens(text)
+    span.fields["output_tokens_estimated"] = True
+
+
+async def run_tool_calls_async(
+    tool_calls: List[Dict[str, Any]],
+    execute: Callable[[Dict[str, Any]], Tuple[str, int]],
+    max_workers: int,
+) -> List[Tuple[Dict[str, Any], str, int]]:
+    """Run one round of tool calls concurrently, at most max_workers at a time.
+
+    Blocking tool implementations run in worker threads; results keep the
+    original tool_call order.
+    """
+    calls = [tc for tc in tool_calls if "function" in tc and tc["function"]]
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def _run(tool_call):
+        async with semaphore:
+            return await asyncio.to_thread(execute, tool_call)
+
+    results = await asyncio.gather(*(_run(tc) for tc in calls))
+    return [(tc, content, ms) for tc, (content, ms) in zip(calls, results)]
+
+
+def replay_completion(
+    completion: Dict[str, Any], callbacks: TurnCallbacks
+) -> Tuple[str, str, Dict[int, Dict]]:
+    """Report a cached completion through the callbacks as if it had been streamed."""
+    content = completion.get("content", "")
+    reasoning = completion.get("reasoning", "")
+    tool_calls = completion.get("tool_calls", {})
+    if reasoning:
+        callbacks.on_delta("", reasoning, 0, {})
+    if content:
+        callbacks.on_delta(content, "", 0, {})
+    if tool_calls:
+        progress = sum(
+            len(tc["function"]["arguments"] or "") for tc in tool_calls.values()
+        )
+        callbacks.on_delta("", "", progress, tool_calls)
+    return content, reasoning, tool_calls
+
+
+async def run_chat_turn(
+    client,
+    model: str,
+    history: List[Dict[str, Any]],
+    tools: Optional[List[Dict[str, Any]]],
+    build_request: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]],
+    execute_tool_call: Callable[[Dict[str, Any]], Tuple[str, int]],
+    callbacks: TurnCallbacks,
+    max_rounds: int,
+    max_workers: int,
+    cache=None,
+) -> bool:
+    """Run the tool-call loop of one turn and return True if it was stopped.
+
+    ``history`` (the prepared API messages) is extended in place with the
+    assistant and tool messages of every round; ``build_request`` turns it
+    into the messages of the next request.  With a ``cache`` (an object with
+    ``get(request)`` and ``put(request, completion)``), a cached completion
+    of an identical request is replayed instead of calling the provider.
+    """
+    tool_rounds = 0
+    while True:
+        with telemetry.tagged(round=tool_rounds):
+            callbacks.on_round_start(tool_rounds)
+            request = {
+                "model": model,
+                "messages": build_request(history),
+                "tools": tools,
+                "timeout": COMPLETION_TIMEOUT,
+            }
+            cached = cache.get(request) if cache is not None else None
+            if cached is not None:
+                response, reasoning, tool_calls_by_index = replay_completion(
+                    cached, callbacks
+                )
+                stopped = False
+            else:
+                response, reasoning, tool_calls_by_index, stopped = (
+                    await stream_completion(client, request, callbacks)
+                )
+                if (
+                    cache is not None
+                    and not stopped
+                    and (response or tool_calls_by_index)
+                ):
+                    cache.put(
+                        request,
+                        {
+                            "content": response,
+                            "reasoning": reasoning,
+                            "tool_calls": tool_calls_by_index,
+                        },
+                    )
+            # Arguments of a stopped stream may be incomplete: never run them
+            if stopped:
+                tool_calls_by_index = {}
+            tool_calls = list(tool_calls_by_index.values())
+
+            assistant_msg: Dict[str, Any] = {"role": "assistant", "content": response}
+            if tool_calls:
+                assistant_msg["tool_calls"] = tool_calls
+            history.append(assistant_msg)
+            callbacks.on_assistant_message(
+                {**assistant_msg, "reasoning_content": reasoning}, tool_calls_by_index
+            )
+
+            if stopped or not tool_calls:
+                return stopped
+
+            tool_rounds += 1
+            if tool_rounds >= max_rounds:
+                logger.warning("工具调用次数已达上限 %d，停止。", max_rounds)
+                callbacks.on_max_rounds(max_rounds)
+                return False
+
+            for tool_call, content, duration_ms in await run_tool_calls_async(
+                tool_calls, execute_tool_call, max_workers
+            ):
+                history.append(
+                    {
+                        "role": "tool",
+                        "tool_call_id": tool_call["id"],
+                        "content": content,
+                    }
+                )
+                callbacks.on_tool_message(
+                    {
+                        "role": "tool",
+                        "tool_call_id": tool_call["id"],
+                        "content": content,
+                        "reasoning_content": "",
+                    },
+                    duration_ms,
+                )
+
+            if callbacks.should_stop():
+                return True
@@ -0,0 +1,163 @@
+"""Exact-match cache of chat completions for bots that opt in.
+
+FAQ-style bots receive many identical questions.  For a bot with
+``cache_responses`` enabled, the content, reasoning and tool calls of every
+completion are cached under a hash of the model, the tools and the request
+messages (which include the system prompt), and an identical request is
+replayed from the cache instead of calling the provider.
+
+Entries expire after ``COMPLETION_CACHE_TTL`` seconds and the least recently
+used ones are evicted beyond ``COMPLETION_CACHE_SIZE`` entries.  The cache is
+in-process; ``invalidate_bot`` drops the entries of a bot when it is edited
+or deleted.
+"""
+
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# Lifetime (seconds) of a cached completion; 0 disables the cache.
+COMPLETION_CACHE_TTL = int(os.environ.get("COMPLETION_CACHE_TTL", "3600"))
+
+# Maximum number of completions kept in memory, across all bots.
+COMPLETION_CACHE_SIZE = int(os.environ.get("COMPLETION_CACHE_SIZE", "256"))
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Hash the parts of a completion request that determine its reply."""
+    payload = json.dumps(
+        {
+            "model": request.get("model"),
+            "tools": request.get("tools"),
+            "messages": request.get("messages"),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Bounded LRU + TTL cache of completions, keyed by (bot id, request hash)."""
+
+    def __init__(
+        self,
+        ttl: Optional[int] = None,
+        max_entries: Optional[int] = None,
+        clock=time.monotonic,
+    ):
+        self.ttl = COMPLETION_CACHE_TTL if ttl is None else ttl
+        self.max_entries = COMPLETION_CACHE_SIZE if max_entries is None else max_entries
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def _count(self, bot_id, counter: str) -> None:
+        counters = self._stats.setdefault(str(bot_id), {"hits": 0, "misses": 0})
+        counters[counter] += 1
+
+    def get(self, bot_id, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Return the cached completion of a request, or None on a miss."""
+        if not self.enabled:
+            return None
+        started = time.perf_counter()
+        key = (bot_id, request_key(request))
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._count(bot_id, "misses")
+            else:
+                self._entries.move_to_end(key)
+                self._count(bot_id, "hits")
+        telemetry.record(
+            "completion_cache",
+            (time.perf_counter() - started) * 1000,
+            "miss" if entry is None else "hit",
+        )
+        return None if entry is None else copy.deepcopy(entry[1])
+
+    def put(self, bot_id, request: Dict[str, Any], completion: Dict[str, Any]) -> None:
+        """Store the completion (content, reasoning and tool calls) of a request."""
+        if not self.enabled:
+            return
+        key = (bot_id, request_key(request))
+        value = copy.deepcopy(completion)
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_bot(self, bot_id) -> int:
+        """Drop every cached completion of a bot and return how many were dropped."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == bot_id]
+            for key in keys:
+                del self._entries[key]
+        if keys:
+            logger.info(f"Dropped {len(keys)} cached completions of bot {bot_id}")
+        return len(keys)
+
+    def clear(self) -> None:
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Return the hits, misses, hit rate and current size per bot."""
+        with self._lock:
+            sizes: Dict[str, int] = {}
+            for bot_id, _ in self._entries:
+                sizes[str(bot_id)] = sizes.get(str(bot_id), 0) + 1
+            result = {}
+            for bot_id in set(self._stats) | set(sizes):
+                counters = self._stats.get(bot_id, {"hits": 0, "misses": 0})
+                lookups = counters["hits"] + counters["misses"]
+                result[bot_id] = {
+                    **counters,
+                    "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+                    "size": sizes.get(bot_id, 0),
+                }
+            return result
+
+    def for_bot(self, bot_id) -> "BotCompletionCache":
+        return BotCompletionCache(self, bot_id)
+
+
+class BotCompletionCache:
+    """The entries of one bot, as used by ``chat_engine.run_chat_turn``."""
+
+    def __init__(self, cache: CompletionCache, bot_id):
+        self.cache = cache
+        self.bot_id = bot_id
+
+    def get(self, request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self.cache.get(self.bot_id, request)
+
+    def put(self, request: Dict[str, Any], completion: Dict[str, Any]) -> None:
+        self.cache.put(self.bot_id, request, completion)
+
+
+# Process-wide cache shared by the chat page and bot management.
+COMPLETION_CACHE = CompletionCache()
@@ -0,0 +1,122 @@
+"""Token-budgeted context assembly for API requests.
+
+Token counts are estimated offline (no tokenizer download): CJK characters
+count as one token each, other text as one token per four characters, and
+each image as a fixed cost.  When a prepared message list exceeds the
+budget, stale tool outputs are elided first, then the oldest turns are
+dropped whole, so assistant tool_calls always stay paired with their tool
+responses.
+"""
+
+import json
+import logging
+import re
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Estimated tokens per message for role and separators.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Estimated tokens per attached image.
+IMAGE_TOKENS = 1000
+
+ELIDED_TOOL_OUTPUT = "[工具输出已省略以节省上下文，约 {tokens} tokens]"
+
+_CJK_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text."""
+    if not text:
+        return 0
+    other = len(_CJK_PATTERN.sub("", text))
+    return (len(text) - other) + (other + 3) // 4
+
+
+def estimate_message_tokens(msg: Dict[str, Any]) -> int:
+    """Estimate the number of tokens an API message costs."""
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = msg.get("content")
+    if isinstance(content, str):
+        tokens += estimate_text_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_text_tokens(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+    if msg.get("tool_calls"):
+        tokens += estimate_text_tokens(
+            json.dumps(msg["tool_calls"], ensure_ascii=False)
+        )
+    return tokens
+
+
+def _split_turns(messages: List[Dict[str, Any]]) -> List[List[int]]:
+    """Group message indices into turns, each starting at a user message."""
+    turns: List[List[int]] = []
+    for i, msg in enumerate(messages):
+        if msg["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(i)
+    return turns
+
+
+def assemble_context(
+    messages: List[Dict[str, Any]], budget: int
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Fit a prepared message list into a token budget.
+
+    Returns the messages to send and the number of tokens saved.  The input
+    list and its messages are not modified.  The latest turn and the tool
+    outputs of the latest round are always kept, so the result may still
+    exceed a very small budget.
+    """
+    costs = [estimate_message_tokens(msg) for msg in messages]
+    original_total = total = sum(costs)
+    if not budget or total <= budget:
+        return messages, 0
+
+    result = list(messages)
+    turns = _split_turns(result)
+    # Tool outputs after the latest assistant message belong to the round in
+    # progress and are never elided
+    last_assistant = max(
+        (i for i in turns[-1] if result[i]["role"] == "assistant"), default=None
+    )
+    protected_from = len(result) if last_assistant is None else last_assistant + 1
+
+    # 1. Elide tool outputs, oldest first
+    for i, msg in enumerate(result[:protected_from]):
+        if total <= budget:
+            break
+        if msg["role"] != "tool":
+            continue
+        placeholder = ELIDED_TOOL_OUTPUT.format(tokens=costs[i])
+        elided = {**msg, "content": placeholder}
+        elided_cost = estimate_message_tokens(elided)
+        if elided_cost < costs[i]:
+            total -= costs[i] - elided_cost
+            costs[i] = elided_cost
+            result[i] = elided
+
+    # 2. Drop the oldest turns whole
+    dropped = 0
+    for turn in turns[:-1]:
+        if total <= budget:
+            break
+        total -= sum(costs[i] for i in turn)
+        dropped = turn[-1] + 1
+    result = result[dropped:]
+
+    saved = original_total - total
+    logger.info(
+        "Context trimmed to about %d tokens (budget %d), saved about %d tokens",
+        total,
+        budget,
+        saved,
+    )
+    return result, saved
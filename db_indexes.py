@@ -0,0 +1,108 @@
+"""MongoDB index bootstrap and verification.
+
+``ensure_indexes`` creates the indexes backing the hot queries of the app and
+is safe to run on every start.  ``check_indexes`` runs ``explain`` on those
+queries and reports any that still fall back to a collection scan; run it
+with ``python db_indexes.py --check`` (reads ``MONGO_URI``).
+"""
+
+import logging
+import os
+import sys
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Index specifications per collection: (keys, options).
+INDEXES = {
+    "sessions": [
+        # fetch_session_summaries: filter on user, newest first
+        ([("user", 1), ("create_time", -1), ("id", -1)], {"name": "user_create_time"}),
+        # save_session_to_db upserts by id
+        ([("id", 1)], {"name": "id_unique", "unique": True}),
+        # delete_bot removes all sessions of a bot
+        ([("bot_id", 1)], {"name": "bot_id"}),
+    ],
+    "bots": [
+        # bot_catalog.fetch_bots sorts by id, update_bot / delete_bot match on id
+        ([("id", 1)], {"name": "id_unique", "unique": True}),
+    ],
+    "tool_cache": [
+        # MongoDB drops shared tool results once they expire
+        ([("expires_at", 1)], {"name": "expires_at_1", "expireAfterSeconds": 0}),
+    ],
+}
+
+
+def ensure_indexes(db) -> List[str]:
+    """Create the configured indexes (idempotent) and return the names created or confirmed.
+
+    A failing index, e.g. a unique index over existing duplicates, is logged
+    and skipped so the app still starts.
+    """
+    ensured = []
+    for collection_name, specs in INDEXES.items():
+        collection = db[collection_name]
+        for keys, options in specs:
+            try:
+                collection.create_index(keys, **options)
+                ensured.append(f"{collection_name}.{options['name']}")
+            except Exception as e:
+                logger.error(
+                    f"Failed to create index {collection_name}.{options['name']}: {e}"
+                )
+    return ensured
+
+
+def _hot_queries(db) -> Dict[str, Any]:
+    """Return a cursor for each hot query, keyed by a descriptive name."""
+    return {
+        "sessions by user": db.sessions.find({"user": ""})
+        .sort([("create_time", -1), ("id", -1)])
+        .limit(50),
+        "session by id": db.sessions.find({"id": 0}),
+        "sessions by bot_id": db.sessions.find({"bot_id": 0}),
+        "bots by id": db.bots.find().sort("id", 1),
+    }
+
+
+def _plan_stages(plan: Any) -> List[str]:
+    """Collect every ``stage`` in an explain plan tree."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(_plan_stages(item))
+    return stages
+
+
+def check_indexes(db) -> Dict[str, List[str]]:
+    """Explain each hot query and return the plan stages of those that scan the collection."""
+    scans = {}
+    for name, cursor in _hot_queries(db).items():
+        winning_plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = _plan_stages(winning_plan)
+        if "COLLSCAN" in stages:
+            scans[name] = stages
+    return scans
+
+
+if __name__ == "__main__":
+    from pymongo import MongoClient
+
+    logging.basicConfig(level=logging.INFO)
+    database = MongoClient(os.environ["MONGO_URI"])[
+        os.environ.get("MONGO_DB", "ai-bots")
+    ]
+    ensure_indexes(database)
+    if "--check" in sys.argv:
+        collection_scans = check_indexes(database)
+        for query, plan in collection_scans.items():
+            logger.error(f"{query} uses a collection scan: {' -> '.join(plan)}")
+        if collection_scans:
+            sys.exit(1)
+        logger.info("All hot queries use indexes.")
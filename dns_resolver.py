@@ -0,0 +1,145 @@
+"""Cached DNS resolution and address pinning for tool requests.
+
+Hosts are resolved with ``getaddrinfo`` (IPv4 and IPv6) and the addresses
+are cached for ``DNS_CACHE_TTL`` seconds, so the SSRF check and the
+connection that follows share one lookup.  A caller that vetted the
+addresses of a host pins them with ``pinned``; connections opened by
+``http_client`` in that context connect to exactly those addresses, which
+closes the window for DNS rebinding between the check and the connect.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# Lifetime (seconds) of a cached resolution; 0 disables the cache.
+DNS_CACHE_TTL = float(os.environ.get("DNS_CACHE_TTL", "60"))
+
+# Maximum number of hosts kept in the cache.
+DNS_CACHE_SIZE = int(os.environ.get("DNS_CACHE_SIZE", "1024"))
+
+_pins: ContextVar[Dict[str, List[str]]] = ContextVar("dns_pins", default={})
+
+
+def _key(host: str) -> str:
+    return host.strip("[]").rstrip(".").lower()
+
+
+def _literal(host: str) -> Optional[str]:
+    """Return the host as an address if it is an IP literal."""
+    try:
+        return str(ipaddress.ip_address(host.strip("[]")))
+    except ValueError:
+        return None
+
+
+def is_public_address(address: str) -> bool:
+    """Return True unless the address is private, loopback, link-local or otherwise internal."""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    if getattr(ip, "ipv4_mapped", None):
+        ip = ip.ipv4_mapped
+    return not (
+        ip.is_private
+        or ip.is_loopback
+        or ip.is_link_local
+        or ip.is_reserved
+        or ip.is_multicast
+        or ip.is_unspecified
+    )
+
+
+class Resolver:
+    """TTL- and size-bounded cache of ``getaddrinfo`` results."""
+
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        clock=time.monotonic,
+    ):
+        self.ttl = DNS_CACHE_TTL if ttl is None else ttl
+        self.max_entries = DNS_CACHE_SIZE if max_entries is None else max_entries
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, host: str) -> List[str]:
+        addresses: List[str] = []
+        for family, _, _, _, sockaddr in socket.getaddrinfo(
+            host, None, type=socket.SOCK_STREAM
+        ):
+            if family in (socket.AF_INET, socket.AF_INET6):
+                address = str(sockaddr[0])
+                if address not in addresses:
+                    addresses.append(address)
+        if not addresses:
+            raise socket.gaierror(f"No addresses found for {host}")
+        return addresses
+
+    def resolve(self, host: str) -> List[str]:
+        """Return the addresses of a host; raises OSError if it does not resolve."""
+        literal = _literal(host)
+        if literal is not None:
+            return [literal]
+        host = _key(host)
+        started = time.perf_counter()
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(host)
+                telemetry.record("dns", (time.perf_counter() - started) * 1000, "hit")
+                return list(entry[1])
+        try:
+            addresses = self._lookup(host)
+        except OSError:
+            telemetry.record("dns", (time.perf_counter() - started) * 1000, "error")
+            raise
+        telemetry.record("dns", (time.perf_counter() - started) * 1000, "miss")
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[host] = (now + self.ttl, addresses)
+                self._entries.move_to_end(host)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return list(addresses)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+# Process-wide resolver used by the web tools and the HTTP transport.
+RESOLVER = Resolver()
+
+
+@contextmanager
+def pinned(host: str, addresses: List[str]) -> Iterator[None]:
+    """Make connections to ``host`` opened in this context use only ``addresses``."""
+    token = _pins.set({**_pins.get(), _key(host): list(addresses)})
+    try:
+        yield
+    finally:
+        _pins.reset(token)
+
+
+def connect_addresses(host: str) -> List[str]:
+    """Return the addresses a connection to ``host`` should use: pinned ones first."""
+    addresses = _pins.get().get(_key(host))
+    if addresses is not None:
+        return addresses
+    return RESOLVER.resolve(host)
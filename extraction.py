@@ -0,0 +1,129 @@
+"""HTML extraction for the web tools.
+
+Pages fetched by ``fetch_url`` go through trafilatura, which parses them with
+lxml (libxml2) and keeps the main content (text, headings, lists, tables and
+links) without navigation, sidebars and footers before rendering it as
+markdown.  When it finds no main content, or fails, the page falls back to
+converting the whole ``<body>`` with markdownify.
+
+Bing result pages are parsed with lxml and only the result list is read;
+BeautifulSoup is the fallback if lxml cannot parse the page.
+"""
+
+import logging
+from typing import Dict, List, Optional, Union
+
+import lxml.html
+import markdownify
+import trafilatura
+from bs4 import BeautifulSoup
+
+logger = logging.getLogger(__name__)
+
+# Number of search results returned by parse_search_results.
+SEARCH_RESULT_LIMIT = 5
+
+_RESULT_XPATH = (
+    '//*[@id="b_results"]//li'
+    '[contains(concat(" ", normalize-space(@class), " "), " b_algo ")]'
+)
+_SNIPPET_XPATH = (
+    './/*[contains(concat(" ", normalize-space(@class), " "), " b_caption ")]//p'
+)
+
+
+def _decode(data: bytes, encoding: Optional[str]) -> Union[str, bytes]:
+    """Decode with the charset from the headers, or leave detection to the parser."""
+    if not encoding:
+        return data
+    try:
+        return data.decode(encoding, errors="replace")
+    except LookupError:
+        return data
+
+
+def body_to_markdown(data: bytes, encoding: Optional[str] = None) -> str:
+    """Convert the whole ``<body>`` of a page to markdown."""
+    soup = BeautifulSoup(data, "lxml", from_encoding=encoding)
+    body = soup.find("body")
+    return markdownify.markdownify(str(body) if body else "", heading_style="ATX")
+
+
+def html_to_markdown(
+    data: bytes, encoding: Optional[str] = None, url: Optional[str] = None
+) -> str:
+    """Extract the main content of an HTML page as markdown."""
+    try:
+        content = trafilatura.extract(
+            _decode(data, encoding),
+            url=url,
+            output_format="txt",
+            include_formatting=True,
+            include_links=True,
+            include_tables=True,
+            include_comments=False,
+        )
+    except Exception as e:
+        logger.warning(f"Main content extraction failed for {url}: {e}")
+        content = None
+    if content:
+        return content
+    logger.debug(f"No main content found in {url}, converting the whole body")
+    return body_to_markdown(data, encoding)
+
+
+def _parse_results_lxml(data: bytes, limit: int) -> List[Dict[str, str]]:
+    tree = lxml.html.fromstring(data)
+    results = []
+    for li in tree.xpath(_RESULT_XPATH):
+        links = li.xpath(".//h2//a")
+        if not links:
+            continue
+        url = links[0].get("href", "")
+        if not url.startswith(("http://", "https://")):
+            continue
+        snippets = li.xpath(_SNIPPET_XPATH)
+        results.append(
+            {
+                "title": links[0].text_content(),
+                "url": url,
+                "snippet": snippets[0].text_content() if snippets else "",
+            }
+        )
+        if len(results) >= limit:
+            break
+    return results
+
+
+def _parse_results_soup(data: bytes, limit: int) -> List[Dict[str, str]]:
+    soup = BeautifulSoup(data, "html.parser")
+    results = []
+    for li in soup.select("#b_results li.b_algo"):
+        a_tag = li.select_one("h2 a")
+        if not a_tag:
+            continue
+        url = a_tag.get("href", "")
+        if not url.startswith(("http://", "https://")):
+            continue
+        snippet_tag = li.select_one(".b_caption p")
+        results.append(
+            {
+                "title": a_tag.get_text(),
+                "url": url,
+                "snippet": snippet_tag.get_text() if snippet_tag else "",
+            }
+        )
+        if len(results) >= limit:
+            break
+    return results
+
+
+def parse_search_results(
+    data: bytes, limit: int = SEARCH_RESULT_LIMIT
+) -> List[Dict[str, str]]:
+    """Return the title, url and snippet of the first results of a Bing page."""
+    try:
+        return _parse_results_lxml(data, limit)
+    except Exception as e:
+        logger.warning(f"lxml could not parse the search results, retrying: {e}")
+        return _parse_results_soup(data, limit)
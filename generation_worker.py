@@ -0,0 +1,347 @@
+"""Process-level worker pool for chat turns.
+
+A turn runs on a worker thread that owns the streaming and tool loop, so it
+is not aborted when a Streamlit rerun (a click anywhere on the page) or a
+browser reconnect ends the script run that started it.  The job records the
+messages of the turn in its own copy of the session, checkpoints them
+together with the partial reply at ``CHECKPOINT_INTERVAL`` and keeps them
+until a script run attaches to the job and adopts its messages.
+
+``tags`` given to ``submit`` (model and bot) label every telemetry span of
+the turn, including the time it waited for a free worker.  Each worker
+thread runs its turns on one long-lived event loop (``thread_event_loop``),
+so async clients kept per thread reuse their connections across turns.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import blob_store
+import telemetry
+from chat_engine import TurnCallbacks
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of chat turns generated at the same time by this process.
+GENERATION_WORKERS = max(1, int(os.environ.get("GENERATION_WORKERS", "8")))
+
+# Minimum interval (seconds) between two checkpoints of a running turn.
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "2.0"))
+
+# Finished jobs nobody attached to are dropped after this many seconds.
+JOB_RETENTION_SECONDS = 600
+
+# Event loop of the calling worker thread, kept for all of its turns.
+_thread_state = threading.local()
+_loops: List[asyncio.AbstractEventLoop] = []
+_loops_lock = threading.Lock()
+
+RUNNING = "running"
+DONE = "done"
+STOPPED = "stopped"
+FAILED = "failed"
+
+
+class GenerationJob(TurnCallbacks):
+    """One chat turn generated in the background.
+
+    The job is the ``TurnCallbacks`` of its turn.  All state read by the UI
+    is guarded by a lock and exposed through ``snapshot``.  ``persist`` is
+    called as ``persist(session, dirty_from)`` to checkpoint the session.
+    """
+
+    def __init__(
+        self,
+        session: Dict[str, Any],
+        persist: Optional[Callable[[Dict[str, Any], Optional[int]], None]] = None,
+        checkpoint_interval: Optional[float] = None,
+        clock=time.monotonic,
+        tags: Optional[Dict[str, Any]] = None,
+    ):
+        # Work on a copy so the script run can keep rendering its own session
+        self.session = {**session, "messages": list(session["messages"])}
+        self.start = len(self.session["messages"])
+        self.status = RUNNING
+        self.error: Optional[str] = None
+        self.notice: Optional[str] = None
+        self.saved_tokens = 0
+        self.finished_at: Optional[float] = None
+        self.tags = dict(tags or {})
+        self.submitted_at = time.perf_counter()
+        self.checkpoint_interval = (
+            CHECKPOINT_INTERVAL if checkpoint_interval is None else checkpoint_interval
+        )
+        self._persist = persist
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._version = 0
+        self._response_parts: List[str] = []
+        self._reasoning_parts: List[str] = []
+        self._tool_calls: Dict[int, Dict] = {}
+        # Id of the reply being streamed; the parts above belong to it
+        self._stream = 0
+        self._last_checkpoint = clock()
+        # Index at which the last checkpoint stored the partial reply
+        self._partial_at: Optional[int] = None
+
+    @property
+    def session_id(self):
+        return self.session["id"]
+
+    @property
+    def finished(self) -> bool:
+        return self.status != RUNNING
+
+    def stop(self) -> None:
+        """Ask the turn to stop; the output produced so far is kept."""
+        self._stop.set()
+
+    def wait(self, version: int, timeout: float) -> None:
+        """Block until the job changes from ``version`` or ``timeout`` seconds have passed."""
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+
+    def _partial_message(self) -> Optional[Dict[str, Any]]:
+        if not (self._response_parts or self._reasoning_parts):
+            return None
+        return {
+            "role": "assistant",
+            "content": "".join(self._response_parts),
+            "reasoning_content": "".join(self._reasoning_parts),
+        }
+
+    def snapshot(
+        self,
+        stream: Optional[int] = None,
+        reasoning_from: int = 0,
+        content_from: int = 0,
+    ) -> Dict[str, Any]:
+        """Return a consistent view of the turn for rendering.
+
+        ``reasoning`` and ``content`` hold the deltas of the reply being
+        streamed that come after the given offsets, so a reader only handles
+        what is new; all of them are returned when ``stream`` is not the
+        current reply.
+        """
+        with self._lock:
+            if stream != self._stream:
+                reasoning_from = content_from = 0
+            return {
+                "version": self._version,
+                "status": self.status,
+                "messages": self.session["messages"][self.start :],
+                "stream": self._stream,
+                "reasoning": self._reasoning_parts[reasoning_from:],
+                "content": self._response_parts[content_from:],
+                "tool_calls": dict(self._tool_calls),
+                "error": self.error,
+                "notice": self.notice,
+                "saved_tokens": self.saved_tokens,
+            }
+
+    def _changed_locked(self) -> None:
+        self._version += 1
+        self._changed.notify_all()
+
+    def _end_stream_locked(self) -> None:
+        self._response_parts = []
+        self._reasoning_parts = []
+        self._tool_calls = {}
+        self._stream += 1
+
+    # --- TurnCallbacks ---
+
+    def on_round_start(self, round_index: int) -> None:
+        with self._lock:
+            self._end_stream_locked()
+            self._changed_locked()
+
+    def on_delta(self, content, reasoning, tool_progress, tool_calls) -> None:
+        with self._lock:
+            if content:
+                self._response_parts.append(content)
+            if reasoning:
+                self._reasoning_parts.append(reasoning)
+            if tool_calls:
+                # The engine keeps extending these dicts: copy them for readers
+                self._tool_calls = {
+                    index: {**call, "function": dict(call["function"])}
+                    for index, call in tool_calls.items()
+                }
+            self._changed_locked()
+        self.checkpoint()
+
+    def on_tick(self, tool_calls) -> None:
+        self.checkpoint()
+
+    def on_assistant_message(self, message, tool_calls) -> None:
+        with self._lock:
+            self.session["messages"].append(message)
+            self._end_stream_locked()
+            self._changed_locked()
+
+    def on_tool_message(self, message, duration_ms) -> None:
+        content = blob_store.store_text_if_large(message["content"])
+        stored = {**message, "content": content, "duration_ms": duration_ms}
+        if content != message["content"]:
+            # Shown in place of the stored response until it is loaded
+            stored["preview"] = message["content"][: blob_store.TOOL_PREVIEW_CHARS]
+        with self._lock:
+            self.session["messages"].append(stored)
+            self._changed_locked()
+        self.checkpoint()
+
+    def on_max_rounds(self, max_rounds: int) -> None:
+        with self._lock:
+            self.notice = f"工具调用次数已达上限 ({max_rounds})，响应可能不完整。"
+            self._changed_locked()
+
+    def should_stop(self) -> bool:
+        return self._stop.is_set()
+
+    # --- Persistence and execution ---
+
+    def checkpoint(self, force: bool = False) -> None:
+        """Persist the messages and partial reply if the checkpoint interval has passed."""
+        if self._persist is None:
+            return
+        now = self._clock()
+        if not force and now - self._last_checkpoint < self.checkpoint_interval:
+            return
+        self._last_checkpoint = now
+        with self._lock:
+            partial = None if self.finished else self._partial_message()
+            messages = self.session["messages"] + ([partial] if partial else [])
+            # The previous partial reply may since have been replaced
+            dirty_from = self._partial_at
+            self._partial_at = len(self.session["messages"]) if partial else None
+            checkpoint = {**self.session, "messages": messages}
+        try:
+            self._persist(checkpoint, dirty_from)
+            self.session["message_count"] = checkpoint.get("message_count")
+        except Exception as e:
+            logger.error(f"Failed to checkpoint session {self.session_id}: {e}")
+            # Rewrite from the old partial position on the next checkpoint
+            self._partial_at = dirty_from
+
+    def run(self, turn: Callable[["GenerationJob"], Awaitable[bool]]) -> None:
+        """Run the turn on the thread's event loop and record how it ended."""
+        with telemetry.tagged(**self.tags):
+            started = time.perf_counter()
+            telemetry.record("queue", (started - self.submitted_at) * 1000)
+            self._run(turn)
+            telemetry.record(
+                "turn", (time.perf_counter() - started) * 1000, self.status
+            )
+
+    def _run(self, turn: Callable[["GenerationJob"], Awaitable[bool]]) -> None:
+        status, error = DONE, None
+        try:
+            if thread_event_loop().run_until_complete(turn(self)):
+                status = STOPPED
+        except Exception as e:
+            logger.error(f"创建聊天回复失败: {e}", exc_info=True)
+            status, error = FAILED, str(e)
+            with self._lock:
+                # Keep the reply streamed before the failure
+                partial = self._partial_message()
+                if partial:
+                    self.session["messages"].append(partial)
+        with self._lock:
+            self.status, self.error = status, error
+            self.finished_at = self._clock()
+            self._end_stream_locked()
+            self._changed_locked()
+        self.checkpoint(force=True)
+
+
+def thread_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop of the calling thread, creating it on first use."""
+    loop = getattr(_thread_state, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_state.loop = asyncio.new_event_loop()
+        with _loops_lock:
+            _loops.append(loop)
+    return loop
+
+
+def _close_event_loops() -> None:
+    """Finalize the async generators left on the thread loops, as asyncio.run would."""
+    with _loops_lock:
+        loops, _loops[:] = list(_loops), []
+    for loop in loops:
+        if loop.is_running() or loop.is_closed():
+            continue
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+atexit.register(_close_event_loops)
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_jobs: Dict[Any, GenerationJob] = {}
+_jobs_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=GENERATION_WORKERS, thread_name_prefix="generation"
+                )
+    return _executor
+
+
+def _prune_locked(now: float) -> None:
+    for session_id, job in list(_jobs.items()):
+        if job.finished and now - job.finished_at > JOB_RETENTION_SECONDS:
+            logger.info(f"Dropping unattached generation job of session {session_id}")
+            del _jobs[session_id]
+
+
+def submit(
+    session: Dict[str, Any],
+    turn: Callable[[GenerationJob], Awaitable[bool]],
+    persist: Optional[Callable[[Dict[str, Any], Optional[int]], None]] = None,
+    tags: Optional[Dict[str, Any]] = None,
+) -> GenerationJob:
+    """Start generating a turn of the session in the background and return its job.
+
+    Raises RuntimeError if a turn of the session is still running.
+    """
+    with _jobs_lock:
+        _prune_locked(time.monotonic())
+        existing = _jobs.get(session["id"])
+        if existing is not None and not existing.finished:
+            raise RuntimeError(f"Session {session['id']} is already generating")
+        job = GenerationJob(session, persist, tags=tags)
+        _jobs[session["id"]] = job
+    _get_executor().submit(job.run, turn)
+    return job
+
+
+def get_job(session_id) -> Optional[GenerationJob]:
+    """Return the running or unadopted job of a session, if any."""
+    with _jobs_lock:
+        return _jobs.get(session_id)
+
+
+def release(job: GenerationJob) -> None:
+    """Forget a finished job once its messages have been adopted."""
+    with _jobs_lock:
+        if _jobs.get(job.session_id) is job:
+            del _jobs[job.session_id]
@@ -0,0 +1,159 @@
+"""Shared keep-alive HTTP transport for tool traffic.
+
+All outbound requests made by the web tools go through one process-wide
+``requests.Session`` so that TCP+TLS connections are pooled and reused
+across tool calls, rounds and user sessions.  Pool sizes and timeouts are
+configured through environment variables.
+
+New connections resolve their host through ``dns_resolver``: they use the
+addresses pinned by the caller (the ones its SSRF check approved) or the
+cached resolution, so a request does not repeat the lookup of its check.
+TLS still verifies the certificate against the host name.
+"""
+
+from http.cookiejar import DefaultCookiePolicy
+import logging
+import os
+import socket
+import threading
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util import connection
+
+import dns_resolver
+
+logger = logging.getLogger(__name__)
+
+# Number of per-host connection pools kept alive.
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "32"))
+
+# Maximum number of connections kept (and used concurrently) per host.
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "8"))
+
+# Connect / read timeouts (seconds) applied to every tool request.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "15"))
+
+# Maximum wait (seconds) for a free connection of a host whose pool is in use.
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", "30"))
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def default_timeout() -> Tuple[float, float]:
+    """Return the (connect, read) timeout used for tool requests."""
+    return (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+
+class _ResolvedConnectionMixin:
+    """Connect to the addresses given by ``dns_resolver``, trying each in turn.
+
+    Only the socket is opened to the address; ``host`` is left alone, so the
+    Host header, SNI and certificate verification use the host name.
+    """
+
+    def _new_conn(self):
+        try:
+            addresses = dns_resolver.connect_addresses(self.host)
+        except OSError:
+            # Let urllib3 resolve again and report the failure its own way
+            return super()._new_conn()
+        for i, address in enumerate(addresses):
+            last = i == len(addresses) - 1
+            try:
+                return connection.create_connection(
+                    (address, self.port),
+                    self.timeout,
+                    source_address=self.source_address,
+                    socket_options=self.socket_options,
+                )
+            except socket.timeout as e:
+                if last:
+                    raise ConnectTimeoutError(
+                        self,
+                        f"Connection to {self.host} timed out. "
+                        f"(connect timeout={self.timeout})",
+                    ) from e
+            except OSError as e:
+                if last:
+                    raise NewConnectionError(
+                        self, f"Failed to establish a new connection: {e}"
+                    ) from e
+            logger.debug(f"Connecting to {self.host} via {address} failed")
+
+
+class ResolvedHTTPConnection(_ResolvedConnectionMixin, HTTPConnection):
+    pass
+
+
+class ResolvedHTTPSConnection(_ResolvedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _PoolTimeoutMixin:
+    """Wait at most ``HTTP_POOL_TIMEOUT`` seconds for a free connection.
+
+    Pools block once ``HTTP_POOL_MAXSIZE`` connections to a host are in use,
+    and requests never passes a pool timeout, so nested fetches could wait
+    forever; they fail with ``EmptyPoolError`` instead.
+    """
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(HTTP_POOL_TIMEOUT if timeout is None else timeout)
+
+
+class ResolvedHTTPConnectionPool(_PoolTimeoutMixin, HTTPConnectionPool):
+    ConnectionCls = ResolvedHTTPConnection
+
+
+class ResolvedHTTPSConnectionPool(_PoolTimeoutMixin, HTTPSConnectionPool):
+    ConnectionCls = ResolvedHTTPSConnection
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    # pool_block makes HTTP_POOL_MAXSIZE a hard per-host limit instead of
+    # opening throwaway connections once the pool is exhausted.
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=True,
+        max_retries=0,
+    )
+    adapter.poolmanager.pool_classes_by_scheme = {
+        "http": ResolvedHTTPConnectionPool,
+        "https": ResolvedHTTPSConnectionPool,
+    }
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Never persist cookies: the session is shared by every user, and an
+    # immutable cookie jar keeps concurrent use from worker threads safe.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session() -> requests.Session:
+    """Return the process-wide pooled HTTP session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+                logger.debug(
+                    "Created pooled HTTP session (pools=%d, maxsize=%d)",
+                    HTTP_POOL_CONNECTIONS,
+                    HTTP_POOL_MAXSIZE,
+                )
+    return _session
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """Issue a GET through the pooled session with the configured timeouts."""
+    kwargs.setdefault("timeout", default_timeout())
+    return get_session().get(url, **kwargs)
@@ -0,0 +1,70 @@
+"""Session queries backing the sidebar history and session switching.
+
+The sidebar only needs a few fields per session, so it works on summaries
+fetched with a projection; the full message list is loaded when the user
+opens a session.
+"""
+
+from datetime import datetime
+import base64
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Fields shown in the sidebar session list.
+SUMMARY_FIELDS = ("id", "name", "bot_id", "create_time")
+
+
+def session_summary(session: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the sidebar summary of a full session."""
+    return {field: session.get(field) for field in SUMMARY_FIELDS}
+
+
+def encode_page_token(summary: Dict[str, Any]) -> str:
+    """Encode the (create_time, id) position of a session as an opaque page token."""
+    position = json.dumps([summary["create_time"].isoformat(), summary["id"]])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(token: str) -> Tuple[datetime, Any]:
+    """Decode a page token into the (create_time, id) position it continues from."""
+    create_time, session_id = json.loads(base64.urlsafe_b64decode(token))
+    return datetime.fromisoformat(create_time), session_id
+
+
+def fetch_session_summaries(
+    db, username, page_token: Optional[str] = None, limit=50
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Fetch one page of session summaries for the current user, newest first.
+
+    Pages continue from the last seen (create_time, id) instead of skipping,
+    so each page costs the same and sessions saved in between do not shift
+    later pages.  Returns the summaries and the token of the next page, or
+    None when there are no more sessions.
+    """
+    query: Dict[str, Any] = {"user": username}
+    if page_token:
+        create_time, session_id = decode_page_token(page_token)
+        query["$or"] = [
+            {"create_time": {"$lt": create_time}},
+            {"create_time": create_time, "id": {"$lt": session_id}},
+        ]
+    projection = {field: 1 for field in SUMMARY_FIELDS}
+    projection["_id"] = 0
+    summaries = list(
+        db.sessions.find(query, projection)
+        .sort([("create_time", -1), ("id", -1)])
+        .limit(limit)
+    )
+    next_token = encode_page_token(summaries[-1]) if len(summaries) == limit else None
+    return summaries, next_token
+
+
+def load_session(db, username, session_id) -> Optional[Dict[str, Any]]:
+    """Load a full session, including its messages, from MongoDB."""
+    session = db.sessions.find_one({"id": session_id, "user": username})
+    if session is None:
+        logger.warning(f"Session {session_id} not found for user {username}")
+    return session
@@ -0,0 +1,314 @@
+"""Write-behind queue that coalesces session saves into background bulk writes."""
+
+from datetime import datetime
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import (
+    BulkWriteError,
+    ConnectionFailure,
+    ExecutionTimeout,
+    WTimeoutError,
+)
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# Seconds a pending save waits for further saves to coalesce with.
+SESSION_WRITE_DELAY = float(os.environ.get("SESSION_WRITE_DELAY", "0.2"))
+
+# Retries of a bulk write failing with a transient error.
+SESSION_WRITE_RETRIES = int(os.environ.get("SESSION_WRITE_RETRIES", "3"))
+
+# Backoff (seconds) before the first retry; doubled for each further one.
+RETRY_BACKOFF = 0.5
+
+TRANSIENT_ERRORS = (ConnectionFailure, ExecutionTimeout, WTimeoutError)
+
+
+def build_session_update(
+    session: Dict[str, Any], start: Optional[int]
+) -> Dict[str, Any]:
+    """Build the upsert of a session that rewrites its messages from ``start``.
+
+    The changed tail is inserted at ``start`` and the array is sliced to its
+    new length, which also drops popped or truncated entries.  A ``start``
+    of None rewrites the whole array.
+    """
+    messages = session["messages"]
+    fields = {
+        "user": session["user"],
+        "name": session["name"],
+        "updated_at": session.get("updated_at"),
+        "bot_id": session["bot_id"],
+        "message_count": len(messages),
+    }
+    update: Dict[str, Any] = {
+        "$set": fields,
+        "$setOnInsert": {
+            "create_time": session.get("updated_at"),
+        },
+    }
+    if start is None:
+        fields["messages"] = messages
+    else:
+        update["$push"] = {
+            "messages": {
+                "$each": messages[start:],
+                "$position": start,
+                "$slice": len(messages),
+            }
+        }
+    return update
+
+
+def _merge_start(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    if a is None or b is None:
+        return None
+    return min(a, b)
+
+
+class _PendingSave:
+    """The latest state of a session waiting to be written."""
+
+    def __init__(self, db, session: Dict[str, Any], start: Optional[int]):
+        self.db = db
+        self.session = session
+        self.start = start
+        self.saves = 1
+        self.enqueued_at = time.perf_counter()
+        self.tags = telemetry.current_tags()
+
+    def merge(self, newer: "_PendingSave") -> None:
+        self.db = newer.db
+        self.session = newer.session
+        self.start = _merge_start(self.start, newer.start)
+        self.saves += newer.saves
+
+
+class SessionWriter:
+    """Coalescing write-behind queue of session upserts."""
+
+    def __init__(
+        self,
+        delay: Optional[float] = None,
+        retries: Optional[int] = None,
+        backoff: float = RETRY_BACKOFF,
+        sleep=time.sleep,
+    ):
+        self.delay = SESSION_WRITE_DELAY if delay is None else delay
+        self.retries = SESSION_WRITE_RETRIES if retries is None else retries
+        self.backoff = backoff
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        # Notified when a save is queued or a write ends
+        self._changed = threading.Condition(self._lock)
+        self._pending: Dict[Any, _PendingSave] = {}
+        # Sessions being written; their next saves wait, so saves stay in order
+        self._writing: set = set()
+        # Sessions whose last update was rejected: their next save rewrites them
+        self._rewrite: set = set()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def depth(self) -> int:
+        """Return the number of sessions waiting to be written."""
+        with self._lock:
+            return len(self._pending)
+
+    def enqueue(self, db, session: Dict[str, Any], dirty_from: Optional[int] = None):
+        """Queue a save of the session's current messages.
+
+        ``session["message_count"]`` is the number of messages written by
+        the previous save (None to rewrite them all); the caller updates it
+        once the save is queued.
+        """
+        messages = list(session["messages"])
+        persisted = session.get("message_count")
+        start = None
+        if persisted is not None:
+            start = min(persisted, len(messages))
+            if dirty_from is not None:
+                start = min(start, dirty_from)
+        snapshot = {**session, "messages": messages, "updated_at": datetime.now()}
+        entry = _PendingSave(db, snapshot, start)
+        with self._lock:
+            existing = self._pending.get(session["id"])
+            if existing is not None:
+                existing.merge(entry)
+            else:
+                if session["id"] in self._rewrite:
+                    entry.start = None
+                self._pending[session["id"]] = entry
+            self._changed.notify_all()
+        self._ensure_thread()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None or self._closed.is_set():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="session-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _ready_locked(self) -> List:
+        return [i for i in self._pending if i not in self._writing]
+
+    def _run(self) -> None:
+        while True:
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: self._ready_locked() or self._closed.is_set()
+                )
+                if self._closed.is_set():
+                    return
+            # Give saves arriving shortly after this one the chance to coalesce
+            self._closed.wait(self.delay)
+            try:
+                with self._lock:
+                    batch = self._take_locked(self._ready_locked())
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Session writer failed: {e}", exc_info=True)
+
+    def flush(self, session_ids: Optional[Iterable] = None) -> None:
+        """Write pending saves now, on the calling thread.
+
+        ``session_ids`` limits the flush to those sessions, waiting only for
+        their writes in progress; by default every session is written.
+        """
+        with self._changed:
+            if session_ids is None:
+                self._changed.wait_for(lambda: not self._writing)
+                session_ids = list(self._pending)
+            else:
+                session_ids = set(session_ids)
+                self._changed.wait_for(lambda: not session_ids & self._writing)
+            batch = self._take_locked(session_ids)
+        self._write_batch(batch)
+
+    def _take_locked(self, session_ids: Iterable) -> Dict[Any, _PendingSave]:
+        batch = {i: self._pending.pop(i) for i in session_ids if i in self._pending}
+        self._writing.update(batch)
+        return batch
+
+    def _write_batch(self, batch: Dict[Any, _PendingSave]) -> None:
+        try:
+            groups: Dict[int, List] = {}
+            for session_id, entry in batch.items():
+                groups.setdefault(id(entry.db), []).append((session_id, entry))
+            for entries in groups.values():
+                self._write(entries)
+        finally:
+            with self._changed:
+                self._writing.difference_update(batch)
+                self._changed.notify_all()
+
+    def _write(self, entries: List) -> None:
+        db = entries[0][1].db
+        operations = [
+            UpdateOne(
+                {"id": session_id},
+                build_session_update(entry.session, entry.start),
+                upsert=True,
+            )
+            for session_id, entry in entries
+        ]
+        failed: Dict[int, str] = {}
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                db.sessions.bulk_write(operations, ordered=False)
+            except TRANSIENT_ERRORS as e:
+                self._record_flush(started, "retry", len(operations))
+                if attempt < self.retries:
+                    logger.warning(f"Retrying session writes after: {e}")
+                    self._sleep(self.backoff * 2**attempt)
+                    continue
+                logger.error(f"Giving up on {len(entries)} session writes for now: {e}")
+                self._requeue(entries)
+                return
+            except BulkWriteError as e:
+                self._record_flush(started, "error", len(operations))
+                failed = {
+                    error["index"]: error.get("errmsg", "")
+                    for error in e.details.get("writeErrors", [])
+                }
+            except Exception as e:
+                self._record_flush(started, "error", len(operations))
+                logger.error(f"Failed to write {len(entries)} sessions for now: {e}")
+                self._requeue(entries)
+                return
+            else:
+                self._record_flush(started, "ok", len(operations))
+            break
+
+        written_at = time.perf_counter()
+        for i, (session_id, entry) in enumerate(entries):
+            if i in failed:
+                logger.error(f"Failed to save session {session_id}: {failed[i]}")
+            telemetry.record(
+                "save_session",
+                (written_at - entry.enqueued_at) * 1000,
+                "error" if i in failed else "ok",
+                tags=entry.tags,
+                messages=len(entry.session["messages"]),
+                saves=entry.saves,
+            )
+        with self._lock:
+            for i, (session_id, entry) in enumerate(entries):
+                if i in failed:
+                    self._rewrite.add(session_id)
+                    pending = self._pending.get(session_id)
+                    if pending is not None:
+                        pending.start = None
+                else:
+                    self._rewrite.discard(session_id)
+
+    def _requeue(self, entries: List) -> None:
+        """Put saves that could not be written back in front of newer ones."""
+        with self._lock:
+            for session_id, entry in entries:
+                newer = self._pending.get(session_id)
+                if newer is not None:
+                    entry.merge(newer)
+                self._pending[session_id] = entry
+
+    @staticmethod
+    def _record_flush(started: float, outcome: str, sessions: int) -> None:
+        telemetry.record(
+            "session_flush",
+            (time.perf_counter() - started) * 1000,
+            outcome,
+            sessions=sessions,
+        )
+
+    def close(self) -> None:
+        """Stop the background thread and write what is still pending."""
+        self._closed.set()
+        with self._changed:
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        remaining = self.depth()
+        if remaining:
+            logger.error(f"{remaining} session saves could not be written")
+
+
+# Process-wide queue used by save_session_to_db.
+SESSION_WRITER = SessionWriter()
+atexit.register(SESSION_WRITER.close)
+telemetry.gauge(
+    "session_write_queue_depth",
+    "Sessions with saves waiting to be written.",
+    SESSION_WRITER.depth,
+)
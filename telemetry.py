@@ -0,0 +1,280 @@
+"""Per-turn latency telemetry.
+
+Timed spans (queueing, context build, time to first token, completion
+streams, tool calls, session saves) are tagged with the model, bot and
+round of the turn they belong to.  Tags are kept in a context variable, so
+they follow a turn into its event loop and the worker threads of its tool
+calls without being passed around.
+
+Spans are exported in two ways:
+
+- one JSON object per line to ``TELEMETRY_JSONL_PATH``, for offline
+  collectors
+- aggregated histograms in the Prometheus text format, served at
+  ``/metrics`` on ``TELEMETRY_PORT``, together with the gauges registered
+  with ``gauge`` (e.g. the depth of the session write queue)
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# File receiving one JSON span per line; unset disables the JSONL export.
+TELEMETRY_JSONL_PATH = os.environ.get("TELEMETRY_JSONL_PATH", "")
+
+# Port of the Prometheus /metrics endpoint; 0 disables it.
+TELEMETRY_PORT = int(os.environ.get("TELEMETRY_PORT", "0"))
+
+METRIC_PREFIX = "ai_bots"
+
+# Tags that become Prometheus labels; others (e.g. round) only go to JSONL.
+LABEL_TAGS = ("model", "bot", "tool")
+
+DURATION_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500)
+
+_tags: ContextVar[Dict[str, str]] = ContextVar("telemetry_tags", default={})
+
+# Gauges read when the metrics are rendered: name -> (help text, read).
+_gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+
+
+@contextmanager
+def tagged(**tags) -> Iterator[None]:
+    """Add tags to every span recorded in this context."""
+    token = _tags.set({**_tags.get(), **{k: str(v) for k, v in tags.items()}})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def current_tags() -> Dict[str, str]:
+    return dict(_tags.get())
+
+
+class Histogram:
+    """Cumulative Prometheus histogram for one label set."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Recorder:
+    """Collect spans into histograms and append them to the JSONL export."""
+
+    def __init__(self, jsonl_path: str = ""):
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._durations: Dict[Tuple, Histogram] = {}
+        self._rates: Dict[Tuple, Histogram] = {}
+
+    @staticmethod
+    def _labels(name: str, tags: Dict[str, str], outcome: Optional[str]) -> Tuple:
+        labels = [("span", name)]
+        labels += [(tag, tags[tag]) for tag in LABEL_TAGS if tag in tags]
+        if outcome is not None:
+            labels.append(("outcome", outcome))
+        return tuple(labels)
+
+    def record(
+        self,
+        name: str,
+        duration_ms: float,
+        outcome: str = "ok",
+        tags: Optional[Dict[str, str]] = None,
+        **fields,
+    ) -> None:
+        """Record one finished span."""
+        tags = {**current_tags(), **(tags or {})}
+        with self._lock:
+            key = self._labels(name, tags, outcome)
+            if key not in self._durations:
+                self._durations[key] = Histogram(DURATION_BUCKETS_MS)
+            self._durations[key].observe(duration_ms)
+            if fields.get("tokens_per_s") is not None:
+                key = self._labels(name, tags, None)
+                if key not in self._rates:
+                    self._rates[key] = Histogram(RATE_BUCKETS)
+                self._rates[key].observe(fields["tokens_per_s"])
+        if self.jsonl_path:
+            self._write_jsonl(
+                {
+                    "ts": time.time(),
+                    "span": name,
+                    "duration_ms": round(duration_ms, 3),
+                    "outcome": outcome,
+                    **tags,
+                    **fields,
+                }
+            )
+
+    def _write_jsonl(self, span: Dict[str, Any]) -> None:
+        line = json.dumps(span, ensure_ascii=False, default=str) + "\n"
+        try:
+            with self._lock, open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError as e:
+            logger.error(f"Failed to write telemetry span: {e}")
+
+    def render_prometheus(self) -> str:
+        """Render the aggregated spans in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            for metric, help_text, histograms in (
+                (
+                    f"{METRIC_PREFIX}_span_duration_milliseconds",
+                    "Duration of chat turn spans.",
+                    self._durations,
+                ),
+                (
+                    f"{METRIC_PREFIX}_stream_tokens_per_second",
+                    "Output tokens per second of completion streams.",
+                    self._rates,
+                ),
+            ):
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in sorted(histograms.items()):
+                    label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(
+                            f'{metric}_bucket{{{label_text},le="{bound}"}} {count}'
+                        )
+                    lines.append(
+                        f'{metric}_bucket{{{label_text},le="+Inf"}} {histogram.count}'
+                    )
+                    lines.append(f"{metric}_sum{{{label_text}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{{label_text}}} {histogram.count}")
+        for name, (help_text, read) in sorted(_gauges.items()):
+            metric = f"{METRIC_PREFIX}_{name}"
+            try:
+                value = read()
+            except Exception as e:
+                logger.error(f"Failed to read gauge {name}: {e}")
+                continue
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._durations.clear()
+            self._rates.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Process-wide recorder used by the app.
+RECORDER = Recorder(TELEMETRY_JSONL_PATH)
+
+
+def record(
+    name: str,
+    duration_ms: float,
+    outcome: str = "ok",
+    tags: Optional[Dict[str, Any]] = None,
+    **fields,
+) -> None:
+    """Record a span measured by the caller."""
+    tags = {k: str(v) for k, v in (tags or {}).items()}
+    RECORDER.record(name, duration_ms, outcome, tags=tags, **fields)
+
+
+def gauge(name: str, help_text: str, read: Callable[[], float]) -> None:
+    """Export the value returned by ``read`` as a Prometheus gauge."""
+    _gauges[name] = (help_text, read)
+
+
+class Span:
+    """A running span; set ``outcome`` or add ``fields`` before it ends."""
+
+    def __init__(self, name: str, tags: Dict[str, str]):
+        self.name = name
+        self.tags = tags
+        self.outcome = "ok"
+        self.fields: Dict[str, Any] = {}
+
+
+@contextmanager
+def span(name: str, **tags) -> Iterator[Span]:
+    """Time a block as a span; exceptions mark it as an error (or cancelled)."""
+    current = Span(name, {k: str(v) for k, v in tags.items()})
+    started = time.perf_counter()
+    try:
+        yield current
+    except (asyncio.CancelledError, KeyboardInterrupt, SystemExit):
+        current.outcome = "cancelled"
+        raise
+    except BaseException:
+        current.outcome = "error"
+        raise
+    finally:
+        RECORDER.record(
+            name,
+            (time.perf_counter() - started) * 1000,
+            current.outcome,
+            tags=current.tags,
+            **current.fields,
+        )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = RECORDER.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server: Optional[ThreadingHTTPServer] = None
+_server_lock = threading.Lock()
+
+
+def serve_metrics(port: Optional[int] = None) -> Optional[ThreadingHTTPServer]:
+    """Start the /metrics endpoint once per process (no-op when the port is 0)."""
+    global _server
+    port = TELEMETRY_PORT if port is None else port
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            except OSError as e:
+                logger.error(f"Failed to serve metrics on port {port}: {e}")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            logger.info(f"Serving Prometheus metrics on port {port}")
+        return _server
@@ -2,6 +2,8 @@ import sys
 import os
 import unittest.mock as mock
 
+import pytest
+
 # Ensure project root is importable
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -11,8 +13,23 @@ for _mod in [
     "openai",
     "bs4",
     "requests",
+    "requests.adapters",
     "markdownify",
     "st_copy_to_clipboard",
+    "gridfs",
 ]:
     if _mod not in sys.modules:
         sys.modules[_mod] = mock.MagicMock()
+
+
+@pytest.fixture(autouse=True)
+def _clear_tool_cache():
+    """Keep cached tool results and DNS answers from leaking between tests."""
+    import botpage
+    import dns_resolver
+
+    botpage.TOOL_CACHE.clear()
+    dns_resolver.RESOLVER.clear()
+    yield
+    botpage.TOOL_CACHE.clear()
+    dns_resolver.RESOLVER.clear()
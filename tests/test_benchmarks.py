@@ -0,0 +1,107 @@
+import json
+import urllib.request
+
+from benchmarks.bench import RecordingStreamlit, find_regressions, make_session
+from benchmarks.stub_servers import StubLLMServer, StubWebServer, completed_tool_rounds
+
+
+def _events(body: bytes):
+    return [
+        json.loads(line[len(b"data: ") :])
+        for line in body.split(b"\n\n")
+        if line.startswith(b"data: ") and line != b"data: [DONE]"
+    ]
+
+
+class TestFindRegressions:
+    def test_within_tolerance(self):
+        baseline = {"case": {"time_ms": 10.0, "peak_kib": 100.0, "renders": 10}}
+        results = {"case": {"time_ms": 14.0, "peak_kib": 120.0, "renders": 12}}
+        assert find_regressions(results, baseline) == []
+
+    def test_reports_each_regressed_metric(self):
+        baseline = {"case": {"time_ms": 10.0, "peak_kib": 100.0, "renders": 10}}
+        results = {"case": {"time_ms": 20.0, "peak_kib": 100.0, "renders": 20}}
+        regressions = find_regressions(results, baseline)
+        assert len(regressions) == 2
+        assert regressions[0].startswith("case: time_ms 20.0")
+
+    def test_noise_of_millisecond_cases_is_tolerated(self):
+        baseline = {"case": {"time_ms": 2.7}}
+        assert find_regressions({"case": {"time_ms": 4.6}}, baseline) == []
+        assert find_regressions({"case": {"time_ms": 8.0}}, baseline)
+
+    def test_new_cases_are_skipped(self):
+        assert find_regressions({"new": {"time_ms": 1.0}}, {}) == []
+
+    def test_tolerance_override(self):
+        baseline = {"case": {"time_ms": 10.0}}
+        results = {"case": {"time_ms": 14.0}}
+        assert find_regressions(results, baseline, {"time_ms": 0.1})
+
+
+class TestStubServers:
+    def test_make_session_size(self):
+        session = make_session(25)
+        assert len(session["messages"]) == 25
+        assert session["messages"][0]["role"] == "user"
+
+    def test_completed_tool_rounds(self):
+        messages = [
+            {"role": "user", "content": "q"},
+            {"role": "assistant", "content": "", "tool_calls": [{}]},
+            {"role": "tool", "content": "r"},
+        ]
+        assert completed_tool_rounds(messages) == 1
+        assert completed_tool_rounds(messages[:1]) == 0
+
+    def test_llm_streams_tool_round_then_answer(self):
+        with StubLLMServer(web_base_url="http://web", answer_chunks=3) as llm:
+
+            def post(messages):
+                request = urllib.request.Request(
+                    f"{llm.base_url}/v1/chat/completions",
+                    data=json.dumps({"messages": messages, "tools": [{}]}).encode(),
+                    headers={"Content-Type": "application/json"},
+                )
+                with urllib.request.urlopen(request) as response:
+                    return _events(response.read())
+
+            events = post([{"role": "user", "content": "q"}])
+            assert events[-1]["choices"][0]["finish_reason"] == "tool_calls"
+            names = [
+                e["choices"][0]["delta"]["tool_calls"][0]["function"].get("name")
+                for e in events
+                if "tool_calls" in e["choices"][0]["delta"]
+            ]
+            assert "search_web" in names and "fetch_url" in names
+
+            events = post(
+                [
+                    {"role": "user", "content": "q"},
+                    {"role": "assistant", "content": "", "tool_calls": [{}]},
+                ]
+            )
+            content = "".join(
+                e["choices"][0]["delta"].get("content") or "" for e in events
+            )
+            assert content == "token " * 3
+            assert llm.requests == 2
+
+    def test_web_serves_search_and_pages(self):
+        with StubWebServer(page_bytes=1000) as web:
+            with urllib.request.urlopen(f"{web.base_url}/search?q=x") as response:
+                assert b"b_algo" in response.read()
+            with urllib.request.urlopen(f"{web.base_url}/page/3") as response:
+                assert b"Page 3" in response.read()
+
+
+def test_recording_streamlit_counts_renders():
+    st = RecordingStreamlit()
+    with st.chat_message("user"):
+        st.markdown("a")
+    columns = st.columns([6, 1])
+    columns[1].text("b")
+    st.empty().markdown("c")
+    assert st.renders == 3
+    assert st.button("x") is False
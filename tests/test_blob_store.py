@@ -0,0 +1,116 @@
+import hashlib
+
+import pytest
+
+import blob_store
+from blob_store import LocalBlobStore
+from botpage import prepare_messages_for_api
+
+
+@pytest.fixture
+def store(tmp_path):
+    local = LocalBlobStore(str(tmp_path))
+    blob_store.set_store(local)
+    yield local
+    blob_store.set_store(None)
+
+
+class TestRefs:
+    def test_make_and_parse_ref(self):
+        digest = "a" * 64
+        ref = blob_store.make_ref("image/png", digest)
+        assert ref == f"blob:image/png;sha256,{digest}"
+        assert blob_store.parse_ref(ref) == ("image/png", digest)
+
+    def test_plain_strings_are_not_refs(self):
+        assert blob_store.is_ref("blob: hello") is False
+        assert blob_store.is_ref("data:image/png;base64,abc") is False
+        assert blob_store.is_ref(None) is False
+
+
+class TestBlobStore:
+    def test_put_is_content_addressed_and_deduplicated(self, store, tmp_path):
+        ref1 = blob_store.put_blob(b"img", "image/png")
+        ref2 = blob_store.put_blob(b"img", "image/png")
+        digest = hashlib.sha256(b"img").hexdigest()
+        assert ref1 == ref2 == f"blob:image/png;sha256,{digest}"
+        assert len(list(tmp_path.rglob(digest))) == 1
+        assert blob_store.get_blob(ref1) == b"img"
+
+    def test_resolve_data_uri(self, store):
+        ref = blob_store.put_blob(b"img", "image/png")
+        assert blob_store.resolve_data_uri(ref) == "data:image/png;base64,aW1n"
+        assert blob_store.resolve_data_uri("https://x/y.png") == "https://x/y.png"
+
+    def test_small_text_stays_inline(self, store, monkeypatch):
+        monkeypatch.setattr(blob_store, "BLOB_INLINE_MAX_BYTES", 10)
+        assert blob_store.store_text_if_large("short") == "short"
+
+    def test_large_text_round_trips(self, store, monkeypatch):
+        monkeypatch.setattr(blob_store, "BLOB_INLINE_MAX_BYTES", 10)
+        ref = blob_store.store_text_if_large("长" * 20)
+        assert blob_store.is_ref(ref)
+        assert blob_store.resolve_text(ref) == "长" * 20
+
+    def test_missing_blob_resolves_to_empty(self, store):
+        assert (
+            blob_store.resolve_text(blob_store.make_ref("text/plain", "0" * 64)) == ""
+        )
+
+    def test_cache_is_bounded_by_size(self, store, monkeypatch):
+        cache = blob_store._BlobCache(10)
+        monkeypatch.setattr(blob_store, "_BLOB_CACHE", cache)
+        refs = [blob_store.put_blob(data, "image/png") for data in (b"a" * 4, b"b" * 4)]
+        for ref in refs:
+            blob_store.get_blob(ref)
+        assert cache.size == 8
+        big = blob_store.put_blob(b"c" * 11, "image/png")
+        assert blob_store.get_blob(big) == b"c" * 11
+        assert cache.size == 8
+        blob_store.get_blob(blob_store.put_blob(b"d" * 4, "image/png"))
+        # The least recently used blob made room for the new one
+        assert cache.size == 8
+        assert cache.get(hashlib.sha256(b"a" * 4).hexdigest()) is None
+
+
+class TestPrepareMessagesResolvesRefs:
+    def test_tool_and_image_refs_resolved_for_api(self, store, monkeypatch):
+        monkeypatch.setattr(blob_store, "BLOB_INLINE_MAX_BYTES", 1)
+        image_ref = blob_store.put_blob(b"img", "image/png")
+        user_content = [
+            {"type": "text", "text": "look"},
+            {"type": "image_url", "image_url": {"url": image_ref}},
+        ]
+        msgs = [
+            {"role": "user", "content": user_content, "reasoning_content": ""},
+            {
+                "role": "tool",
+                "tool_call_id": "t1",
+                "content": blob_store.store_text_if_large("tool output"),
+                "reasoning_content": "",
+            },
+        ]
+        result = prepare_messages_for_api({"messages": msgs})
+        assert result[0]["content"][1]["image_url"]["url"] == (
+            "data:image/png;base64,aW1n"
+        )
+        assert result[1]["content"] == "tool output"
+        # The session keeps the reference
+        assert user_content[1]["image_url"]["url"] == image_ref
+
+    def test_missing_image_is_dropped_from_the_request(self, store):
+        content = [
+            {"type": "text", "text": "look"},
+            {
+                "type": "image_url",
+                "image_url": {"url": blob_store.make_ref("image/png", "0" * 64)},
+            },
+        ]
+        msgs = [{"role": "user", "content": content, "reasoning_content": ""}]
+        result = prepare_messages_for_api({"messages": msgs})
+        assert result[0]["content"] == [{"type": "text", "text": "look"}]
+
+    def test_user_text_that_looks_like_a_ref_is_not_resolved(self, store):
+        ref = blob_store.put_blob(b"secret", "text/plain")
+        msgs = [{"role": "user", "content": ref, "reasoning_content": ""}]
+        assert prepare_messages_for_api({"messages": msgs})[0]["content"] == ref
@@ -0,0 +1,179 @@
+import threading
+
+import pytest
+
+import bot_management
+from bot_catalog import BotCatalog, read_version
+
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda d: d[key], reverse=direction < 0))
+
+
+class FakeCollection:
+    """The subset of a pymongo collection used by the catalog and bot management."""
+
+    def __init__(self):
+        self.docs = []
+
+    def _match(self, query):
+        return [d for d in self.docs if all(d.get(k) == v for k, v in query.items())]
+
+    def find(self, query=None):
+        return FakeCursor(dict(d) for d in self._match(query or {}))
+
+    def find_one(self, query, projection=None):
+        found = self._match(query)
+        return dict(found[0]) if found else None
+
+    def insert_one(self, doc):
+        self.docs.append(dict(doc))
+
+    def update_one(self, query, update):
+        for doc in self._match(query)[:1]:
+            doc.update(update["$set"])
+
+    def delete_one(self, query):
+        for doc in self._match(query)[:1]:
+            self.docs.remove(doc)
+
+    def delete_many(self, query):
+        for doc in self._match(query):
+            self.docs.remove(doc)
+
+    def find_one_and_update(self, query, update, upsert, return_document):
+        found = self._match(query)
+        if not found:
+            found = [dict(query)]
+            self.docs.append(found[0])
+        for field, amount in update["$inc"].items():
+            found[0][field] = found[0].get(field, 0) + amount
+        return dict(found[0])
+
+
+class FakeDb(dict):
+    def __getitem__(self, name):
+        return self.setdefault(name, FakeCollection())
+
+    __getattr__ = __getitem__
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def db():
+    return FakeDb()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def catalog(clock, monkeypatch):
+    catalog = BotCatalog(check_interval=1.0, clock=clock)
+    monkeypatch.setattr(bot_management, "BOT_CATALOG", catalog)
+    return catalog
+
+
+def _names(bots):
+    return [b["name"] for b in bots]
+
+
+def test_empty_collection_is_seeded_from_config(db, catalog):
+    bots = catalog.bots(db, [{"id": 2, "name": "b"}, {"id": 1, "name": "a"}])
+    assert _names(bots) == ["a", "b"]
+    assert len(db.bots.docs) == 2
+    assert read_version(db) == 1
+
+
+def test_bots_are_loaded_once_while_the_version_is_unchanged(db, catalog, clock):
+    db.bots.insert_one({"id": 1, "name": "a"})
+    for _ in range(3):
+        catalog.bots(db)
+        clock.now += 5
+    assert catalog.loads == 1
+
+
+def test_mutations_from_another_process_are_seen_after_the_interval(db, catalog, clock):
+    db.bots.insert_one({"id": 1, "name": "a"})
+    catalog.bots(db)
+
+    other = BotCatalog(check_interval=1.0, clock=clock)
+    db.bots.update_one({"id": 1}, {"$set": {"name": "renamed"}})
+    other.bump(db)
+
+    assert _names(catalog.bots(db)) == ["a"]
+    clock.now += 1
+    assert _names(catalog.bots(db)) == ["renamed"]
+    assert catalog.loads == 2
+
+
+def test_local_mutations_are_seen_immediately(db, catalog):
+    bot_management.add_bot(db, {"name": "a", "prompt": "p"})
+    assert _names(catalog.bots(db)) == ["a"]
+    bot_id = catalog.bots(db)[0]["id"]
+
+    bot_management.update_bot(db, bot_id, {"name": "b"})
+    assert _names(catalog.bots(db)) == ["b"]
+
+    bot_management.delete_bot(db, bot_id)
+    assert catalog.bots(db) == []
+    assert read_version(db) == 3
+
+
+def test_returned_bots_are_copies(db, catalog):
+    db.bots.insert_one({"id": 1, "name": "a"})
+    catalog.bots(db)[0]["name"] = "changed"
+    assert _names(catalog.bots(db)) == ["a"]
+
+
+def test_cached_bots_served_when_the_version_cannot_be_read(
+    db, catalog, clock, monkeypatch
+):
+    db.bots.insert_one({"id": 1, "name": "a"})
+    catalog.bots(db)
+
+    def _down(*args, **kwargs):
+        raise RuntimeError("mongo down")
+
+    monkeypatch.setattr("bot_catalog.read_version", _down)
+    clock.now += 5
+    assert _names(catalog.bots(db)) == ["a"]
+
+    catalog.invalidate()
+    with pytest.raises(RuntimeError):
+        catalog.bots(db)
+
+
+def test_cached_bots_served_while_another_thread_refreshes(
+    db, catalog, clock, monkeypatch
+):
+    db.bots.insert_one({"id": 1, "name": "a"})
+    catalog.bots(db)
+    clock.now += 5
+
+    entered, release = threading.Event(), threading.Event()
+
+    def _slow_version(db):
+        entered.set()
+        release.wait(5)
+        return 0
+
+    monkeypatch.setattr("bot_catalog.read_version", _slow_version)
+    refresher = threading.Thread(target=catalog.bots, args=(db,))
+    refresher.start()
+    assert entered.wait(5)
+    # The refresh is stuck on the database; other reruns are not
+    assert _names(catalog.bots(db)) == ["a"]
+    release.set()
+    refresher.join(5)
+    assert catalog.loads == 1
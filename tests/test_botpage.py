@@ -1,13 +1,32 @@
+import asyncio
 import logging
 import socket
+import threading
+import time
+from unittest import mock
+from types import SimpleNamespace
+
 import pytest
+import blob_store
 import botpage
+import chat_engine
 from botpage import (
     _get_text_content,
     _is_safe_url,
+    execute_tool_call,
+    display_message_content,
     handle_function_call,
+    history_window_start,
+    prepare_message_render,
     prepare_messages_for_api,
+    MessageRenderCache,
+    PreparedHistory,
+    StreamRenderer,
     process_tool_calls,
+    quote_content,
+    render_tool_calls,
+    save_session_to_db,
+    tool_response_preview,
 )
 
 # ---------------------------------------------------------------------------
@@ -19,6 +38,14 @@ def _session(messages):
     return {"messages": messages}
 
 
+def _tool_call(call_id, name, arguments):
+    return {
+        "id": call_id,
+        "type": "function",
+        "function": {"name": name, "arguments": arguments},
+    }
+
+
 # ---------------------------------------------------------------------------
 # _is_safe_url
 # ---------------------------------------------------------------------------
@@ -41,21 +68,47 @@ class TestIsSafeUrl:
         assert _is_safe_url("http://169.254.169.254/latest/meta-data/") is False
 
     def test_public_ip_allowed(self, monkeypatch):
-        monkeypatch.setattr(socket, "gethostbyname", lambda h: "93.184.216.34")
+        _resolve_to(monkeypatch, "93.184.216.34")
         assert _is_safe_url("https://example.com") is True
 
     def test_internal_hostname_resolving_to_private_ip_blocked(self, monkeypatch):
-        monkeypatch.setattr(socket, "gethostbyname", lambda h: "10.0.0.1")
+        _resolve_to(monkeypatch, "10.0.0.1")
         assert _is_safe_url("https://internal.corp") is False
 
+    def test_any_private_address_blocks_the_host(self, monkeypatch):
+        _resolve_to(monkeypatch, "93.184.216.34", "fd00::1")
+        assert _is_safe_url("https://mixed.example") is False
+
+    def test_ipv6_addresses_are_checked(self, monkeypatch):
+        _resolve_to(monkeypatch, "2606:2800:220:1:248:1893:25c8:1946")
+        assert _is_safe_url("https://v6.example") is True
+        assert _is_safe_url("http://[::1]/") is False
+        assert _is_safe_url("http://[::ffff:127.0.0.1]/") is False
+
     def test_dns_failure_blocked(self, monkeypatch):
-        def _raise(h):
+        def _raise(*args, **kwargs):
             raise socket.gaierror("dns failure")
 
-        monkeypatch.setattr(socket, "gethostbyname", _raise)
+        monkeypatch.setattr(socket, "getaddrinfo", _raise)
         assert _is_safe_url("https://nonexistent.invalid") is False
 
 
+def _resolve_to(monkeypatch, *addresses):
+    def _getaddrinfo(host, port, *args, **kwargs):
+        return [
+            (
+                socket.AF_INET6 if ":" in a else socket.AF_INET,
+                socket.SOCK_STREAM,
+                6,
+                "",
+                (a, 0),
+            )
+            for a in addresses
+        ]
+
+    monkeypatch.setattr(socket, "getaddrinfo", _getaddrinfo)
+
+
 # ---------------------------------------------------------------------------
 # prepare_messages_for_api
 # ---------------------------------------------------------------------------
@@ -227,3 +280,758 @@ class TestHandleFunctionCall:
         monkeypatch.setattr(botpage, "fetch_url", _boom)
         result = handle_function_call("fetch_url", {"url": "https://example.com"})
         assert "error" in result
+
+
+# ---------------------------------------------------------------------------
+# execute_tool_call
+# ---------------------------------------------------------------------------
+
+
+def run_tool_calls(tool_calls, max_workers=botpage.TOOL_CALL_WORKERS):
+    return asyncio.run(
+        chat_engine.run_tool_calls_async(tool_calls, execute_tool_call, max_workers)
+    )
+
+
+class TestRunToolCalls:
+    def test_results_keep_tool_call_order(self, monkeypatch):
+        delays = {"a": 0.05, "b": 0.0, "c": 0.02}
+
+        def _fetch(url):
+            time.sleep(delays[url])
+            return f"page {url}"
+
+        monkeypatch.setattr(botpage, "fetch_url", _fetch)
+        calls = [
+            _tool_call(f"t{key}", "fetch_url", f'{{"url": "{key}"}}')
+            for key in ("a", "b", "c")
+        ]
+        results = run_tool_calls(calls, max_workers=3)
+        assert [tc["id"] for tc, _, _ in results] == ["ta", "tb", "tc"]
+        assert [content for _, content, _ in results] == [
+            "page a",
+            "page b",
+            "page c",
+        ]
+        assert all(isinstance(ms, int) and ms >= 0 for _, _, ms in results)
+
+    def test_sequential_mode_with_single_worker(self, monkeypatch):
+        monkeypatch.setattr(botpage, "fetch_url", lambda url: f"page {url}")
+        calls = [
+            _tool_call("t1", "fetch_url", '{"url": "x"}'),
+            _tool_call("t2", "fetch_url", '{"url": "y"}'),
+        ]
+        results = run_tool_calls(calls, max_workers=1)
+        assert [content for _, content, _ in results] == ["page x", "page y"]
+
+    def test_invalid_arguments_return_error_content(self):
+        results = run_tool_calls([_tool_call("t1", "fetch_url", "{not json")])
+        assert results[0][1] == "URL parameter missing"
+
+    def test_response_truncated_to_limit(self, monkeypatch):
+        monkeypatch.setattr(botpage, "MAX_TOOL_RESPONSE_BYTES", 10)
+        monkeypatch.setattr(botpage, "fetch_url", lambda url: "x" * 100)
+        results = run_tool_calls([_tool_call("t1", "fetch_url", '{"url": "u"}')])
+        assert results[0][1] == "x" * 10
+
+    def test_calls_without_function_are_skipped(self):
+        assert run_tool_calls([{"id": "t1", "function": None}]) == []
+
+
+class TestAsyncOpenAIClient:
+    @pytest.fixture(autouse=True)
+    def clients(self, monkeypatch):
+        monkeypatch.setattr(botpage, "_thread_clients", threading.local())
+        monkeypatch.setattr(botpage, "AsyncOpenAI", lambda **kwargs: object())
+
+    def test_client_reused_per_endpoint(self):
+        client = botpage.get_async_openai_client("k", "https://a/v1")
+        assert botpage.get_async_openai_client("k", "https://a/v1") is client
+        assert botpage.get_async_openai_client("k", "https://b/v1") is not client
+        assert botpage.get_async_openai_client("k2", "https://a/v1") is not client
+
+    def test_each_thread_has_its_own_client(self):
+        client = botpage.get_async_openai_client("k", "https://a/v1")
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(
+                botpage.get_async_openai_client("k", "https://a/v1")
+            )
+        )
+        thread.start()
+        thread.join()
+        assert other[0] is not client
+
+
+# ---------------------------------------------------------------------------
+# fetch_urls
+# ---------------------------------------------------------------------------
+
+
+class TestFetchUrls:
+    def test_pages_fetched_concurrently_in_order(self, monkeypatch):
+        started = []
+
+        def _fetch(url):
+            started.append(url)
+            time.sleep(0.05)
+            return f"page {url}"
+
+        monkeypatch.setattr(botpage, "fetch_url", _fetch)
+        began = time.perf_counter()
+        result = handle_function_call("fetch_urls", {"urls": ["a", "b", "c", "a"]})
+        assert time.perf_counter() - began < 0.14
+        assert sorted(started) == ["a", "b", "c"]
+        assert result["content"] == (
+            "## [1] a\n\npage a\n\n## [2] b\n\npage b\n\n## [3] c\n\npage c"
+        )
+
+    def test_failures_reported_per_url(self, monkeypatch):
+        monkeypatch.setattr(
+            botpage, "fetch_url", lambda url: None if url == "bad" else "ok"
+        )
+        result = handle_function_call("fetch_urls", {"urls": ["good", "bad"]})
+        assert "## [1] good\n\nok" in result["content"]
+        assert "## [2] bad\n\nError: Failed to fetch content" in result["content"]
+
+    def test_all_failures_return_error(self, monkeypatch):
+        monkeypatch.setattr(botpage, "fetch_url", lambda url: None)
+        result = handle_function_call("fetch_urls", {"urls": ["a", "b"]})
+        assert "content" not in result
+        assert "Error: Failed to fetch content from URL: a" in result["error"]
+
+    def test_unsafe_urls_are_rejected(self, monkeypatch):
+        requested = []
+        monkeypatch.setattr(botpage, "http_get", lambda *a, **k: requested.append(a))
+        result = handle_function_call(
+            "fetch_urls", {"urls": ["http://127.0.0.1/", "http://10.0.0.1/"]}
+        )
+        assert result["error"].count("Error:") == 2
+        assert requested == []
+
+    @pytest.mark.parametrize("arguments", [{}, {"urls": []}, {"urls": "a"}])
+    def test_missing_urls_param_returns_error(self, arguments):
+        assert handle_function_call("fetch_urls", arguments) == {
+            "error": "URLs parameter missing"
+        }
+
+    @pytest.mark.parametrize("urls", [[1, 2], ["", None]])
+    def test_no_valid_urls_returns_error(self, urls, monkeypatch):
+        monkeypatch.setattr(botpage, "fetch_urls", None)
+        assert handle_function_call("fetch_urls", {"urls": urls}) == {
+            "error": "No valid URLs given"
+        }
+
+    def test_pages_share_the_response_budget(self, monkeypatch):
+        monkeypatch.setattr(botpage, "MAX_TOOL_RESPONSE_BYTES", 1000)
+        pages = {"short": "s" * 50, "long1": "x" * 5000, "long2": "y" * 5000}
+        monkeypatch.setattr(botpage, "fetch_url", pages.get)
+        content = handle_function_call("fetch_urls", {"urls": list(pages)})["content"]
+        assert len(content) <= 1000
+        assert "s" * 50 + "\n\n" in content
+        # The long pages split what the short one left over
+        assert content.count("x") == content.count("y") > 300
+        assert content.count("[Truncated to fit the shared response budget.]") == 2
+
+    def test_urls_beyond_the_limit_are_skipped(self, monkeypatch):
+        monkeypatch.setattr(botpage, "FETCH_URLS_MAX", 2)
+        monkeypatch.setattr(botpage, "fetch_url", lambda url: f"page {url}")
+        content = handle_function_call("fetch_urls", {"urls": ["a", "b", "c"]})[
+            "content"
+        ]
+        assert "## [2] b" in content and "page c" not in content
+        assert content.endswith("[Skipped 1 URLs beyond the limit of 2.]")
+
+
+def test_share_budget():
+    assert botpage._share_budget([10, 100, 100], 110) == [10, 50, 50]
+    assert botpage._share_budget([10, 20], 100) == [10, 20]
+    assert botpage._share_budget([10, 20], -5) == [0, 0]
+
+
+# ---------------------------------------------------------------------------
+# fetch_url
+# ---------------------------------------------------------------------------
+
+
+class TestFetchUrl:
+    def test_unsafe_url_never_requested(self, monkeypatch):
+        requested = []
+        monkeypatch.setattr(botpage, "http_get", lambda *a, **k: requested.append(a))
+        assert botpage.fetch_url("http://127.0.0.1/admin") is None
+        assert requested == []
+
+    def test_redirect_is_not_followed(self, monkeypatch):
+        class _Redirect:
+            is_redirect = True
+            headers = {"Location": "http://169.254.169.254/"}
+
+            def close(self):
+                pass
+
+        seen = {}
+
+        def _get(url, **kwargs):
+            seen.update(kwargs)
+            return _Redirect()
+
+        monkeypatch.setattr(botpage, "_safe_addresses", lambda url: ["93.184.216.34"])
+        monkeypatch.setattr(botpage, "http_get", _get)
+        assert botpage.fetch_url("https://example.com") is None
+        assert seen["allow_redirects"] is False
+
+    def _serve(self, monkeypatch, response):
+        monkeypatch.setattr(botpage, "_safe_addresses", lambda url: ["93.184.216.34"])
+        monkeypatch.setattr(botpage, "http_get", lambda url, **kwargs: response)
+
+    def test_body_is_streamed_up_to_the_cap(self, monkeypatch):
+        response = _FakePage(b"<p>" + b"x" * 100 + b"</p>", chunk_size=10)
+        self._serve(monkeypatch, response)
+        monkeypatch.setattr(botpage, "FETCH_MAX_BYTES", 25)
+        parsed = []
+        monkeypatch.setattr(
+            botpage.extraction,
+            "html_to_markdown",
+            lambda data, charset, url: parsed.append(data) or "text",
+        )
+
+        content = botpage.fetch_url("https://example.com")
+
+        assert parsed == [b"<p>" + b"x" * 22]
+        # Only the chunks needed to pass the cap were read
+        assert response.chunks_read == 3
+        assert response.closed
+        assert content.startswith("text\n\n[Truncated:")
+
+    def test_small_page_is_not_flagged(self, monkeypatch):
+        self._serve(monkeypatch, _FakePage(b"<p>hi</p>"))
+        calls = []
+        monkeypatch.setattr(
+            botpage.extraction,
+            "html_to_markdown",
+            lambda *args: calls.append(args) or "hi",
+        )
+        assert botpage.fetch_url("https://example.com") == "hi"
+        # The charset comes from the Content-Type header
+        assert calls == [(b"<p>hi</p>", "utf-8", "https://example.com")]
+
+    def test_request_connects_to_the_checked_addresses(self, monkeypatch):
+        _resolve_to(monkeypatch, "93.184.216.34")
+        seen = []
+
+        def _get(url, **kwargs):
+            # A rebinding DNS answer must not reach the connection
+            _resolve_to(monkeypatch, "10.0.0.1")
+            seen.append(botpage.dns_resolver.connect_addresses("example.com"))
+            return _FakePage(b"<p>hi</p>")
+
+        monkeypatch.setattr(botpage, "http_get", _get)
+        monkeypatch.setattr(botpage.dns_resolver.RESOLVER, "ttl", 0)
+        monkeypatch.setattr(botpage.extraction, "html_to_markdown", lambda *a: "hi")
+
+        assert botpage.fetch_url("https://example.com/page") == "hi"
+        assert seen == [["93.184.216.34"]]
+
+    def test_non_html_content_type_is_rejected(self, monkeypatch):
+        response = _FakePage(b"%PDF-1.7", content_type="application/pdf")
+        self._serve(monkeypatch, response)
+
+        result = handle_function_call("fetch_url", {"url": "https://example.com/a"})
+
+        assert "application/pdf" in result["error"]
+        assert response.chunks_read == 0
+        assert response.closed
+
+    def test_trim_partial_utf8(self):
+        text = "中文".encode("utf-8")
+        assert botpage._trim_partial_utf8(text) == text
+        assert botpage._trim_partial_utf8(text[:-1]) == text[:3]
+        assert botpage._trim_partial_utf8(text[:4]) == text[:3]
+        assert botpage._trim_partial_utf8(b"abc") == b"abc"
+
+
+class _FakePage:
+    is_redirect = False
+    encoding = "utf-8"
+
+    def __init__(self, body, content_type="text/html; charset=utf-8", chunk_size=4):
+        self.body = body
+        self.headers = {"Content-Type": content_type}
+        self.chunk_size = chunk_size
+        self.chunks_read = 0
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), self.chunk_size):
+            self.chunks_read += 1
+            yield self.body[i : i + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+# ---------------------------------------------------------------------------
+# save_session_to_db
+# ---------------------------------------------------------------------------
+
+
+class _FakeSessions:
+    """Applies the subset of MongoDB update semantics used by save_session_to_db."""
+
+    def __init__(self):
+        self.docs = {}
+        self.updates = []
+
+    def update_one(self, query, update, upsert=False):
+        self.updates.append(update)
+        doc = self.docs.setdefault(query["id"], {"id": query["id"]})
+        doc.update(update.get("$set", {}))
+        push = update.get("$push", {}).get("messages")
+        if push:
+            array = doc.setdefault("messages", [])
+            position = push.get("$position", len(array))
+            array[position:position] = push["$each"]
+            del array[push["$slice"] :]
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+
+class _FakeDb:
+    def __init__(self):
+        self.sessions = _FakeSessions()
+
+
+def _new_session():
+    return {
+        "id": 1,
+        "user": "u",
+        "name": "n",
+        "bot_id": 1,
+        "messages": [],
+        "message_count": 0,
+    }
+
+
+def _msg(role, content):
+    return {"role": role, "content": content, "reasoning_content": ""}
+
+
+def _save(db, session, dirty_from=None):
+    save_session_to_db(db, session, dirty_from)
+    botpage.SESSION_WRITER.flush()
+
+
+class TestSaveSessionToDb:
+    def test_appends_only_new_messages(self):
+        db, session = _FakeDb(), _new_session()
+        session["messages"] += [_msg("user", "q"), _msg("assistant", "a")]
+        _save(db, session)
+        session["messages"].append(_msg("truncation", ""))
+        _save(db, session)
+        last_push = db.sessions.updates[-1]["$push"]["messages"]
+        assert last_push["$each"] == [_msg("truncation", "")]
+        assert "messages" not in db.sessions.updates[-1]["$set"]
+        assert db.sessions.docs[1]["messages"] == session["messages"]
+        assert session["message_count"] == 3
+
+    def test_pop_trims_stored_array(self):
+        db, session = _FakeDb(), _new_session()
+        session["messages"] += [_msg("user", "q"), _msg("assistant", "a")]
+        _save(db, session)
+        session["messages"].pop()
+        _save(db, session)
+        assert db.sessions.updates[-1]["$push"]["messages"]["$each"] == []
+        assert db.sessions.docs[1]["messages"] == [_msg("user", "q")]
+
+    def test_edit_rewrites_from_dirty_index(self):
+        db, session = _FakeDb(), _new_session()
+        session["messages"] += [
+            _msg("user", "q1"),
+            _msg("assistant", "a1"),
+            _msg("user", "q2"),
+            _msg("assistant", "a2"),
+        ]
+        _save(db, session)
+        session["messages"][2]["content"] = "edited"
+        session["messages"] = session["messages"][:3]
+        _save(db, session, dirty_from=2)
+        assert db.sessions.updates[-1]["$push"]["messages"]["$each"] == [
+            _msg("user", "edited")
+        ]
+        assert db.sessions.docs[1]["messages"] == session["messages"]
+
+    def test_legacy_session_without_count_rewrites_full_array(self):
+        db, session = _FakeDb(), _new_session()
+        del session["message_count"]
+        session["messages"].append(_msg("user", "q"))
+        _save(db, session)
+        assert db.sessions.updates[-1]["$set"]["messages"] == session["messages"]
+        assert "$push" not in db.sessions.updates[-1]
+        assert session["message_count"] == 1
+
+    def test_empty_session_not_saved(self):
+        db = _FakeDb()
+        _save(db, _new_session())
+        assert db.sessions.updates == []
+
+    def test_saves_are_written_in_the_background(self):
+        db, session = _FakeDb(), _new_session()
+        session["messages"].append(_msg("user", "q"))
+        save_session_to_db(db, session)
+        assert session["message_count"] == 1
+        deadline = time.monotonic() + 5
+        while 1 not in db.sessions.docs and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert db.sessions.docs[1]["messages"] == session["messages"]
+
+
+# ---------------------------------------------------------------------------
+# StreamRenderer
+# ---------------------------------------------------------------------------
+
+
+class _FakeContainer:
+    def __init__(self):
+        self.rendered = []
+
+    def markdown(self, content):
+        self.rendered.append(content)
+
+
+def _chunk(content=None, reasoning=None, tool_calls=None):
+    delta = SimpleNamespace(
+        content=content, reasoning_content=reasoning, tool_calls=tool_calls
+    )
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class _FakeStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+    async def close(self):
+        pass
+
+
+class _RenderingCallbacks(chat_engine.TurnCallbacks):
+    def __init__(self, renderer):
+        self.renderer = renderer
+
+    def on_delta(self, content, reasoning, tool_progress, tool_calls):
+        self.renderer.feed(content, reasoning, tool_progress)
+        self.renderer.update(tool_calls)
+
+
+def render_stream(chunks, renderer):
+    """Stream the chunks through chat_engine into the renderer, like a live turn."""
+
+    async def _create(**request):
+        return _FakeStream(chunks)
+
+    client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=_create))
+    )
+    response, reasoning, tool_calls, _ = asyncio.run(
+        chat_engine.stream_completion(client, {}, _RenderingCallbacks(renderer))
+    )
+    renderer.finish(tool_calls)
+    return response, reasoning, list(tool_calls.values())
+
+
+class TestStreamRenderer:
+    @pytest.fixture
+    def container(self, monkeypatch):
+        container = _FakeContainer()
+        monkeypatch.setattr(botpage.st, "empty", lambda: container)
+        return container
+
+    def test_renders_are_coalesced_and_final_flush_is_exact(self, container):
+        reasoning = ["step one\n", "step ", "two\n\nstep three"]
+        content = ["Hello", ", ", "world", "!"]
+        stream = [_chunk(reasoning=r) for r in reasoning] + [
+            _chunk(content=c) for c in content
+        ]
+        renderer = StreamRenderer(interval=3600, min_chars=10_000)
+        response, reasoning_response, tool_calls = render_stream(stream, renderer)
+
+        assert response == "Hello, world!"
+        assert reasoning_response == "".join(reasoning)
+        assert tool_calls == []
+        # First chunk plus the final flush only
+        assert renderer.render_count == 2
+        assert container.rendered[-1] == (
+            quote_content(reasoning_response) + "\n\n" + response
+        )
+
+    def test_flushes_when_enough_characters_are_pending(self, container):
+        stream = [_chunk(content="x" * 5) for _ in range(10)]
+        renderer = StreamRenderer(interval=3600, min_chars=10)
+        render_stream(stream, renderer)
+        # first chunk, every second chunk after it, and the final flush
+        assert renderer.render_count == 1 + 4 + 1
+        assert container.rendered[1].endswith(" | ")
+
+    def test_tool_calls_rendered_on_final_flush(self, container):
+        function = SimpleNamespace(name="fetch_url", arguments='{"url":')
+        first = SimpleNamespace(index=0, id="t1", function=function)
+        second = SimpleNamespace(
+            index=0, id=None, function=SimpleNamespace(name=None, arguments='"u"}')
+        )
+        stream = [_chunk(tool_calls=[first]), _chunk(tool_calls=[second])]
+        renderer = StreamRenderer(interval=3600, min_chars=10_000)
+        _, _, tool_calls = render_stream(stream, renderer)
+        assert tool_calls[0]["function"]["arguments"] == '{"url":"u"}'
+        assert container.rendered[-1] == render_tool_calls({0: tool_calls[0]})
+
+    @pytest.mark.parametrize(
+        "pieces",
+        [
+            ["a\nb", "\nc"],
+            ["line\r", "\nnext"],
+            ["\n", "\n", "x"],
+            ["end\n"],
+            ["x y", "z"],
+            ["", "a", "\r"],
+        ],
+    )
+    def test_incremental_quote_matches_quote_content(self, pieces):
+        renderer = StreamRenderer()
+        for piece in pieces:
+            renderer.feed(reasoning=piece)
+            assert renderer._quoted_reasoning() == quote_content(renderer.reasoning)
+
+
+# ---------------------------------------------------------------------------
+# History window / tool response previews
+# ---------------------------------------------------------------------------
+
+
+class TestHistoryWindow:
+    def test_short_history_fully_shown(self):
+        assert history_window_start(5, 40) == 0
+
+    def test_long_history_shows_latest_messages(self):
+        assert history_window_start(100, 40) == 60
+
+
+class TestToolResponsePreview:
+    def test_short_response_shown_inline(self):
+        assert tool_response_preview({"content": "short"}, limit=10) is None
+
+    def test_long_response_previewed(self):
+        assert tool_response_preview({"content": "x" * 20}, limit=10) == "x" * 10
+
+    def test_blob_reference_shows_its_stored_preview(self):
+        ref = "blob:text/plain;sha256," + "0" * 64
+        msg = {"content": ref, "preview": "start of the page"}
+        assert tool_response_preview(msg, limit=10) == "start of the page"
+
+    def test_blob_reference_without_preview_is_empty(self):
+        ref = "blob:text/plain;sha256," + "0" * 64
+        assert tool_response_preview({"content": ref}, limit=10) == ""
+
+
+# ---------------------------------------------------------------------------
+# Message render cache
+# ---------------------------------------------------------------------------
+
+
+class TestPrepareMessageRender:
+    def test_reasoning_text_and_tool_calls(self):
+        msg = {
+            "role": "assistant",
+            "content": "answer",
+            "reasoning_content": "think",
+            "tool_calls": [_tool_call("t1", "fetch_url", '{"url":"u"}')],
+        }
+        markdown, svgs = prepare_message_render(msg)
+        assert markdown == (
+            "> think\n\nanswer\n\n**Tool Calls:**\n" '- **fetch_url**: {"url":"u"}\n'
+        )
+        assert svgs == ()
+
+    def test_svg_converted_to_data_uri(self):
+        msg = {"role": "assistant", "content": "<svg a='1'><g/></svg>"}
+        _, svgs = prepare_message_render(msg)
+        assert svgs == ("data:image/svg+xml;base64,PHN2ZyBhPScxJz48Zy8+PC9zdmc+",)
+
+
+class TestMessageRenderCache:
+    def test_identical_content_hits(self):
+        cache = MessageRenderCache(10)
+        first = cache.prepare({"role": "assistant", "content": "hi"})
+        second = cache.prepare({"role": "assistant", "content": "hi"})
+        assert first == second
+        assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "size": 1}
+
+    def test_changed_content_misses(self):
+        cache = MessageRenderCache(10)
+        cache.prepare({"role": "user", "content": "a"})
+        cache.prepare({"role": "user", "content": "b"})
+        assert cache.stats()["misses"] == 2
+
+    def test_bounded_size(self):
+        cache = MessageRenderCache(2)
+        for text in ("a", "b", "c"):
+            cache.prepare({"role": "user", "content": text})
+        assert cache.stats()["size"] == 2
+
+    def test_disabled_cache_still_renders(self):
+        cache = MessageRenderCache(0)
+        markdown, _ = cache.prepare({"role": "user", "content": "a"})
+        assert markdown == "a"
+        assert cache.stats()["size"] == 0
+
+
+class _SessionState(dict):
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+
+
+class TestDisplayToolResponse:
+    @pytest.fixture
+    def st(self, monkeypatch):
+        for name in ("expander", "text", "button", "rerun"):
+            monkeypatch.setattr(botpage.st, name, mock.MagicMock())
+        monkeypatch.setattr(botpage.st, "session_state", _SessionState())
+        botpage.st.button.return_value = False
+        return botpage.st
+
+    def _tool_msg(self):
+        return {"role": "tool", "tool_call_id": "t1", "content": "x" * 1000}
+
+    def test_buttons_are_keyed_by_message_index(self, st):
+        # Providers may repeat (or omit) tool call ids within a session
+        display_message_content(self._tool_msg(), 3)
+        display_message_content(self._tool_msg(), 5)
+        keys = [call.kwargs["key"] for call in st.button.call_args_list]
+        assert keys == ["load_tool_3", "load_tool_5"]
+
+    def test_loading_expands_only_that_message(self, st):
+        st.button.return_value = True
+        display_message_content(self._tool_msg(), 3)
+        assert st.session_state.loaded_tool_responses == {3}
+
+        st.button.reset_mock()
+        st.text.reset_mock()
+        display_message_content(self._tool_msg(), 5)
+        display_message_content(self._tool_msg(), 3)
+        st.text.assert_called_with("x" * 1000)
+        assert st.button.call_count == 1
+
+
+_IMAGE_REF = blob_store.make_ref("image/png", "0" * 64)
+
+
+class TestDisplayMessageContent:
+    @pytest.fixture
+    def st(self, monkeypatch):
+        for name in ("markdown", "image", "warning"):
+            monkeypatch.setattr(botpage.st, name, mock.MagicMock())
+        return botpage.st
+
+    def _image_msg(self, url):
+        return {
+            "role": "user",
+            "content": [{"type": "image_url", "image_url": {"url": url}}],
+        }
+
+    def test_blob_image_is_shown(self, st, monkeypatch):
+        monkeypatch.setattr(blob_store, "get_blob", lambda ref: b"png")
+        display_message_content(self._image_msg(_IMAGE_REF))
+        st.image.assert_called_once_with(b"png")
+        st.warning.assert_not_called()
+
+    def test_missing_blob_shows_a_warning(self, st, monkeypatch):
+        def _missing(ref):
+            raise FileNotFoundError(ref)
+
+        monkeypatch.setattr(blob_store, "get_blob", _missing)
+        display_message_content(self._image_msg(_IMAGE_REF))
+        st.image.assert_not_called()
+        st.warning.assert_called_once_with("图片加载失败")
+
+
+# ---------------------------------------------------------------------------
+# PreparedHistory
+# ---------------------------------------------------------------------------
+
+
+class TestPreparedHistory:
+    def _check(self, history, messages, **kwargs):
+        assert history.sync(messages, **kwargs) == prepare_messages_for_api(
+            _session(messages)
+        )
+
+    def test_append_pop_and_truncation(self):
+        history, messages = PreparedHistory(), []
+        self._check(history, messages)
+        messages += [_msg("user", "q1"), _msg("assistant", "a1")]
+        self._check(history, messages)
+        messages.append(_msg("truncation", ""))
+        self._check(history, messages)
+        messages += [
+            _msg("user", [{"type": "text", "text": "q2"}]),
+            _msg("assistant", "a2"),
+        ]
+        self._check(history, messages)
+        messages.pop()
+        self._check(history, messages)
+        # Removing the truncation marker restores the older history
+        del messages[2:]
+        self._check(history, messages)
+
+    def test_in_place_edit_detected(self):
+        history = PreparedHistory()
+        messages = [_msg("user", "q1"), _msg("assistant", "a1"), _msg("user", "q2")]
+        self._check(history, messages)
+        messages[2]["content"] = "edited"
+        self._check(history, messages)
+        messages = messages[:1]
+        messages[0]["content"] = "first edited"
+        self._check(history, messages)
+
+    def test_tool_messages_and_dirty_from(self):
+        history = PreparedHistory()
+        messages = [
+            _msg("user", "q"),
+            {
+                "role": "assistant",
+                "content": "",
+                "reasoning_content": "",
+                "tool_calls": [_tool_call("t1", "fetch_url", "{}")],
+            },
+            {
+                "role": "tool",
+                "tool_call_id": "t1",
+                "content": "r",
+                "reasoning_content": "",
+            },
+        ]
+        self._check(history, messages)
+        self._check(history, messages, dirty_from=0)
+
+    def test_cached_items_not_mutated_by_wrapping(self):
+        history = PreparedHistory()
+        messages = [_msg("truncation", ""), _msg("user", "q")]
+        first = history.sync(messages)
+        second = history.sync(messages)
+        assert (
+            first
+            == second
+            == [{"role": "user", "content": "<user_input>q</user_input>"}]
+        )
@@ -0,0 +1,194 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import chat_engine
+from chat_engine import TurnCallbacks, run_chat_turn, stream_completion
+
+
+def _chunk(content=None, reasoning=None, tool_calls=None):
+    delta = SimpleNamespace(
+        content=content, reasoning_content=reasoning, tool_calls=tool_calls
+    )
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+def _tool_delta(index, call_id, name, arguments):
+    return SimpleNamespace(
+        index=index,
+        id=call_id,
+        function=SimpleNamespace(name=name, arguments=arguments),
+    )
+
+
+class FakeStream:
+    def __init__(self, chunks, delay=0.0):
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeClient:
+    """Async client returning one scripted stream per request."""
+
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **request):
+        self.requests.append(request)
+        return self.streams.pop(0)
+
+
+class RecordingCallbacks(TurnCallbacks):
+    def __init__(self, stop_after=None):
+        self.deltas = []
+        self.messages = []
+        self.ticks = 0
+        self.stop_after = stop_after
+
+    def on_delta(self, content, reasoning, tool_progress, tool_calls):
+        self.deltas.append((content, reasoning))
+
+    def on_tick(self, tool_calls):
+        self.ticks += 1
+
+    def on_assistant_message(self, message, tool_calls):
+        self.messages.append(message)
+
+    def on_tool_message(self, message, duration_ms):
+        self.messages.append(message)
+
+    def should_stop(self):
+        return self.stop_after is not None and len(self.deltas) >= self.stop_after
+
+
+class TestStreamCompletion:
+    def test_collects_content_reasoning_and_closes_stream(self):
+        stream = FakeStream(
+            [_chunk(reasoning="think"), _chunk(content="Hel"), _chunk(content="lo")]
+        )
+        callbacks = RecordingCallbacks()
+        result = asyncio.run(
+            stream_completion(FakeClient([stream]), {"model": "m"}, callbacks)
+        )
+        assert result == ("Hello", "think", {}, False)
+        assert stream.closed
+        assert callbacks.deltas == [("", "think"), ("Hel", ""), ("lo", "")]
+
+    def test_stop_closes_stream_early(self):
+        stream = FakeStream([_chunk(content=str(i)) for i in range(10)])
+        callbacks = RecordingCallbacks(stop_after=2)
+        content, _, _, stopped = asyncio.run(
+            stream_completion(FakeClient([stream]), {}, callbacks)
+        )
+        assert stopped
+        assert content == "01"
+        assert stream.closed
+        assert len(stream.chunks) == 8
+
+    def test_exception_from_callback_closes_stream(self):
+        class Interrupt(BaseException):
+            pass
+
+        class Raising(RecordingCallbacks):
+            def on_delta(self, *args):
+                raise Interrupt()
+
+        stream = FakeStream([_chunk(content="a"), _chunk(content="b")])
+        with pytest.raises(Interrupt):
+            asyncio.run(stream_completion(FakeClient([stream]), {}, Raising()))
+        assert stream.closed
+
+    def test_ticks_while_waiting(self, monkeypatch):
+        monkeypatch.setattr(chat_engine, "STREAM_TICK_SECONDS", 0.01)
+        stream = FakeStream([_chunk(content="a")], delay=0.05)
+        callbacks = RecordingCallbacks()
+        asyncio.run(stream_completion(FakeClient([stream]), {}, callbacks))
+        assert callbacks.ticks >= 1
+
+
+class TestRunChatTurn:
+    def _run(self, client, callbacks, history, execute=None, max_rounds=10):
+        return asyncio.run(
+            run_chat_turn(
+                client,
+                "m",
+                history,
+                None,
+                lambda h: list(h),
+                execute or (lambda tc: (f"result {tc['id']}", 1)),
+                callbacks,
+                max_rounds=max_rounds,
+                max_workers=4,
+            )
+        )
+
+    def test_tool_round_then_answer(self):
+        client = FakeClient(
+            [
+                FakeStream(
+                    [
+                        _chunk(tool_calls=[_tool_delta(0, "t1", "fetch_url", "{}")]),
+                        _chunk(tool_calls=[_tool_delta(1, "t2", "fetch_url", "{}")]),
+                    ]
+                ),
+                FakeStream([_chunk(content="done")]),
+            ]
+        )
+        callbacks = RecordingCallbacks()
+        history = [{"role": "user", "content": "q"}]
+        stopped = self._run(client, callbacks, history)
+        assert not stopped
+        assert [m["role"] for m in history] == [
+            "user",
+            "assistant",
+            "tool",
+            "tool",
+            "assistant",
+        ]
+        assert [m["content"] for m in history[2:4]] == ["result t1", "result t2"]
+        assert callbacks.messages[-1]["content"] == "done"
+        # The second request includes the tool results
+        assert len(client.requests[1]["messages"]) == 4
+
+    def test_stopped_round_drops_tool_calls(self):
+        client = FakeClient(
+            [
+                FakeStream(
+                    [
+                        _chunk(content="partial"),
+                        _chunk(tool_calls=[_tool_delta(0, "t1", "fetch_url", "{")]),
+                        _chunk(content="never"),
+                    ]
+                )
+            ]
+        )
+        callbacks = RecordingCallbacks(stop_after=2)
+        history = [{"role": "user", "content": "q"}]
+        assert self._run(client, callbacks, history) is True
+        assert history[-1] == {"role": "assistant", "content": "partial"}
+
+    def test_max_rounds(self):
+        tool_stream = lambda: FakeStream(
+            [_chunk(tool_calls=[_tool_delta(0, "t1", "fetch_url", "{}")])]
+        )
+        client = FakeClient([tool_stream(), tool_stream()])
+        history = [{"role": "user", "content": "q"}]
+        self._run(client, RecordingCallbacks(), history, max_rounds=1)
+        assert [m["role"] for m in history] == ["user", "assistant"]
@@ -0,0 +1,148 @@
+import asyncio
+from unittest import mock
+
+import bot_management
+from chat_engine import run_chat_turn
+from completion_cache import CompletionCache
+from test_chat_engine import (
+    FakeClient,
+    FakeStream,
+    RecordingCallbacks,
+    _chunk,
+    _tool_delta,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _request(system="You are an FAQ bot.", question="How do I reset my password?"):
+    return {
+        "model": "m",
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": question},
+        ],
+        "tools": None,
+        "timeout": 300,
+    }
+
+
+COMPLETION = {"content": "Click 'Forgot password'.", "reasoning": "", "tool_calls": {}}
+
+
+def test_hit_requires_identical_request():
+    cache = CompletionCache(ttl=60, max_entries=10)
+    cache.put(1, _request(), COMPLETION)
+
+    assert cache.get(1, {**_request(), "timeout": 5}) == COMPLETION
+    assert cache.get(1, _request(system="You are a pirate.")) is None
+    assert cache.get(1, _request(question="How do I log in?")) is None
+    assert cache.get(1, {**_request(), "model": "other"}) is None
+    assert cache.get(2, _request()) is None
+
+
+def test_returned_completion_is_a_copy():
+    cache = CompletionCache(ttl=60, max_entries=10)
+    cache.put(1, _request(), COMPLETION)
+    cache.get(1, _request())["content"] = "changed"
+    assert cache.get(1, _request()) == COMPLETION
+
+
+def test_ttl_and_size_eviction():
+    clock = FakeClock()
+    cache = CompletionCache(ttl=60, max_entries=2, clock=clock)
+    cache.put(1, _request(question="a"), COMPLETION)
+    cache.put(1, _request(question="b"), COMPLETION)
+    cache.get(1, _request(question="a"))
+    cache.put(1, _request(question="c"), COMPLETION)
+
+    # "b" was the least recently used entry
+    assert cache.get(1, _request(question="b")) is None
+    assert cache.get(1, _request(question="a")) is not None
+
+    clock.now = 61
+    assert cache.get(1, _request(question="c")) is None
+
+
+def test_disabled_with_zero_ttl():
+    cache = CompletionCache(ttl=0, max_entries=10)
+    cache.put(1, _request(), COMPLETION)
+    assert cache.get(1, _request()) is None
+
+
+def test_invalidate_bot_and_stats():
+    cache = CompletionCache(ttl=60, max_entries=10)
+    cache.put(1, _request(question="a"), COMPLETION)
+    cache.put(1, _request(question="b"), COMPLETION)
+    cache.put(2, _request(question="a"), COMPLETION)
+    cache.get(1, _request(question="a"))
+    cache.get(1, _request(question="z"))
+
+    assert cache.stats()["1"] == {"hits": 1, "misses": 1, "hit_rate": 0.5, "size": 2}
+    assert cache.invalidate_bot(1) == 2
+    assert cache.get(1, _request(question="a")) is None
+    assert cache.get(2, _request(question="a")) is not None
+    assert cache.stats()["1"]["size"] == 0
+
+
+def _turn(client, cache, callbacks):
+    return asyncio.run(
+        run_chat_turn(
+            client,
+            "m",
+            [{"role": "user", "content": "q"}],
+            [{"type": "function"}],
+            lambda history: list(history),
+            lambda tool_call: ("result", 1),
+            callbacks,
+            max_rounds=5,
+            max_workers=1,
+            cache=cache,
+        )
+    )
+
+
+def test_run_chat_turn_replays_cached_rounds():
+    cache = CompletionCache(ttl=60, max_entries=10).for_bot(1)
+    first = FakeClient(
+        [
+            FakeStream(
+                [_chunk(tool_calls=[_tool_delta(0, "c0", "search_web", '{"q": 1}')])]
+            ),
+            FakeStream([_chunk(reasoning="think"), _chunk(content="answer")]),
+        ]
+    )
+    recorded = RecordingCallbacks()
+    _turn(first, cache, recorded)
+
+    # The provider is not called again: the client has no streams left
+    replayed = RecordingCallbacks()
+    _turn(FakeClient([]), cache, replayed)
+
+    assert replayed.messages == recorded.messages
+    assert replayed.messages[-1]["content"] == "answer"
+    assert replayed.messages[-1]["reasoning_content"] == "think"
+    assert ("", "think") in replayed.deltas and ("answer", "") in replayed.deltas
+
+
+def test_stopped_completion_is_not_cached():
+    cache = CompletionCache(ttl=60, max_entries=10)
+    client = FakeClient([FakeStream([_chunk(content="a"), _chunk(content="b")])])
+    assert _turn(client, cache.for_bot(1), RecordingCallbacks(stop_after=1)) is True
+    assert cache.stats()["1"]["size"] == 0
+
+
+def test_update_bot_invalidates_cache(monkeypatch):
+    cache = CompletionCache(ttl=60, max_entries=10)
+    cache.put(7, _request(), COMPLETION)
+    monkeypatch.setattr(bot_management, "COMPLETION_CACHE", cache)
+
+    bot_management.update_bot(mock.MagicMock(), 7, {"prompt": "new"})
+
+    assert cache.get(7, _request()) is None
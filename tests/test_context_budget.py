@@ -0,0 +1,120 @@
+from botpage import build_request_messages
+from context_budget import (
+    IMAGE_TOKENS,
+    MESSAGE_OVERHEAD_TOKENS,
+    assemble_context,
+    estimate_message_tokens,
+    estimate_text_tokens,
+)
+
+
+def _user(text):
+    return {"role": "user", "content": text}
+
+
+def _assistant(text, tool_call_ids=()):
+    msg = {"role": "assistant", "content": text}
+    if tool_call_ids:
+        msg["tool_calls"] = [
+            {
+                "id": call_id,
+                "type": "function",
+                "function": {"name": "fetch_url", "arguments": "{}"},
+            }
+            for call_id in tool_call_ids
+        ]
+    return msg
+
+
+def _tool(call_id, text):
+    return {"role": "tool", "tool_call_id": call_id, "content": text}
+
+
+def _total(messages):
+    return sum(estimate_message_tokens(m) for m in messages)
+
+
+class TestEstimate:
+    def test_latin_text_four_chars_per_token(self):
+        assert estimate_text_tokens("abcdefgh") == 2
+
+    def test_cjk_one_token_per_char(self):
+        assert estimate_text_tokens("你好世界") == 4
+
+    def test_image_parts_have_fixed_cost(self):
+        msg = {
+            "role": "user",
+            "content": [{"type": "image_url", "image_url": {"url": "data:..."}}],
+        }
+        assert estimate_message_tokens(msg) == MESSAGE_OVERHEAD_TOKENS + IMAGE_TOKENS
+
+
+class TestAssembleContext:
+    def test_within_budget_unchanged(self):
+        messages = [_user("hi"), _assistant("hello")]
+        assert assemble_context(messages, 1000) == (messages, 0)
+
+    def test_stale_tool_outputs_elided_first(self):
+        messages = [
+            _user("q1"),
+            _assistant("", ["t1"]),
+            _tool("t1", "x" * 4000),
+            _assistant("a1"),
+            _user("q2"),
+        ]
+        result, saved = assemble_context(messages, 200)
+        assert len(result) == len(messages)
+        assert result[2]["tool_call_id"] == "t1"
+        assert "省略" in result[2]["content"]
+        assert saved == _total(messages) - _total(result)
+        # The input is not modified
+        assert messages[2]["content"] == "x" * 4000
+
+    def test_oldest_turns_dropped_whole(self):
+        messages = [
+            _user("a" * 400),
+            _assistant("b" * 400),
+            _user("c" * 400),
+            _assistant("d" * 400),
+            _user("q"),
+        ]
+        result, saved = assemble_context(messages, 250)
+        assert result == messages[2:]
+        assert saved > 0
+
+    def test_tool_call_pairs_stay_valid(self):
+        messages = [
+            _user("a" * 400),
+            _assistant("", ["t1"]),
+            _tool("t1", "short"),
+            _assistant("b" * 400),
+            _user("q"),
+        ]
+        result, _ = assemble_context(messages, 20)
+        call_ids = {
+            tc["id"] for m in result if m.get("tool_calls") for tc in m["tool_calls"]
+        }
+        assert all(m["tool_call_id"] in call_ids for m in result if m["role"] == "tool")
+        assert result[0]["role"] == "user"
+
+    def test_current_round_tool_outputs_kept(self):
+        messages = [_user("q"), _assistant("", ["t1"]), _tool("t1", "x" * 4000)]
+        result, saved = assemble_context(messages, 10)
+        assert result == messages
+        assert saved == 0
+
+
+class TestBuildRequestMessages:
+    def test_system_prompt_survives_dropped_turns(self):
+        messages = [_user("a" * 400), _assistant("b" * 400), _user("q")]
+        system = [{"role": "system", "content": "be nice"}]
+        result, saved = build_request_messages(messages, system, token_budget=50)
+        assert result[0] == system[0]
+        assert result[1:] == [_user("q")]
+        assert saved > 0
+
+    def test_no_budget_sends_full_history(self):
+        messages = [_user("a" * 400), _assistant("b" * 400)]
+        result, saved = build_request_messages(messages, [], token_budget=None)
+        assert result == messages
+        assert saved == 0
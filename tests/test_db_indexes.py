@@ -0,0 +1,79 @@
+from db_indexes import INDEXES, check_indexes, ensure_indexes
+
+
+class FakeCursor:
+    def __init__(self, plan):
+        self.plan = plan
+
+    def sort(self, *args):
+        return self
+
+    def limit(self, *args):
+        return self
+
+    def explain(self):
+        return {"queryPlanner": {"winningPlan": self.plan}}
+
+
+class FakeCollection:
+    def __init__(self, plan=None, fail_on=None):
+        self.indexes = []
+        self.plan = plan or {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+        self.fail_on = fail_on
+
+    def create_index(self, keys, **options):
+        if options["name"] == self.fail_on:
+            raise RuntimeError("duplicate key")
+        self.indexes.append((keys, options))
+
+    def find(self, *args):
+        return FakeCursor(self.plan)
+
+
+class FakeDb(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+def _db(**collections):
+    db = FakeDb(
+        sessions=FakeCollection(), bots=FakeCollection(), tool_cache=FakeCollection()
+    )
+    db.update(collections)
+    return db
+
+
+class TestEnsureIndexes:
+    def test_creates_all_configured_indexes(self):
+        db = _db()
+        ensured = ensure_indexes(db)
+        assert len(ensured) == sum(len(specs) for specs in INDEXES.values())
+        assert ([("id", 1)], {"name": "id_unique", "unique": True}) in db[
+            "sessions"
+        ].indexes
+
+    def test_tool_cache_ttl_index(self):
+        db = _db()
+        ensure_indexes(db)
+        assert db["tool_cache"].indexes == [
+            ([("expires_at", 1)], {"name": "expires_at_1", "expireAfterSeconds": 0})
+        ]
+
+    def test_failing_index_is_skipped(self):
+        db = _db(sessions=FakeCollection(fail_on="id_unique"))
+        ensured = ensure_indexes(db)
+        assert "sessions.id_unique" not in ensured
+        assert "sessions.bot_id" in ensured
+
+
+class TestCheckIndexes:
+    def test_indexed_queries_pass(self):
+        assert check_indexes(_db()) == {}
+
+    def test_collection_scan_reported(self):
+        db = _db(
+            bots=FakeCollection(
+                plan={"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+            )
+        )
+        assert check_indexes(db) == {"bots by id": ["SORT", "COLLSCAN"]}
@@ -0,0 +1,242 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+
+import pytest
+import urllib3
+
+import http_client
+import telemetry
+from benchmarks.stub_servers import StubWebServer
+from dns_resolver import Resolver, connect_addresses, is_public_address, pinned
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Answer getaddrinfo from a table and count the lookups per host."""
+    table = {
+        "example.com": ["93.184.216.34", "2606:2800:220:1:248:1893:25c8:1946"],
+        "other.example": ["198.51.100.7"],
+    }
+    counts = {}
+
+    def _getaddrinfo(host, port, *args, **kwargs):
+        counts[host] = counts.get(host, 0) + 1
+        if host not in table:
+            raise socket.gaierror("unknown host")
+        return [
+            (
+                socket.AF_INET6 if ":" in a else socket.AF_INET,
+                socket.SOCK_STREAM,
+                6,
+                "",
+                (a, 0, 0, 0) if ":" in a else (a, 0),
+            )
+            for a in table[host] * 2  # one entry per socket type in real answers
+        ]
+
+    monkeypatch.setattr(socket, "getaddrinfo", _getaddrinfo)
+    return counts
+
+
+@pytest.fixture
+def spans(tmp_path, monkeypatch):
+    rec = telemetry.Recorder(str(tmp_path / "spans.jsonl"))
+    monkeypatch.setattr(telemetry, "RECORDER", rec)
+    return rec
+
+
+def test_resolve_returns_unique_ipv4_and_ipv6_addresses(lookups):
+    assert Resolver(ttl=60).resolve("example.com") == [
+        "93.184.216.34",
+        "2606:2800:220:1:248:1893:25c8:1946",
+    ]
+
+
+def test_resolutions_are_cached_until_the_ttl(lookups, spans):
+    clock = FakeClock()
+    resolver = Resolver(ttl=60, clock=clock)
+    resolver.resolve("example.com")
+    resolver.resolve("EXAMPLE.com.")
+    assert lookups == {"example.com": 1}
+
+    clock.now = 61
+    resolver.resolve("example.com")
+    assert lookups == {"example.com": 2}
+    text = spans.render_prometheus()
+    assert 'span="dns",outcome="hit"} 1' in text
+    assert 'span="dns",outcome="miss"} 2' in text
+
+
+def test_failures_are_not_cached(lookups, spans):
+    resolver = Resolver(ttl=60)
+    for _ in range(2):
+        with pytest.raises(OSError):
+            resolver.resolve("missing.example")
+    assert lookups == {"missing.example": 2}
+    assert 'span="dns",outcome="error"} 2' in spans.render_prometheus()
+
+
+def test_cache_size_is_bounded(lookups):
+    resolver = Resolver(ttl=60, max_entries=1)
+    resolver.resolve("example.com")
+    resolver.resolve("other.example")
+    resolver.resolve("example.com")
+    assert lookups == {"example.com": 2, "other.example": 1}
+
+
+def test_ip_literals_are_not_looked_up(lookups):
+    resolver = Resolver(ttl=60)
+    assert resolver.resolve("10.0.0.1") == ["10.0.0.1"]
+    assert resolver.resolve("[::1]") == ["::1"]
+    assert lookups == {}
+
+
+@pytest.mark.parametrize(
+    "address, public",
+    [
+        ("93.184.216.34", True),
+        ("2606:2800:220:1:248:1893:25c8:1946", True),
+        ("10.0.0.1", False),
+        ("169.254.169.254", False),
+        ("0.0.0.0", False),
+        ("::", False),
+        ("fe80::1", False),
+        ("::ffff:127.0.0.1", False),
+        ("not an ip", False),
+    ],
+)
+def test_is_public_address(address, public):
+    assert is_public_address(address) is public
+
+
+def test_pinned_addresses_take_precedence(lookups):
+    with pinned("Example.com", ["93.184.216.34"]):
+        assert connect_addresses("example.com") == ["93.184.216.34"]
+    assert lookups == {}
+    assert connect_addresses("example.com")[0] == "93.184.216.34"
+    assert lookups == {"example.com": 1}
+
+
+def test_connection_uses_the_pinned_address():
+    with StubWebServer(page_bytes=100) as web:
+        port = int(web.base_url.rsplit(":", 1)[1])
+        pool = http_client.ResolvedHTTPConnectionPool(
+            "stub.invalid", port, retries=False
+        )
+        with pinned("stub.invalid", ["127.0.0.1"]):
+            response = pool.request("GET", "/page/1")
+        assert response.status == 200
+        assert b"Page 1" in response.data
+        pool.close()
+
+        # Without a pin the unresolvable name is looked up (and fails)
+        pool = http_client.ResolvedHTTPConnectionPool(
+            "stub.invalid", port, retries=False
+        )
+        with pytest.raises(urllib3.exceptions.HTTPError):
+            pool.request("GET", "/page/1")
+        pool.close()
+
+
+def test_full_pool_wait_is_bounded(monkeypatch):
+    monkeypatch.setattr(http_client, "HTTP_POOL_TIMEOUT", 0.05)
+    pool = http_client.ResolvedHTTPConnectionPool("stub.invalid", maxsize=1, block=True)
+    conn = pool._get_conn()
+    try:
+        with pytest.raises(urllib3.exceptions.EmptyPoolError):
+            pool._get_conn()
+    finally:
+        pool._put_conn(conn)
+        pool.close()
+
+
+def test_connection_tries_the_next_address():
+    with StubWebServer(page_bytes=100) as web:
+        port = int(web.base_url.rsplit(":", 1)[1])
+        pool = http_client.ResolvedHTTPConnectionPool(
+            "stub.invalid", port, retries=False
+        )
+        # The stub only listens on IPv4: the first address is refused
+        with pinned("stub.invalid", ["::1", "127.0.0.1"]):
+            response = pool.request("GET", "/page/2")
+        assert response.status == 200
+        pool.close()
+
+
+@pytest.fixture
+def tls_server(tmp_path):
+    """HTTPS server on 127.0.0.1 with a self-signed certificate for www.example.test."""
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is not installed")
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes"]
+        + ["-keyout", str(key), "-out", str(cert), "-days", "1"]
+        + ["-subj", "/CN=www.example.test"]
+        + ["-addext", "subjectAltName=DNS:www.example.test"],
+        check=True,
+        capture_output=True,
+    )
+
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = self.headers["Host"].encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(str(cert), str(key))
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_address[1], str(cert)
+    server.shutdown()
+    server.server_close()
+
+
+def test_tls_verifies_the_host_name_not_the_pinned_address(tls_server):
+    port, cert = tls_server
+    pool = http_client.ResolvedHTTPSConnectionPool(
+        "www.example.test",
+        port,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=cert,
+        retries=False,
+    )
+    with pinned("www.example.test", ["127.0.0.1"]):
+        response = pool.request("GET", "/")
+    assert response.status == 200
+    assert response.data == f"www.example.test:{port}".encode()
+    pool.close()
+
+
+def test_tls_rejects_a_certificate_for_another_host(tls_server):
+    port, cert = tls_server
+    pool = http_client.ResolvedHTTPSConnectionPool(
+        "other.example.test",
+        port,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=cert,
+        retries=False,
+    )
+    with pinned("other.example.test", ["127.0.0.1"]):
+        with pytest.raises(urllib3.exceptions.SSLError):
+            pool.request("GET", "/")
+    pool.close()
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+import extraction
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "benchmarks",
+    "fixtures",
+)
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+        return f.read()
+
+
+class TestHtmlToMarkdown:
+    def test_keeps_main_content_without_boilerplate(self):
+        content = extraction.html_to_markdown(_fixture("article.html"), "utf-8")
+
+        assert content.startswith("# Why streaming responses feel faster")
+        assert "流式输出" in content
+        for boilerplate in ("Section 5", "Trending", "Footer link", "window.__data"):
+            assert boilerplate not in content
+
+    def test_keeps_code_and_tables(self):
+        content = extraction.html_to_markdown(_fixture("docs.html"), "utf-8")
+
+        assert "adapter = HTTPAdapter(pool_connections=32, pool_maxsize=8)" in content
+        assert "Option | Default | Description" in content
+        assert "Page 3.4" not in content
+
+    def test_detects_the_charset_without_a_header(self):
+        page = "<html><head><meta charset='gbk'></head><body><article><p>{}</p></article></body></html>"
+        text = "中文内容，" * 40
+        content = extraction.html_to_markdown(page.format(text).encode("gbk"))
+        assert text.strip("，") in content
+
+    def test_falls_back_to_the_whole_body(self, monkeypatch):
+        monkeypatch.setattr(extraction.trafilatura, "extract", lambda *a, **k: None)
+        monkeypatch.setattr(
+            extraction, "body_to_markdown", lambda data, encoding: "whole body"
+        )
+        assert extraction.html_to_markdown(b"<p>x</p>", "utf-8") == "whole body"
+
+    def test_falls_back_when_extraction_raises(self, monkeypatch):
+        def _boom(*args, **kwargs):
+            raise ValueError("bad markup")
+
+        monkeypatch.setattr(extraction.trafilatura, "extract", _boom)
+        monkeypatch.setattr(
+            extraction, "body_to_markdown", lambda data, encoding: "whole body"
+        )
+        assert extraction.html_to_markdown(b"<p>x</p>") == "whole body"
+
+
+class TestParseSearchResults:
+    def test_reads_the_organic_results(self):
+        results = extraction.parse_search_results(_fixture("bing.html"))
+
+        # Ads are not b_algo results and relative tracking links are skipped
+        assert [r["url"] for r in results] == [
+            f"https://example{i}.com/articles/{i}" for i in (0, 1, 2, 4, 5)
+        ]
+        assert results[0]["title"].startswith("Result 0: ")
+        assert results[0]["snippet"]
+
+    def test_limit(self):
+        assert len(extraction.parse_search_results(_fixture("bing.html"), 2)) == 2
+
+    def test_no_results(self):
+        assert extraction.parse_search_results(b"<html><body></body></html>") == []
+
+    @pytest.mark.parametrize("data", [b"", b"   "])
+    def test_unparsable_page_falls_back_to_soup(self, monkeypatch, data):
+        monkeypatch.setattr(
+            extraction, "_parse_results_soup", lambda data, limit: ["fallback"]
+        )
+        assert extraction.parse_search_results(data) == ["fallback"]
@@ -0,0 +1,215 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import blob_store
+import generation_worker
+from generation_worker import DONE, FAILED, STOPPED, GenerationJob
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _session(messages=None):
+    return {
+        "id": 1,
+        "name": "s",
+        "messages": messages or [{"role": "user", "content": "q"}],
+    }
+
+
+def _run(job, turn):
+    async def _turn(j):
+        return turn(j)
+
+    job.run(_turn)
+
+
+class TestGenerationJob:
+    def test_records_turn_in_its_own_session_copy(self):
+        session = _session()
+        job = GenerationJob(session)
+
+        def turn(j):
+            j.on_round_start(0)
+            j.on_delta("Hi", "", 0, {})
+            assert j.snapshot()["content"] == ["Hi"]
+            j.on_assistant_message({"role": "assistant", "content": "Hi"}, {})
+            return False
+
+        _run(job, turn)
+        snapshot = job.snapshot()
+        assert snapshot["status"] == DONE
+        assert snapshot["messages"] == [{"role": "assistant", "content": "Hi"}]
+        assert snapshot["content"] == [] and snapshot["reasoning"] == []
+        assert len(session["messages"]) == 1
+
+    def test_snapshot_returns_only_new_deltas_of_the_current_reply(self):
+        job = GenerationJob(_session())
+        job.on_delta("a", "r1", 0, {})
+        first = job.snapshot()
+        assert (first["reasoning"], first["content"]) == (["r1"], ["a"])
+
+        job.on_delta("b", "r2", 0, {})
+        second = job.snapshot(first["stream"], 1, 1)
+        assert (second["reasoning"], second["content"]) == (["r2"], ["b"])
+
+        job.on_assistant_message({"role": "assistant", "content": "ab"}, {})
+        job.on_delta("c", "", 0, {})
+        third = job.snapshot(first["stream"], 2, 2)
+        assert third["stream"] != first["stream"]
+        assert third["content"] == ["c"]
+
+    def test_stopped_turn(self):
+        job = GenerationJob(_session())
+        job.stop()
+        assert job.should_stop()
+        _run(job, lambda j: True)
+        assert job.status == STOPPED
+
+    def test_failure_keeps_partial_reply(self):
+        job = GenerationJob(_session())
+
+        def turn(j):
+            j.on_round_start(0)
+            j.on_delta("part", "why", 0, {})
+            raise RuntimeError("boom")
+
+        _run(job, turn)
+        assert job.status == FAILED
+        assert job.error == "boom"
+        assert job.session["messages"][-1] == {
+            "role": "assistant",
+            "content": "part",
+            "reasoning_content": "why",
+        }
+
+    def test_tool_message_keeps_duration(self):
+        job = GenerationJob(_session())
+        job.on_tool_message({"role": "tool", "tool_call_id": "t", "content": "r"}, 12)
+        assert job.session["messages"][-1]["duration_ms"] == 12
+
+    def test_stored_tool_message_keeps_a_preview(self, tmp_path, monkeypatch):
+        blob_store.set_store(blob_store.LocalBlobStore(str(tmp_path)))
+        monkeypatch.setattr(blob_store, "BLOB_INLINE_MAX_BYTES", 10)
+        monkeypatch.setattr(blob_store, "TOOL_PREVIEW_CHARS", 4)
+        try:
+            job = GenerationJob(_session())
+            job.on_tool_message({"role": "tool", "content": "page text"}, 1)
+            job.on_tool_message({"role": "tool", "content": "long page text"}, 1)
+        finally:
+            blob_store.set_store(None)
+        short, stored = job.session["messages"][-2:]
+        assert "preview" not in short
+        assert blob_store.is_ref(stored["content"])
+        assert stored["preview"] == "long"
+
+    def test_checkpoints_partial_reply_at_interval(self):
+        calls = []
+
+        def persist(session, dirty_from):
+            calls.append(([m["content"] for m in session["messages"]], dirty_from))
+            session["message_count"] = len(session["messages"])
+
+        clock = FakeClock()
+        job = GenerationJob(_session(), persist, checkpoint_interval=2, clock=clock)
+        job.on_round_start(0)
+        job.on_delta("a", "", 0, {})
+        assert calls == []
+
+        clock.now = 3
+        job.on_delta("b", "", 0, {})
+        assert calls == [(["q", "ab"], None)]
+        assert job.session["message_count"] == 2
+
+        # The final reply replaces the checkpointed partial one
+        job.on_assistant_message({"role": "assistant", "content": "abc"}, {})
+        _run(job, lambda j: False)
+        assert calls[-1] == (["q", "abc"], 1)
+
+    def test_checkpoint_failure_is_retried(self):
+        clock = FakeClock()
+        failures = [RuntimeError("down")]
+        calls = []
+
+        def persist(session, dirty_from):
+            calls.append(dirty_from)
+            if failures:
+                raise failures.pop()
+
+        job = GenerationJob(_session(), persist, checkpoint_interval=0, clock=clock)
+        job.on_round_start(0)
+        job.on_delta("a", "", 0, {})
+        job.on_delta("b", "", 0, {})
+        assert calls == [None, None]
+        job.on_delta("c", "", 0, {})
+        assert calls == [None, None, 1]
+
+    def test_turns_of_a_thread_share_its_event_loop(self):
+        loops = []
+
+        async def turn(job):
+            loops.append(asyncio.get_running_loop())
+            return False
+
+        GenerationJob(_session()).run(turn)
+        GenerationJob(_session()).run(turn)
+        assert loops[0] is loops[1]
+        assert not loops[0].is_closed()
+
+    def test_wait_returns_on_change(self):
+        job = GenerationJob(_session())
+        version = job.snapshot()["version"]
+        threading.Timer(0.01, job.on_round_start, args=(0,)).start()
+        job.wait(version, timeout=5)
+        assert job.snapshot()["version"] != version
+
+
+class TestRegistry:
+    def test_submit_attach_release(self):
+        release = threading.Event()
+
+        async def turn(job):
+            release.wait(5)
+            return False
+
+        session = _session()
+        session["id"] = "registry-test"
+        job = generation_worker.submit(session, turn)
+        try:
+            assert generation_worker.get_job("registry-test") is job
+            with pytest.raises(RuntimeError):
+                generation_worker.submit(session, turn)
+        finally:
+            release.set()
+        job.wait(job.snapshot()["version"], timeout=5)
+        assert job.status == DONE
+        generation_worker.release(job)
+        assert generation_worker.get_job("registry-test") is None
+
+
+def test_executor_created_once_under_concurrent_submits(monkeypatch):
+    created = []
+
+    def _slow_executor(**kwargs):
+        time.sleep(0.05)
+        created.append(kwargs)
+        return object()
+
+    monkeypatch.setattr(generation_worker, "_executor", None)
+    monkeypatch.setattr(generation_worker, "ThreadPoolExecutor", _slow_executor)
+    threads = [
+        threading.Thread(target=generation_worker._get_executor) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(created) == 1
@@ -0,0 +1,120 @@
+from datetime import datetime
+
+from session_store import (
+    decode_page_token,
+    encode_page_token,
+    fetch_session_summaries,
+    load_session,
+    session_summary,
+)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = []
+
+    def sort(self, *args):
+        self.calls.append(("sort", args))
+        return self
+
+    def limit(self, n):
+        self.calls.append(("limit", n))
+        self.docs = self.docs[:n]
+        return self
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+class FakeSessions:
+    def __init__(self, docs):
+        self.docs = docs
+        self.find_args = None
+
+    def find(self, query, projection=None):
+        self.find_args = (query, projection)
+        self.cursor = FakeCursor(self.docs)
+        return self.cursor
+
+    def find_one(self, query):
+        return next(
+            (d for d in self.docs if all(d.get(k) == v for k, v in query.items())),
+            None,
+        )
+
+
+class FakeDb:
+    def __init__(self, docs):
+        self.sessions = FakeSessions(docs)
+
+
+def _full_session(session_id, user="alice"):
+    return {
+        "id": session_id,
+        "user": user,
+        "name": f"s{session_id}",
+        "bot_id": 1,
+        "create_time": datetime(2025, 1, session_id),
+        "messages": [{"role": "user", "content": "hi"}],
+    }
+
+
+class TestSessionSummary:
+    def test_keeps_only_sidebar_fields(self):
+        summary = session_summary(_full_session(1))
+        assert summary == {
+            "id": 1,
+            "name": "s1",
+            "bot_id": 1,
+            "create_time": datetime(2025, 1, 1),
+        }
+
+
+class TestFetchSessionSummaries:
+    def test_uses_projection_without_messages(self):
+        db = FakeDb([])
+        fetch_session_summaries(db, "alice")
+        query, projection = db.sessions.find_args
+        assert query == {"user": "alice"}
+        assert "messages" not in projection
+        assert projection["_id"] == 0
+        assert (
+            "sort",
+            ([("create_time", -1), ("id", -1)],),
+        ) in db.sessions.cursor.calls
+
+    def test_full_page_returns_token_of_last_session(self):
+        docs = [session_summary(_full_session(i)) for i in (3, 2, 1)]
+        summaries, token = fetch_session_summaries(FakeDb(docs), "alice", limit=2)
+        assert [s["id"] for s in summaries] == [3, 2]
+        assert decode_page_token(token) == (datetime(2025, 1, 2), 2)
+
+    def test_last_page_has_no_token(self):
+        docs = [session_summary(_full_session(1))]
+        _, token = fetch_session_summaries(FakeDb(docs), "alice", limit=2)
+        assert token is None
+
+    def test_token_continues_after_last_seen_position(self):
+        db = FakeDb([])
+        token = encode_page_token({"create_time": datetime(2025, 1, 2), "id": 7})
+        fetch_session_summaries(db, "alice", page_token=token)
+        query, _ = db.sessions.find_args
+        assert query == {
+            "user": "alice",
+            "$or": [
+                {"create_time": {"$lt": datetime(2025, 1, 2)}},
+                {"create_time": datetime(2025, 1, 2), "id": {"$lt": 7}},
+            ],
+        }
+
+
+class TestLoadSession:
+    def test_loads_full_session_of_user(self):
+        db = FakeDb([_full_session(1, "bob"), _full_session(1)])
+        session = load_session(db, "alice", 1)
+        assert session["user"] == "alice"
+        assert session["messages"]
+
+    def test_missing_session_returns_none(self):
+        assert load_session(FakeDb([]), "alice", 1) is None
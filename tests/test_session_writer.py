@@ -0,0 +1,251 @@
+import threading
+import time
+
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import telemetry
+from session_writer import SessionWriter
+
+
+class FakeSessions:
+    """Applies the bulk upserts of the writer; ``failures`` are raised first."""
+
+    def __init__(self):
+        self.docs = {}
+        self.batches = []
+        self.failures = []
+
+    def bulk_write(self, requests, ordered=True):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.batches.append([(r._filter, r._doc) for r in requests])
+        for request in requests:
+            update = request._doc
+            doc = self.docs.setdefault(request._filter["id"], {})
+            doc.update(update["$set"])
+            push = update.get("$push", {}).get("messages")
+            if push:
+                array = doc.setdefault("messages", [])
+                array[push["$position"] : push["$position"]] = push["$each"]
+                del array[push["$slice"] :]
+
+
+class SlowSessions(FakeSessions):
+    """Blocks every bulk write until ``release`` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def bulk_write(self, requests, ordered=True):
+        self.entered.set()
+        self.release.wait(5)
+        super().bulk_write(requests, ordered)
+
+
+class FakeDb:
+    def __init__(self):
+        self.sessions = FakeSessions()
+
+
+@pytest.fixture
+def spans(tmp_path, monkeypatch):
+    rec = telemetry.Recorder(str(tmp_path / "spans.jsonl"))
+    monkeypatch.setattr(telemetry, "RECORDER", rec)
+    return rec
+
+
+@pytest.fixture
+def sleeps():
+    return []
+
+
+@pytest.fixture
+def writer(sleeps):
+    writer = SessionWriter(delay=60, retries=2, backoff=0.5, sleep=sleeps.append)
+    yield writer
+    writer.close()
+
+
+def _session(session_id=1, count=0, *contents):
+    return {
+        "id": session_id,
+        "user": "u",
+        "name": "n",
+        "bot_id": 1,
+        "messages": [{"role": "user", "content": c} for c in contents],
+        "message_count": count,
+    }
+
+
+def _save(writer, db, session, dirty_from=None):
+    writer.enqueue(db, session, dirty_from)
+    session["message_count"] = len(session["messages"])
+
+
+def _contents(doc):
+    return [m["content"] for m in doc["messages"]]
+
+
+def test_saves_of_a_session_are_coalesced(writer, spans):
+    db, session = FakeDb(), _session(1, 0, "a", "b")
+    _save(writer, db, session)
+    session["messages"].pop()
+    session["messages"] += [{"role": "user", "content": "c"}]
+    _save(writer, db, session)
+    assert writer.depth() == 1
+
+    writer.flush()
+    (batch,) = db.sessions.batches
+    assert len(batch) == 1
+    assert batch[0][1]["$push"]["messages"]["$position"] == 0
+    assert _contents(db.sessions.docs[1]) == ["a", "c"]
+    assert writer.depth() == 0
+    assert '"saves": 2' in open(spans.jsonl_path).read()
+
+
+def test_coalesced_saves_rewrite_from_the_earliest_change(writer):
+    db, session = FakeDb(), _session(1, 0, "a", "b", "c")
+    _save(writer, db, session)
+    writer.flush()
+
+    session["messages"][1]["content"] = "edited"
+    session["messages"] = session["messages"][:2]
+    _save(writer, db, session, dirty_from=1)
+    session["messages"].append({"role": "user", "content": "d"})
+    _save(writer, db, session)
+    writer.flush()
+
+    update = db.sessions.batches[-1][0][1]
+    assert update["$push"]["messages"]["$position"] == 1
+    assert _contents(db.sessions.docs[1]) == ["a", "edited", "d"]
+
+
+def test_sessions_are_written_in_one_bulk_write(writer):
+    db = FakeDb()
+    for session_id in (1, 2, 3):
+        _save(writer, db, _session(session_id, 0, "q"))
+    writer.flush()
+    assert [len(batch) for batch in db.sessions.batches] == [3]
+
+
+def test_transient_errors_are_retried_with_backoff(writer, sleeps, spans):
+    db = FakeDb()
+    db.sessions.failures = [AutoReconnect("primary stepped down")] * 2
+    _save(writer, db, _session(1, 0, "q"))
+    writer.flush()
+    assert sleeps == [0.5, 1.0]
+    assert _contents(db.sessions.docs[1]) == ["q"]
+    text = spans.render_prometheus()
+    assert 'span="session_flush",outcome="retry"} 2' in text
+    assert 'span="session_flush",outcome="ok"} 1' in text
+
+
+def test_saves_are_requeued_when_retries_run_out(writer):
+    db = FakeDb()
+    db.sessions.failures = [AutoReconnect("down")] * 3
+    session = _session(1, 0, "a")
+    _save(writer, db, session)
+    writer.flush()
+    assert db.sessions.docs == {}
+    assert writer.depth() == 1
+
+    session["messages"].append({"role": "user", "content": "b"})
+    _save(writer, db, session)
+    writer.flush()
+    # The requeued save still covers the messages it never wrote
+    assert _contents(db.sessions.docs[1]) == ["a", "b"]
+
+
+def test_rejected_session_is_rewritten_by_its_next_save(writer):
+    db = FakeDb()
+    db.sessions.failures = [
+        BulkWriteError({"writeErrors": [{"index": 0, "errmsg": "too large"}]})
+    ]
+    session = _session(1, 0, "a")
+    _save(writer, db, session)
+    writer.flush()
+
+    session["messages"].append({"role": "user", "content": "b"})
+    _save(writer, db, session)
+    writer.flush()
+    update = db.sessions.batches[-1][0][1]
+    assert "$push" not in update
+    assert _contents(update["$set"]) == ["a", "b"]
+
+
+def test_unexpected_errors_requeue_the_saves(writer):
+    db = FakeDb()
+    db.sessions.failures = [ValueError("bad document")]
+    _save(writer, db, _session(1, 0, "a"))
+    writer.flush()
+    assert db.sessions.docs == {}
+    assert writer.depth() == 1
+    writer.flush()
+    assert _contents(db.sessions.docs[1]) == ["a"]
+
+
+def test_flush_of_a_session_writes_only_that_session(writer):
+    db = FakeDb()
+    for session_id in (1, 2):
+        _save(writer, db, _session(session_id, 0, "q"))
+    writer.flush([2])
+    assert list(db.sessions.docs) == [2]
+    assert writer.depth() == 1
+
+
+def test_flush_of_a_session_does_not_wait_for_other_writes(writer):
+    slow, db = FakeDb(), FakeDb()
+    slow.sessions = SlowSessions()
+    _save(writer, slow, _session(1, 0, "q"))
+    background = threading.Thread(target=writer.flush)
+    background.start()
+    assert slow.sessions.entered.wait(5)
+    try:
+        _save(writer, db, _session(2, 0, "q"))
+        writer.flush([2])
+        assert _contents(db.sessions.docs[2]) == ["q"]
+    finally:
+        slow.sessions.release.set()
+        background.join(5)
+
+
+def test_flush_of_a_session_waits_for_its_write_in_progress(writer):
+    db = FakeDb()
+    db.sessions = SlowSessions()
+    _save(writer, db, _session(1, 0, "q"))
+    background = threading.Thread(target=writer.flush)
+    background.start()
+    assert db.sessions.entered.wait(5)
+    threading.Timer(0.05, db.sessions.release.set).start()
+    writer.flush([1])
+    assert _contents(db.sessions.docs[1]) == ["q"]
+    background.join(5)
+
+
+def test_background_thread_flushes_after_the_delay():
+    writer = SessionWriter(delay=0)
+    db = FakeDb()
+    _save(writer, db, _session(1, 0, "q"))
+    deadline = time.monotonic() + 5
+    while not db.sessions.docs and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert _contents(db.sessions.docs[1]) == ["q"]
+    writer.close()
+
+
+def test_close_writes_pending_saves(writer):
+    db = FakeDb()
+    _save(writer, db, _session(1, 0, "q"))
+    writer.close()
+    assert _contents(db.sessions.docs[1]) == ["q"]
+    assert writer.depth() == 0
+
+
+def test_queue_depth_is_exported(writer, spans, monkeypatch):
+    monkeypatch.setattr(telemetry, "_gauges", {})
+    telemetry.gauge("session_write_queue_depth", "Pending sessions.", writer.depth)
+    _save(writer, FakeDb(), _session(1, 0, "q"))
+    assert "ai_bots_session_write_queue_depth 1" in spans.render_prometheus()
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import socket
+import urllib.request
+from types import SimpleNamespace
+
+import pytest
+
+import botpage
+import generation_worker
+import telemetry
+from chat_engine import TurnCallbacks, run_chat_turn
+from test_chat_engine import FakeClient, FakeStream, _chunk, _tool_delta
+
+
+@pytest.fixture
+def recorder(tmp_path, monkeypatch):
+    rec = telemetry.Recorder(str(tmp_path / "spans.jsonl"))
+    monkeypatch.setattr(telemetry, "RECORDER", rec)
+    return rec
+
+
+def _spans(rec):
+    with open(rec.jsonl_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_spans_carry_context_tags(recorder):
+    with telemetry.tagged(model="m", bot="b"):
+        with telemetry.tagged(round=2):
+            with telemetry.span("context_build") as span:
+                span.fields["saved_tokens"] = 7
+        telemetry.record("tool", 12.5, "error", tags={"tool": "fetch_url"})
+    telemetry.record("save_session", 3.0)
+
+    spans = _spans(recorder)
+    assert spans[0]["span"] == "context_build"
+    assert (spans[0]["model"], spans[0]["bot"], spans[0]["round"]) == ("m", "b", "2")
+    assert spans[0]["saved_tokens"] == 7
+    assert spans[1]["outcome"] == "error"
+    assert spans[1]["tool"] == "fetch_url"
+    assert "round" not in spans[1]
+    assert "model" not in spans[2]
+
+
+def test_span_marks_exceptions_as_errors(recorder):
+    with pytest.raises(ValueError):
+        with telemetry.span("save_session"):
+            raise ValueError("boom")
+    assert _spans(recorder)[0]["outcome"] == "error"
+
+
+def test_render_prometheus_histograms(recorder):
+    with telemetry.tagged(model="m", bot="b", round=0):
+        telemetry.record("tool", 30, tags={"tool": "search_web"})
+        telemetry.record("tool", 3000, tags={"tool": "search_web"})
+        telemetry.record("completion", 1000, tokens_per_s=42.0)
+
+    text = recorder.render_prometheus()
+    labels = 'span="tool",model="m",bot="b",tool="search_web",outcome="ok"'
+    metric = "ai_bots_span_duration_milliseconds"
+    assert f'{metric}_bucket{{{labels},le="50"}} 1' in text
+    assert f'{metric}_bucket{{{labels},le="5000"}} 2' in text
+    assert f'{metric}_bucket{{{labels},le="+Inf"}} 2' in text
+    assert f"{metric}_count{{{labels}}} 2" in text
+    assert f"{metric}_sum{{{labels}}} 3030.0" in text
+    assert "round=" not in text
+    rate = 'ai_bots_stream_tokens_per_second_bucket{span="completion",model="m",bot="b",le="50"} 1'
+    assert rate in text
+
+
+def test_serve_metrics(recorder, monkeypatch):
+    monkeypatch.setattr(telemetry, "_server", None)
+    assert telemetry.serve_metrics(0) is None
+    telemetry.record("save_session", 1.0)
+    server = telemetry.serve_metrics(_free_port())
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode("utf-8")
+        assert 'span="save_session"' in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_chat_turn_records_rounds_ttft_and_rate(recorder):
+    client = FakeClient(
+        [
+            FakeStream(
+                [_chunk(tool_calls=[_tool_delta(0, "c0", "search_web", '{"q": 1}')])]
+            ),
+            FakeStream(
+                [
+                    SimpleNamespace(choices=[], usage=None),
+                    _chunk(content="hello "),
+                    _chunk(content="world"),
+                    SimpleNamespace(
+                        choices=[], usage=SimpleNamespace(completion_tokens=5)
+                    ),
+                ]
+            ),
+        ]
+    )
+
+    async def _turn():
+        with telemetry.tagged(model="m", bot="b"):
+            return await run_chat_turn(
+                client,
+                "m",
+                [{"role": "user", "content": "q"}],
+                None,
+                lambda history: list(history),
+                lambda tool_call: (
+                    telemetry.record("tool", 1.0, tags={"tool": "search_web"})
+                    or ("result", 1)
+                ),
+                TurnCallbacks(),
+                max_rounds=5,
+                max_workers=2,
+            )
+
+    assert asyncio.run(_turn()) is False
+
+    spans = _spans(recorder)
+    assert [(s["span"], s["round"]) for s in spans] == [
+        ("ttft", "0"),
+        ("completion", "0"),
+        ("tool", "0"),
+        ("ttft", "1"),
+        ("completion", "1"),
+    ]
+    assert all(s["model"] == "m" and s["bot"] == "b" for s in spans)
+    assert spans[1]["output_tokens_estimated"] is True
+    assert spans[4]["output_tokens"] == 5
+    assert "output_tokens_estimated" not in spans[4]
+    assert spans[4]["ttft_ms"] >= 0
+
+
+def test_stopped_completion_outcome(recorder):
+    class StopAfterFirst(TurnCallbacks):
+        def __init__(self):
+            self.deltas = 0
+
+        def on_delta(self, *args):
+            self.deltas += 1
+
+        def should_stop(self):
+            return self.deltas > 0
+
+    client = FakeClient([FakeStream([_chunk(content="a"), _chunk(content="b")])])
+    stopped = asyncio.run(
+        run_chat_turn(
+            client,
+            "m",
+            [],
+            None,
+            list,
+            None,
+            StopAfterFirst(),
+            max_rounds=5,
+            max_workers=1,
+        )
+    )
+    assert stopped is True
+    assert _spans(recorder)[-1]["outcome"] == "stopped"
+
+
+def test_generation_job_records_queue_and_turn(recorder):
+    job = generation_worker.GenerationJob(
+        {"id": 1, "messages": []}, tags={"model": "m", "bot": "b"}
+    )
+
+    async def _turn(j):
+        telemetry.record("context_build", 1.0)
+        return True
+
+    job.run(_turn)
+
+    spans = _spans(recorder)
+    assert [s["span"] for s in spans] == ["queue", "context_build", "turn"]
+    assert all(s["bot"] == "b" for s in spans)
+    assert spans[-1]["outcome"] == generation_worker.STOPPED
+
+
+def test_execute_tool_call_records_outcome(recorder, monkeypatch):
+    monkeypatch.setattr(
+        botpage, "handle_function_call", lambda name, args: {"error": "nope"}
+    )
+    botpage.execute_tool_call(
+        {"function": {"name": "fetch_url", "arguments": '{"url": "x"}'}}
+    )
+
+    span = _spans(recorder)[0]
+    assert (span["span"], span["tool"], span["outcome"]) == (
+        "tool",
+        "fetch_url",
+        "error",
+    )
@@ -0,0 +1,142 @@
+from datetime import datetime, timezone
+
+import botpage
+import telemetry
+from botpage import handle_function_call
+from tool_cache import ToolResultCache, normalize_key, normalize_url
+
+
+class FakeCollection:
+    """Minimal in-memory stand-in for a pymongo collection."""
+
+    def __init__(self):
+        self.docs = {}
+
+    def find_one(self, query):
+        doc = self.docs.get(query["_id"])
+        if doc and doc["expires_at"] > query["expires_at"]["$gt"]:
+            return doc
+        return None
+
+    def replace_one(self, query, doc, upsert=False):
+        self.docs[query["_id"]] = doc
+
+
+class TestNormalizeKey:
+    def test_query_whitespace_and_case_normalized(self):
+        assert normalize_key("search_web", {"query": "  Hello   World "}) == (
+            "hello world"
+        )
+
+    def test_url_host_case_port_and_fragment_normalized(self):
+        assert (
+            normalize_url("HTTPS://Example.COM:443/a?b=1#top")
+            == "https://example.com/a?b=1"
+        )
+
+    def test_url_keeps_non_default_port(self):
+        assert normalize_url("http://example.com:8080") == "http://example.com:8080/"
+
+    def test_unknown_tool_not_cacheable(self):
+        assert normalize_key("other", {"query": "x"}) is None
+
+
+class TestToolResultCache:
+    def test_miss_then_hit(self):
+        cache = ToolResultCache({"fetch_url": (60, 10)})
+        assert cache.get("fetch_url", "k") is None
+        cache.put("fetch_url", "k", "v")
+        assert cache.get("fetch_url", "k") == "v"
+        stats = cache.stats()["fetch_url"]
+        assert stats["misses"] == 1
+        assert stats["local_hits"] == 1
+        assert stats["size"] == 1
+
+    def test_lru_eviction(self):
+        cache = ToolResultCache({"fetch_url": (60, 2)})
+        cache.put("fetch_url", "a", "1")
+        cache.put("fetch_url", "b", "2")
+        cache.get("fetch_url", "a")
+        cache.put("fetch_url", "c", "3")
+        assert cache.get("fetch_url", "b") is None
+        assert cache.get("fetch_url", "a") == "1"
+        assert cache.get("fetch_url", "c") == "3"
+
+    def test_expired_entry_is_a_miss(self, monkeypatch):
+        import tool_cache
+
+        now = [1000.0]
+        monkeypatch.setattr(tool_cache.time, "monotonic", lambda: now[0])
+        cache = ToolResultCache({"fetch_url": (10, 10)})
+        cache.put("fetch_url", "k", "v")
+        now[0] += 11
+        assert cache.get("fetch_url", "k") is None
+
+    def test_zero_ttl_disables_caching(self):
+        cache = ToolResultCache({"fetch_url": (0, 10)})
+        cache.put("fetch_url", "k", "v")
+        assert cache.get("fetch_url", "k") is None
+
+    def test_shared_tier_fills_local_tier(self):
+        collection = FakeCollection()
+        writer = ToolResultCache({"fetch_url": (60, 10)})
+        writer.bind_collection(collection)
+        writer.put("fetch_url", "k", "v")
+
+        reader = ToolResultCache({"fetch_url": (60, 10)})
+        reader.bind_collection(collection)
+        assert reader.get("fetch_url", "k") == "v"
+        assert reader.get("fetch_url", "k") == "v"
+        stats = reader.stats()["fetch_url"]
+        assert stats["shared_hits"] == 1
+        assert stats["local_hits"] == 1
+
+    def test_expired_shared_entry_is_a_miss(self):
+        collection = FakeCollection()
+        cache = ToolResultCache({"fetch_url": (60, 10)})
+        cache.bind_collection(collection)
+        cache.put("fetch_url", "k", "v")
+        for doc in collection.docs.values():
+            # Expiry times are UTC, as the TTL monitor compares them
+            assert doc["expires_at"].tzinfo is timezone.utc
+            doc["expires_at"] = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        cache.clear()
+        assert cache.get("fetch_url", "k") is None
+
+
+def test_counters_are_exported_as_gauges(tmp_path, monkeypatch):
+    monkeypatch.setattr(telemetry, "_gauges", {})
+    monkeypatch.setattr(
+        telemetry, "RECORDER", telemetry.Recorder(str(tmp_path / "spans.jsonl"))
+    )
+    cache = ToolResultCache({"fetch_url": (60, 10)})
+    cache.register_gauges()
+    cache.get("fetch_url", "k")
+    cache.put("fetch_url", "k", "v")
+    cache.get("fetch_url", "k")
+    text = telemetry.RECORDER.render_prometheus()
+    assert "ai_bots_tool_cache_fetch_url_misses 1" in text
+    assert "ai_bots_tool_cache_fetch_url_local_hits 1" in text
+    assert "ai_bots_tool_cache_fetch_url_size 1" in text
+
+
+class TestHandleFunctionCallCaching:
+    def test_repeated_fetch_served_from_cache(self, monkeypatch):
+        calls = []
+
+        def _fetch(url):
+            calls.append(url)
+            return "# Content"
+
+        monkeypatch.setattr(botpage, "fetch_url", _fetch)
+        handle_function_call("fetch_url", {"url": "https://example.com/"})
+        result = handle_function_call("fetch_url", {"url": "https://EXAMPLE.com"})
+        assert result == {"content": "# Content"}
+        assert calls == ["https://example.com/"]
+
+    def test_errors_are_not_cached(self, monkeypatch):
+        monkeypatch.setattr(botpage, "fetch_url", lambda url: None)
+        handle_function_call("fetch_url", {"url": "https://example.com"})
+        monkeypatch.setattr(botpage, "fetch_url", lambda url: "# Content")
+        result = handle_function_call("fetch_url", {"url": "https://example.com"})
+        assert result == {"content": "# Content"}
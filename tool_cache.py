@@ -0,0 +1,203 @@
+"""Tiered result cache for the web tools.
+
+Tier 1 is a bounded in-process LRU per tool; tier 2 is a MongoDB collection
+with a TTL index shared by all replicas.  Only successful tool results are
+cached.  TTLs and size limits are configured per tool via environment
+variables, e.g. ``TOOL_CACHE_SEARCH_WEB_TTL=600`` and
+``TOOL_CACHE_FETCH_URL_SIZE=128``; a TTL of 0 disables caching for the tool.
+The hit/miss counters and sizes are exported as ``telemetry`` gauges.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, Optional, Tuple
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+# Default (ttl_seconds, max_entries) per tool.
+DEFAULT_POLICIES = {
+    "search_web": (600, 256),
+    "fetch_url": (3600, 128),
+}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logger.warning("Invalid integer for %s, using default %d", name, default)
+        return default
+
+
+def load_policies() -> Dict[str, Tuple[int, int]]:
+    """Return the (ttl_seconds, max_entries) policy of each tool, applying env overrides."""
+    policies = {}
+    for tool, (ttl, size) in DEFAULT_POLICIES.items():
+        prefix = f"TOOL_CACHE_{tool.upper()}"
+        policies[tool] = (
+            _env_int(f"{prefix}_TTL", ttl),
+            _env_int(f"{prefix}_SIZE", size),
+        )
+    return policies
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query: trim, collapse whitespace and casefold."""
+    return re.sub(r"\s+", " ", query.strip()).casefold()
+
+
+def normalize_url(url: str) -> str:
+    """Normalize a URL: lowercase scheme and host, drop default ports and fragments."""
+    parsed = urllib.parse.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or "").lower()
+    if parsed.port and (scheme, parsed.port) not in (("http", 80), ("https", 443)):
+        netloc = f"{netloc}:{parsed.port}"
+    return urllib.parse.urlunsplit(
+        (scheme, netloc, parsed.path or "/", parsed.query, "")
+    )
+
+
+def normalize_key(tool: str, arguments: Dict[str, Any]) -> Optional[str]:
+    """Build the cache key of a tool call, or None if the call is not cacheable."""
+    if tool == "search_web" and arguments.get("query"):
+        return normalize_query(arguments["query"])
+    if tool == "fetch_url" and arguments.get("url"):
+        return normalize_url(arguments["url"])
+    return None
+
+
+class ToolResultCache:
+    """Two-tier (in-process LRU + MongoDB TTL collection) cache of tool results."""
+
+    def __init__(self, policies: Optional[Dict[str, Tuple[int, int]]] = None):
+        self.policies = policies if policies is not None else load_policies()
+        self._local: Dict[str, OrderedDict] = {
+            tool: OrderedDict() for tool in self.policies
+        }
+        self._lock = threading.Lock()
+        self._collection = None
+        self._stats = {
+            tool: {"local_hits": 0, "shared_hits": 0, "misses": 0}
+            for tool in self.policies
+        }
+
+    def bind_collection(self, collection) -> None:
+        """Attach the shared MongoDB collection (or None).
+
+        Its TTL index on ``expires_at`` is created with the other indexes by
+        ``db_indexes.ensure_indexes``.
+        """
+        self._collection = collection
+
+    def _enabled(self, tool: str) -> bool:
+        return tool in self.policies and self.policies[tool][0] > 0
+
+    @staticmethod
+    def _doc_id(tool: str, key: str) -> str:
+        return f"{tool}:{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+
+    def get(self, tool: str, key: str) -> Optional[Any]:
+        """Return the cached value for (tool, key), or None on a miss."""
+        if not self._enabled(tool):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entries = self._local[tool]
+            entry = entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    entries.move_to_end(key)
+                    self._stats[tool]["local_hits"] += 1
+                    return value
+                del entries[key]
+
+        value = self._get_shared(tool, key)
+        with self._lock:
+            if value is None:
+                self._stats[tool]["misses"] += 1
+                return None
+            self._stats[tool]["shared_hits"] += 1
+        self._put_local(tool, key, value)
+        return value
+
+    def _get_shared(self, tool: str, key: str) -> Optional[Any]:
+        if self._collection is None:
+            return None
+        try:
+            doc = self._collection.find_one(
+                {
+                    "_id": self._doc_id(tool, key),
+                    "expires_at": {"$gt": datetime.now(timezone.utc)},
+                }
+            )
+        except Exception as e:
+            logger.warning(f"Tool cache lookup failed for {tool}: {e}")
+            return None
+        return doc["value"] if doc else None
+
+    def _put_local(self, tool: str, key: str, value: Any) -> None:
+        ttl, max_entries = self.policies[tool]
+        with self._lock:
+            entries = self._local[tool]
+            entries[key] = (time.monotonic() + ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > max_entries:
+                entries.popitem(last=False)
+
+    def put(self, tool: str, key: str, value: Any) -> None:
+        """Store a value in both tiers."""
+        if not self._enabled(tool):
+            return
+        self._put_local(tool, key, value)
+        if self._collection is None:
+            return
+        ttl = self.policies[tool][0]
+        try:
+            self._collection.replace_one(
+                {"_id": self._doc_id(tool, key)},
+                {
+                    "tool": tool,
+                    "key": key,
+                    "value": value,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+                },
+                upsert=True,
+            )
+        except Exception as e:
+            logger.warning(f"Tool cache write failed for {tool}: {e}")
+
+    def clear(self) -> None:
+        """Drop all in-process entries and reset the counters."""
+        with self._lock:
+            for tool in self.policies:
+                self._local[tool].clear()
+                self._stats[tool] = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+
+    def register_gauges(self) -> None:
+        """Export the counters and size of each tool as telemetry gauges."""
+        for tool in self.policies:
+            for counter in ("local_hits", "shared_hits", "misses", "size"):
+                telemetry.gauge(
+                    f"tool_cache_{tool}_{counter}",
+                    f"{counter.replace('_', ' ').capitalize()} of the {tool} cache.",
+                    lambda tool=tool, counter=counter: self.stats()[tool][counter],
+                )
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return hit/miss counters and current size per tool."""
+        with self._lock:
+            return {
+                tool: {**counters, "size": len(self._local[tool])}
+                for tool, counters in self._stats.items()
+            }